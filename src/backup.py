@@ -0,0 +1,50 @@
+import argparse
+import logging
+import sys
+from pathlib import Path
+
+from lib.backup import BackupError, BackupStore
+
+logger = logging.getLogger("backup")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "backup",
+        description="Create, list, verify and restore backups of Keabot's database and image store. Stop the bot before restoring."
+    )
+    parser.add_argument("action", choices=["create", "list", "verify", "restore"])
+    parser.add_argument("backup_dir", type=Path, help="Folder holding the backups (backup_dir in the config)")
+    parser.add_argument("-d", dest="data_folder", type=Path, default=Path("/app/data"))
+    parser.add_argument("--snapshot", help="Snapshot to verify or restore, defaults to the latest")
+    parser.add_argument("--keep", type=int, default=0, help="After create, delete all but this many snapshots")
+    parser.add_argument("--quick", action="store_true", help="Verify sizes only, without hashing every blob")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    DATA_DIR: Path = args.data_folder
+    store = BackupStore(args.backup_dir)
+    try:
+        if args.action == "create":
+            store.create(DATA_DIR / "db" / "keabot.sqlite3", DATA_DIR / "images")
+            if args.keep:
+                store.prune(args.keep)
+        elif args.action == "list":
+            for manifest in store.snapshots():
+                print(manifest)
+        elif args.action == "verify":
+            problems = store.verify(args.snapshot, full=not args.quick)
+            for problem in problems:
+                logger.error(problem)
+            logger.info("%d problems found", len(problems))
+            return 1 if problems else 0
+        else:
+            store.restore(DATA_DIR, args.snapshot)
+    except BackupError as e:
+        logger.error("%s", e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+import argparse
+import asyncio
+import json
+import shutil
+import tempfile
+from pathlib import Path
+
+from . import results
+from .micro import run_micro
+from .replay import recorded_events, replay, synthetic_events
+from .synthetic import generate_database, load_dataset
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "python -m bench",
+        description="Offline benchmarks for Keabot. Run from src/. Never point micro or replay at the live data folder; they write to the database."
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    generate = sub.add_parser("generate", help="Create a synthetic data folder")
+    generate.add_argument("data_folder", type=Path)
+    generate.add_argument("--guilds", type=int, default=3)
+    generate.add_argument("--users", type=int, default=500, help="Users per guild")
+    generate.add_argument("--images", type=int, default=5000, help="Images per guild")
+    generate.add_argument("--tags", type=int, default=200, help="Tags per guild")
+    generate.add_argument("--seed", type=int, default=0)
+
+    for name, help_text in (("micro", "Time every database helper"), ("replay", "Replay events through Keabot's handlers")):
+        cmd = sub.add_parser(name, help=help_text)
+        cmd.add_argument("data_folder", type=Path, nargs="?", help="Existing data folder. A temporary synthetic one is generated if omitted")
+        cmd.add_argument("-o", dest="output", type=Path, help="Write results as JSON")
+        cmd.add_argument("--seed", type=int, default=0)
+    sub.choices["micro"].add_argument("--iterations", type=int, default=1000)
+    replay_cmd = sub.choices["replay"]
+    replay_cmd.add_argument("--events", type=int, default=20000, help="Synthetic events to generate")
+    replay_cmd.add_argument("--record", type=Path, help="Replay this JSONL event file instead of a synthetic stream")
+    replay_cmd.add_argument("--concurrency", type=int, default=50)
+    replay_cmd.add_argument("--gateway-delay", type=float, default=0.0, help="Seconds a member query takes")
+    replay_cmd.add_argument("--upload-delay", type=float, default=0.0, help="Seconds an upload takes")
+    replay_cmd.add_argument("--config", type=Path, help="config.json to build the bot with")
+
+    compare = sub.add_parser("compare", help="Compare two result files")
+    compare.add_argument("baseline", type=Path)
+    compare.add_argument("current", type=Path)
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        generate_database(args.data_folder, args.guilds, args.users, args.images, args.tags, seed=args.seed)
+        return
+    if args.command == "compare":
+        results.compare(json.loads(args.baseline.read_text()), json.loads(args.current.read_text()))
+        return
+
+    temp_dir = None
+    data_dir = args.data_folder
+    if data_dir is None:
+        temp_dir = Path(tempfile.mkdtemp(prefix="keabot-bench-"))
+        data_dir = temp_dir
+        dataset = generate_database(data_dir, seed=args.seed)
+    else:
+        dataset = load_dataset(data_dir)
+    try:
+        if args.command == "micro":
+            output = {"benchmarks": run_micro(data_dir, dataset, args.iterations, args.seed)}
+        else:
+            events = recorded_events(args.record) if args.record else synthetic_events(dataset, args.events, seed=args.seed)
+            config = json.loads(args.config.read_text()) if args.config else {}
+            output = asyncio.run(replay(
+                data_dir, dataset, events, args.concurrency, config, args.gateway_delay, args.upload_delay
+            ))
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+
+    results.print_table(output["benchmarks"])
+    if "loop_lag" in output:
+        lag = output["loop_lag"]
+        print(f"event loop lag: p50 {lag['p50_ms']:.3f} ms, p99 {lag['p99_ms']:.3f} ms, max {lag['max_ms']:.3f} ms")
+    if args.output:
+        results.save({"command": args.command, **output}, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import random
+import sqlite3
+import time
+from pathlib import Path
+
+from lib.db import configure_connection
+from lib.db_stats import helper_calls
+
+from .results import summarize
+from .synthetic import Dataset
+
+
+def run_micro(data_dir: Path, dataset: Dataset, iterations: int = 1000, seed: int = 0) -> dict[str, dict]:
+    """Time every score_helper/image_helper function directly against the database.
+
+    Arguments are drawn at random from the dataset on every call so caches
+    see a realistic spread of keys. Write helpers commit as they do in the bot.
+    """
+    rng = random.Random(seed)
+    conn = sqlite3.connect(data_dir / "db" / "keabot.sqlite3")
+    conn.row_factory = sqlite3.Row
+    configure_connection(conn)
+
+    def sample_args() -> dict:
+        guild_id = rng.choice(dataset.guild_ids)
+        return {
+            "server_id": guild_id,
+            "user_id": rng.choice(dataset.user_ids[guild_id] or [0]),
+            "tag_server_id": guild_id,
+            "tag": rng.choice(dataset.tags[guild_id] or ["tag"]),
+        }
+
+    names = [fn.__name__ for fn, *_ in helper_calls(sample_args())]
+    latencies: dict[str, list[float]] = {name: [] for name in names}
+    elapsed: dict[str, float] = {name: 0.0 for name in names}
+    for _ in range(iterations):
+        for fn, *args in helper_calls(sample_args()):
+            start = time.perf_counter()
+            fn(conn, *args)
+            took = time.perf_counter() - start
+            latencies[fn.__name__].append(took)
+            elapsed[fn.__name__] += took
+    conn.close()
+    return {name: summarize(latencies[name], elapsed[name]) for name in names}
@@ -0,0 +1,266 @@
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator, Optional
+
+import discord
+
+from lib.database import Database
+from lib.keabot import Keabot
+
+from .results import summarize
+from .synthetic import Dataset
+
+# Relative frequency of each event in a synthetic stream
+DEFAULT_MIX = {
+    "reaction_add": 60,
+    "reaction_remove": 10,
+    "postimage": 15,
+    "leaderboard": 5,
+    "score": 8,
+    "tags": 2,
+}
+
+
+# Just enough of discord.py's models for Keabot's handlers and commands
+
+@dataclass(eq=False)
+class StubMember:
+    id: int
+    guild: Optional["StubGuild"] = None
+    display_name: str = ""
+
+    def __post_init__(self):
+        self.display_name = self.display_name or f"user{self.id}"
+
+    def __eq__(self, other):
+        return isinstance(other, StubMember) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+@dataclass
+class StubAttachment:
+    url: str
+    filename: str = "file"
+    id: int = 0
+
+
+@dataclass
+class StubChannel:
+    id: int = 1
+
+
+@dataclass
+class StubMessage:
+    id: int
+    author: Optional[StubMember] = None
+    guild: Optional["StubGuild"] = None
+    channel: StubChannel = field(default_factory=StubChannel)
+    attachments: list[StubAttachment] = field(default_factory=list)
+
+
+class StubGuild:
+    def __init__(self, guild_id: int, member_ids: list[int], gateway_delay: float = 0.0, member_cache: bool = True):
+        self.id = guild_id
+        self.members = {member_id: StubMember(member_id, self) for member_id in member_ids}
+        self.gateway_delay = gateway_delay
+        self.member_cache = member_cache
+        self.filesize_limit = 25 * 1024 * 1024
+        self.member_queries = 0
+
+    def get_member(self, user_id: int) -> Optional[StubMember]:
+        # Lean mode keeps no library member cache
+        return self.members.get(user_id) if self.member_cache else None
+
+    async def query_members(self, user_ids: list[int], limit: int = 5, **kwargs) -> list[StubMember]:
+        self.member_queries += 1
+        await asyncio.sleep(self.gateway_delay)
+        return [self.members.get(user_id, StubMember(user_id, self)) for user_id in user_ids][:limit]
+
+
+class StubContext:
+    """Stands in for commands.Context; replies are counted, uploads are not sent anywhere."""
+
+    _message_ids = 0
+
+    def __init__(self, guild: StubGuild, author: StubMember, upload_delay: float = 0.0):
+        self.guild = guild
+        self.author = author
+        self.interaction = None
+        self.clean_prefix = ".."
+        self.upload_delay = upload_delay
+        self.message = self._new_message()
+        self.replies = 0
+
+    def _new_message(self) -> StubMessage:
+        StubContext._message_ids += 1
+        return StubMessage(StubContext._message_ids, self.author, self.guild)
+
+    async def reply(self, content=None, *, embed=None, file: Optional[discord.File] = None, **kwargs) -> StubMessage:
+        self.replies += 1
+        message = self._new_message()
+        if file is not None:
+            file.close()
+            await asyncio.sleep(self.upload_delay)
+            message.attachments.append(StubAttachment(
+                url=f"https://cdn.invalid/attachments/1/{message.id}/{file.filename}", filename=file.filename, id=message.id
+            ))
+        return message
+
+    send = reply
+
+
+def synthetic_events(dataset: Dataset, count: int, mix: dict[str, int] = DEFAULT_MIX, seed: int = 0) -> Iterator[dict]:
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    # Real snowflakes, so gold lands in the current day/week/month rollups
+    message_ids = iter(range(discord.utils.time_snowflake(discord.utils.utcnow()), 2**63))
+    # Half of all reactions land on one of the last few hundred messages reacted to
+    recent: list[tuple[int, int, int]] = []
+    for _ in range(count):
+        guild_id = rng.choice(dataset.guild_ids)
+        users = dataset.user_ids[guild_id]
+        event = {"type": rng.choices(kinds, weights)[0], "guild": guild_id, "user": rng.choice(users)}
+        if event["type"].startswith("reaction"):
+            if recent and rng.random() < 0.5:
+                message_id, guild_id, receiver = rng.choice(recent)
+                event["guild"], event["user"] = guild_id, rng.choice(dataset.user_ids[guild_id])
+            else:
+                message_id, receiver = next(message_ids), rng.choice(users)
+                recent = [*recent[-299:], (message_id, guild_id, receiver)]
+            event["receiver"] = receiver
+            event["message"] = message_id
+        elif event["type"] == "postimage":
+            event["tag"] = rng.choice(dataset.tags[guild_id])
+            # Some multi-tag queries: a b, a|b, a -b
+            if rng.random() < 0.3:
+                other = rng.choice(dataset.tags[guild_id])
+                event["tag"] += rng.choice([" ", "|", " -"]) + other
+        elif event["type"] == "leaderboard":
+            event["number"] = rng.choice([5, 10, 25])
+            event["window"] = rng.choice(["all", "all", "week", "month", "day"])
+        yield event
+
+
+def recorded_events(path: Path) -> Iterator[dict]:
+    """One JSON event per line, in the same shape synthetic_events produces."""
+    with path.open() as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+async def _sample_loop_lag(samples: list[float], interval: float = 0.01):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - start - interval))
+
+
+async def replay(
+        data_dir: Path,
+        dataset: Dataset,
+        events: Iterator[dict],
+        concurrency: int = 50,
+        config: Optional[dict] = None,
+        gateway_delay: float = 0.0,
+        upload_delay: float = 0.0) -> dict:
+    """Push events through a real Keabot's reaction handlers and command callbacks.
+
+    Up to `concurrency` events are in flight at once, like a busy gateway.
+    Network calls are simulated by the stubs and take `gateway_delay` and
+    `upload_delay` seconds.
+    """
+    db = Database(data_dir / "db" / "keabot.sqlite3")
+    bot = Keabot(
+        db=db,
+        root_dir=data_dir,
+        data_dir=data_dir,
+        config=config or {},
+        intents=discord.Intents.default(),
+        command_prefix=".."
+    )
+    await bot.setup_hook()
+    lean = (config or {}).get("lean_mode", False)
+    guilds = {
+        guild_id: StubGuild(guild_id, dataset.user_ids[guild_id], gateway_delay, member_cache=not lean)
+        for guild_id in dataset.guild_ids
+    }
+    commands = {name: bot.get_command(name).callback for name in ("postimage", "leaderboard", "score", "tags")}
+    gold = discord.PartialEmoji(name="gold", id=1)
+    authors: dict[int, tuple[int, StubGuild]] = {}
+    message_fetches = 0
+
+    async def fetch_message(channel_id: int, guild_id: int, message_id: int) -> StubMessage:
+        nonlocal message_fetches
+        message_fetches += 1
+        await asyncio.sleep(gateway_delay)
+        author_id, guild = authors[message_id]
+        return StubMessage(message_id, guild.members.get(author_id) or StubMember(author_id, guild), guild)
+
+    bot.message_authors.fetch_message = fetch_message
+
+    async def dispatch(event: dict):
+        guild = guilds[event["guild"]]
+        user = guild.members.get(event["user"]) or StubMember(event["user"], guild)
+        kind = event["type"]
+        if kind in ("reaction_add", "reaction_remove"):
+            authors[event["message"]] = (event["receiver"], guild)
+            payload = discord.RawReactionActionEvent(
+                {"message_id": event["message"], "channel_id": 1, "user_id": user.id, "guild_id": guild.id},
+                gold,
+                "REACTION_ADD" if kind == "reaction_add" else "REACTION_REMOVE"
+            )
+            handler = bot.on_raw_reaction_add if kind == "reaction_add" else bot.on_raw_reaction_remove
+            await handler(payload)
+            return
+        ctx = StubContext(guild, user, upload_delay)
+        if kind == "postimage":
+            await commands["postimage"](ctx, tag=event["tag"])
+        elif kind == "leaderboard":
+            await commands["leaderboard"](ctx, event.get("number", 5), event.get("window", "all"))
+        elif kind == "score":
+            await commands["score"](ctx, None)
+        elif kind == "tags":
+            await commands["tags"](ctx, 1)
+
+    latencies: dict[str, list[float]] = {}
+    lag: list[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(event: dict):
+        try:
+            start = time.perf_counter()
+            await dispatch(event)
+            latencies.setdefault(event["type"], []).append(time.perf_counter() - start)
+        finally:
+            semaphore.release()
+
+    lag_task = asyncio.create_task(_sample_loop_lag(lag))
+    tasks = []
+    started = time.perf_counter()
+    for event in events:
+        await semaphore.acquire()
+        tasks.append(asyncio.create_task(timed(event)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    lag_task.cancel()
+    await bot.close()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        "benchmarks": {
+            "replay.all": summarize(all_latencies, elapsed),
+            **{f"replay.{kind}": summarize(values, elapsed) for kind, values in sorted(latencies.items())},
+        },
+        "loop_lag": summarize(lag, elapsed),
+        "member_queries": sum(guild.member_queries for guild in guilds.values()),
+        "message_fetches": message_fetches,
+    }
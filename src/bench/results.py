@@ -0,0 +1,58 @@
+import json
+import platform
+import time
+from pathlib import Path
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: list[float], elapsed: float) -> dict:
+    """Latencies in seconds -> count, throughput and percentiles in milliseconds."""
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "throughput_per_s": len(values) / elapsed if elapsed else 0.0,
+        "mean_ms": sum(values) / len(values) * 1000 if values else 0.0,
+        "p50_ms": percentile(values, 50) * 1000,
+        "p90_ms": percentile(values, 90) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+        "max_ms": values[-1] * 1000 if values else 0.0,
+    }
+
+
+def save(results: dict, path: Path):
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        **results,
+    }
+    path.write_text(json.dumps(results, indent=2))
+
+
+def print_table(results: dict[str, dict]):
+    print(f"{'name':32} {'count':>7} {'ops/s':>10} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, row in results.items():
+        print(
+            f"{name:32} {row['count']:7d} {row['throughput_per_s']:10.1f} {row['p50_ms']:9.3f}"
+            f" {row['p90_ms']:9.3f} {row['p99_ms']:9.3f} {row['max_ms']:9.3f}"
+        )
+
+
+def compare(baseline: dict, current: dict):
+    """Print p50/p99 changes for every benchmark present in both result files."""
+    print(f"{'name':32} {'p50 ms':>19} {'p99 ms':>19}")
+    for name, row in current["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if base is None:
+            continue
+        cells = []
+        for key in ("p50_ms", "p99_ms"):
+            change = (row[key] - base[key]) / base[key] * 100 if base[key] else 0.0
+            cells.append(f"{row[key]:9.3f} ({change:+6.1f}%)")
+        print(f"{name:32} {cells[0]:>19} {cells[1]:>19}")
@@ -0,0 +1,84 @@
+import random
+import sqlite3
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from lib.blob_store import blob_path
+from lib.db import configure_connection, migrate
+from lib.image_helper import add_images_bulk
+from lib.score_helper import apply_score_deltas
+
+
+@dataclass
+class Dataset:
+    guild_ids: list[int]
+    user_ids: dict[int, list[int]] = field(default_factory=dict)
+    tags: dict[int, list[str]] = field(default_factory=dict)
+
+
+def snowflake(rng: random.Random) -> int:
+    return rng.randrange(10**17, 10**18)
+
+
+def generate_database(
+        data_dir: Path,
+        guilds: int = 3,
+        users: int = 500,
+        images: int = 5000,
+        tags: int = 200,
+        tags_per_image: int = 2,
+        seed: int = 0,
+        with_files: bool = True) -> Dataset:
+    """Build a keabot data dir (db/ and images/) with `users`, `images` and `tags` per guild.
+
+    Tag popularity is skewed so a few tags hold most images, like a real guild.
+    With `with_files`, an empty placeholder is created for every image so
+    postimage can build its upload.
+    """
+    rng = random.Random(seed)
+    (data_dir / "db").mkdir(parents=True, exist_ok=True)
+    (data_dir / "images").mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(data_dir / "db" / "keabot.sqlite3")
+    configure_connection(conn)
+    migrate(conn)
+
+    dataset = Dataset(guild_ids=[snowflake(rng) for _ in range(guilds)])
+    for guild_id in dataset.guild_ids:
+        user_ids = [snowflake(rng) for _ in range(users)]
+        dataset.user_ids[guild_id] = user_ids
+        apply_score_deltas(conn, {
+            (guild_id, user_id): [int(rng.paretovariate(1.2)) - 1, rng.randrange(50), rng.randrange(5)]
+            for user_id in user_ids
+        })
+
+        tag_names = [f"tag{n}" for n in range(tags)]
+        dataset.tags[guild_id] = tag_names
+        weights = [1 / (rank + 1) for rank in range(tags)]
+        batch = []
+        for _ in range(images):
+            filename = f"{rng.getrandbits(256):064x}.png"
+            image_tags = set(rng.choices(tag_names, weights, k=tags_per_image))
+            batch.append((filename, sorted(image_tags)))
+            if with_files:
+                path = blob_path(data_dir / "images", filename)
+                path.parent.mkdir(exist_ok=True)
+                path.touch()
+            if len(batch) >= 1000:
+                add_images_bulk(conn, guild_id, batch)
+                batch = []
+        if batch:
+            add_images_bulk(conn, guild_id, batch)
+    conn.close()
+    return dataset
+
+
+def load_dataset(data_dir: Path) -> Dataset:
+    """Recover guild, user and tag ids from an existing (synthetic or real) database."""
+    conn = sqlite3.connect(data_dir / "db" / "keabot.sqlite3")
+    guild_ids = sorted({int(row[0]) for row in conn.execute("SELECT DISTINCT server_id FROM user UNION SELECT DISTINCT server_id FROM tag")})
+    dataset = Dataset(guild_ids=guild_ids)
+    for guild_id in guild_ids:
+        dataset.user_ids[guild_id] = [int(row[0]) for row in conn.execute("SELECT user_id FROM user WHERE server_id = ?", (guild_id,))]
+        dataset.tags[guild_id] = [row[0] for row in conn.execute("SELECT name FROM tag WHERE server_id = ?", (guild_id,))]
+    conn.close()
+    return dataset
@@ -0,0 +1,178 @@
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterator
+
+from lib.blob_store import blob_path, migrate_flat_layout
+from lib.db import configure_connection, migrate
+from lib.image_helper import add_images_bulk, touch_blobs
+
+logger = logging.getLogger("import_images")
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path: Path) -> str:
+    hasher = hashlib.sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def folder_sources(source: Path) -> Iterator[tuple[Path, list[str]]]:
+    """<source>/<tag>/<file>: every file is tagged with its folder name."""
+    for tag_dir in sorted(source.iterdir()):
+        if not tag_dir.is_dir():
+            continue
+        for image in sorted(tag_dir.iterdir()):
+            if image.is_file():
+                yield image, [tag_dir.name]
+
+
+def csv_sources(source: Path, mapping: Path) -> Iterator[tuple[Path, list[str]]]:
+    """Rows of `path,tags` where path is relative to source and tags are separated by ';'."""
+    with mapping.open(newline="") as f:
+        for row in csv.DictReader(f):
+            tags = [tag.strip() for tag in row["tags"].split(";") if tag.strip()]
+            if tags:
+                yield source / row["path"], tags
+
+
+def store_file(path: Path, dest: Path) -> str:
+    """Put a file into the image store. Hard links when possible, never overwrites."""
+    if dest.exists():
+        return "skipped"
+    dest.parent.mkdir(exist_ok=True)
+    try:
+        os.link(path, dest)
+        return "linked"
+    except FileExistsError:
+        return "skipped"
+    except OSError:
+        # Different filesystem, or links not supported
+        tmp = dest.with_name(f".import-{dest.name}")
+        shutil.copy2(path, tmp)
+        os.replace(tmp, dest)
+        return "copied"
+
+
+def load_manifest(manifest: Path) -> set[str]:
+    if not manifest.exists():
+        return set()
+    done = set()
+    with manifest.open() as f:
+        for line in f:
+            if line.strip():
+                done.add(json.loads(line)["source"])
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "import_images",
+        description="Bulk import an image archive into Keabot's image store and database. Safe to re-run; finished files are skipped."
+    )
+    parser.add_argument("guild_id", type=int, help="Guild the images belong to")
+    parser.add_argument("source", type=Path, help="Folder containing the archive")
+    parser.add_argument("-d", dest="data_folder", type=Path, default=Path("/app/data"))
+    parser.add_argument("--layout", choices=["folders", "csv"], default="folders",
+                        help="folders: one sub-folder per tag. csv: tags come from --mapping")
+    parser.add_argument("--mapping", type=Path, help="CSV with 'path' and 'tags' columns for --layout csv")
+    parser.add_argument("--manifest", type=Path, help="Checkpoint file, defaults to <data>/import/<guild_id>.jsonl")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Hashing processes")
+    parser.add_argument("--batch-size", type=int, default=500, help="Files per database transaction")
+    parser.add_argument("--dry-run", action="store_true", help="Hash and report without changing anything")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    DATA_DIR: Path = args.data_folder
+    images_dir = DATA_DIR / "images"
+    manifest = args.manifest or DATA_DIR / "import" / f"{args.guild_id}.jsonl"
+
+    if args.layout == "csv":
+        if not args.mapping:
+            parser.error("--layout csv needs --mapping")
+        sources = list(csv_sources(args.source, args.mapping))
+    else:
+        sources = list(folder_sources(args.source))
+
+    done = load_manifest(manifest)
+    todo = [(path, tags) for path, tags in sources if str(path) not in done]
+    logger.info("%d files found, %d already imported, %d to go", len(sources), len(sources) - len(todo), len(todo))
+    if not todo:
+        return
+
+    conn = None
+    manifest_file = None
+    if not args.dry_run:
+        images_dir.mkdir(parents=True, exist_ok=True)
+        manifest.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(DATA_DIR / "db" / "keabot.sqlite3")
+        configure_connection(conn)
+        migrate(conn)
+        migrate_flat_layout(images_dir, DATA_DIR / "db" / "keabot.sqlite3")
+        manifest_file = manifest.open("a")
+
+    counts = {"linked": 0, "copied": 0, "skipped": 0}
+    total_bytes = 0
+    processed = 0
+    started = time.perf_counter()
+    batch: list[tuple[Path, list[str], str]] = []
+    seen: set[str] = set()
+
+    def flush():
+        nonlocal processed
+        if not batch:
+            return
+        if conn is not None:
+            # Registered first: a file stored but not registered would never be collected
+            touch_blobs(conn, sorted({filename for _, _, filename in batch}), int(time.time()))
+            for path, _, filename in batch:
+                counts[store_file(path, blob_path(images_dir, filename))] += 1
+            add_images_bulk(conn, args.guild_id, [(filename, tags) for _, tags, filename in batch])
+            for path, _, filename in batch:
+                manifest_file.write(json.dumps({"source": str(path), "file": filename}) + "\n")
+            manifest_file.flush()
+        processed += len(batch)
+        batch.clear()
+        elapsed = time.perf_counter() - started
+        logger.info(
+            "%d/%d files (%.1f files/s, %.1f MiB/s) linked=%d copied=%d already stored=%d",
+            processed, len(todo), processed / elapsed, total_bytes / elapsed / 1024 / 1024,
+            counts["linked"], counts["copied"], counts["skipped"]
+        )
+
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            hashes = pool.map(hash_file, [path for path, _ in todo], chunksize=16)
+            for (path, tags), file_hash in zip(todo, hashes):
+                filename = f"{file_hash}{path.suffix}"
+                total_bytes += path.stat().st_size
+                if args.dry_run:
+                    stored = filename in seen or blob_path(images_dir, filename).exists()
+                    counts["skipped" if stored else "linked"] += 1
+                    seen.add(filename)
+                batch.append((path, tags, filename))
+                if len(batch) >= args.batch_size:
+                    flush()
+            flush()
+    finally:
+        if conn is not None:
+            conn.close()
+            manifest_file.close()
+    if args.dry_run:
+        logger.info("Dry run: %d files would be stored, %d are already in the store", counts["linked"], counts["skipped"])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
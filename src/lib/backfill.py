@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Optional, Union
+
+import discord
+from discord import ForumChannel, Guild, TextChannel, Thread
+
+from .database import Database
+
+logger = logging.getLogger(__name__)
+
+# Messages per history request; Discord's maximum
+PAGE_SIZE = 100
+# Users per reaction request and archived threads per thread list request; Discord's maximums
+USERS_PAGE_SIZE = 100
+THREAD_PAGE_SIZE = 100
+
+
+class RateLimiter:
+    """Token bucket shared by every channel scan.
+
+    discord.py already waits out 429s per route, but a backfill left to run
+    flat out would spend the global request budget the live bot needs. This
+    keeps it to `rate` requests per second across all channels.
+    """
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+@dataclass
+class BackfillProgress:
+    channels: int = 0
+    channels_done: int = 0
+    messages: int = 0
+    reactions: int = 0
+    failed: list[str] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        text = (f"{self.channels_done}/{self.channels} channels, {self.messages} messages, "
+                f"{self.reactions} gold reactions")
+        if self.failed:
+            text += f", failed: {', '.join(self.failed)}"
+        return text
+
+
+class Backfill:
+    """Reconciles the gold ledger of a guild with its channel history.
+
+    Text channels and their threads, archived ones included, are scanned up
+    to `concurrency` at a time, oldest message first. Every page of history
+    is written together with the channel's checkpoint, so a stopped backfill
+    picks up where it left off. Once every channel and thread has been
+    scanned the guild's counters are rebuilt from the ledger. Each request
+    counts against the rate limit, every page of a thread list or of a
+    reaction's users included.
+    """
+
+    def __init__(self, db: Database, emoji_name: str = "gold", concurrency: int = 3, rate: float = 5.0):
+        self.db = db
+        self.emoji_name = emoji_name
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+
+    async def run(self, guild: Guild, progress: Optional[BackfillProgress] = None) -> BackfillProgress:
+        progress = progress or BackfillProgress()
+        channels = await self._channels(guild, progress)
+        progress.channels = len(channels)
+        checkpoints = await self.db.get_backfill_checkpoints(guild.id)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def scan(channel: Union[TextChannel, Thread]):
+            async with semaphore:
+                checkpoint = checkpoints.get(channel.id)
+                try:
+                    await self._scan_channel(guild, channel, checkpoint["last_message_id"] if checkpoint else None, progress)
+                except discord.HTTPException:
+                    logger.exception("Backfill of channel %d in guild %d failed", channel.id, guild.id)
+                    progress.failed.append(channel.name)
+                    return
+                progress.channels_done += 1
+
+        logger.info("Backfilling %d channels and threads of guild %d", len(channels), guild.id)
+        await asyncio.gather(*(scan(channel) for channel in channels))
+        # Rebuilding without every channel and thread would drop the gold in those left out
+        if not progress.failed:
+            await self.db.rebuild_scores(guild.id)
+        logger.info("Backfill of guild %d finished: %s", guild.id, progress)
+        return progress
+
+    async def _channels(self, guild: Guild, progress: BackfillProgress) -> list[Union[TextChannel, Thread]]:
+        """Readable text channels of `guild` and the threads in them and its forums, active and archived."""
+        me = guild.me
+
+        def readable(channel: Union[TextChannel, ForumChannel, Thread]) -> bool:
+            permissions = channel.permissions_for(me)
+            return permissions.view_channel and permissions.read_message_history
+
+        parents = {channel.id: channel for channel in (*guild.text_channels, *guild.forums) if readable(channel)}
+        channels: list[Union[TextChannel, Thread]] = [channel for channel in parents.values() if isinstance(channel, TextChannel)]
+        threads: dict[int, Thread] = {}
+        try:
+            await self.limiter.acquire()
+            threads.update((thread.id, thread) for thread in await guild.active_threads())
+        except discord.HTTPException:
+            logger.exception("Listing the active threads of guild %d failed", guild.id)
+            progress.failed.append("active threads")
+        for parent in parents.values():
+            # Private archived threads can only be listed with Manage Threads; forums have none
+            private_too = isinstance(parent, TextChannel) and parent.permissions_for(me).manage_threads
+            for private in (False, True) if private_too else (False,):
+                try:
+                    threads.update((thread.id, thread) for thread in await self._archived_threads(parent, private))
+                except discord.HTTPException:
+                    logger.exception("Listing the archived threads of channel %d in guild %d failed", parent.id, guild.id)
+                    progress.failed.append(f"{parent.name} threads")
+        channels.extend(thread for thread in threads.values() if thread.parent_id in parents and readable(thread))
+        return channels
+
+    async def _archived_threads(self, parent: Union[TextChannel, ForumChannel], private: bool) -> list[Thread]:
+        threads = []
+        before = None
+        while True:
+            await self.limiter.acquire()
+            page = [thread async for thread in parent.archived_threads(limit=THREAD_PAGE_SIZE, before=before, private=private)]
+            threads.extend(page)
+            if len(page) < THREAD_PAGE_SIZE:
+                return threads
+            # Listed newest archived first
+            before = page[-1].archive_timestamp
+
+    async def _reaction_users(self, reaction: discord.Reaction) -> list[int]:
+        users = []
+        after = None
+        while True:
+            await self.limiter.acquire()
+            page = [user async for user in reaction.users(limit=USERS_PAGE_SIZE, after=after)]
+            users.extend(user.id for user in page)
+            if len(page) < USERS_PAGE_SIZE:
+                return users
+            after = page[-1]
+
+    async def _scan_channel(self, guild: Guild, channel: Union[TextChannel, Thread], after_id: Optional[int], progress: BackfillProgress):
+        while True:
+            await self.limiter.acquire()
+            after = discord.Object(after_id) if after_id else None
+            page = [message async for message in channel.history(limit=PAGE_SIZE, after=after, oldest_first=True)]
+            if not page:
+                if after_id is not None:
+                    await self.db.reconcile_reactions(guild.id, channel.id, [], after_id, True, int(time.time()))
+                return
+            messages = []
+            for message in page:
+                reactions = []
+                for reaction in message.reactions:
+                    if not reaction.is_custom_emoji() or reaction.emoji.name != self.emoji_name:
+                        continue
+                    emoji = str(reaction.emoji.id)
+                    reactions.extend((emoji, user_id) for user_id in await self._reaction_users(reaction))
+                messages.append((message.id, message.author.id, reactions))
+                progress.reactions += len(reactions)
+            after_id = page[-1].id
+            done = len(page) < PAGE_SIZE
+            await self.db.reconcile_reactions(guild.id, channel.id, messages, after_id, done, int(time.time()))
+            progress.messages += len(page)
+            if done:
+                return
@@ -0,0 +1,333 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator, Optional
+
+from .blob_store import blob_path
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+DATABASE_FILE = "keabot.sqlite3"
+MANIFEST_FILE = "manifest.json"
+LOCK_FILE = ".lock"
+# A stepped backup restarts whenever another connection writes to the source.
+# After this many restarts the rest is copied in one step instead, which in WAL
+# mode is a single read transaction and still doesn't block the writer.
+MAX_RESTARTS = 5
+
+
+class BackupError(Exception):
+    pass
+
+
+class _Restarted(Exception):
+    pass
+
+
+@dataclass
+class Manifest:
+    name: str
+    created: float
+    database_sha256: str = ""
+    database_size: int = 0
+    # blob name -> (size, sha256)
+    blobs: dict[str, tuple[int, str]] = field(default_factory=dict)
+    copied_blobs: int = 0
+    copied_bytes: int = 0
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "name": self.name,
+            "created": self.created,
+            "database": {"sha256": self.database_sha256, "size": self.database_size},
+            "blobs": self.blobs,
+            "copied_blobs": self.copied_blobs,
+            "copied_bytes": self.copied_bytes,
+        })
+
+    @classmethod
+    def from_json(cls, text: str) -> "Manifest":
+        data = json.loads(text)
+        return cls(
+            data["name"],
+            data["created"],
+            data["database"]["sha256"],
+            data["database"]["size"],
+            {name: tuple(entry) for name, entry in data["blobs"].items()},
+            data.get("copied_blobs", 0),
+            data.get("copied_bytes", 0)
+        )
+
+    def __str__(self) -> str:
+        total = sum(size for size, _ in self.blobs.values())
+        return (f"{self.name}: database {self.database_size / 1024 / 1024:.1f} MiB, "
+                f"{len(self.blobs)} blobs ({total / 1024 / 1024:.1f} MiB), "
+                f"{self.copied_blobs} new ({self.copied_bytes / 1024 / 1024:.1f} MiB)")
+
+
+def file_sha256(path: Path) -> str:
+    hasher = hashlib.sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _copy_hashed(source: Path, dest: Path) -> tuple[int, str]:
+    """Copy through a temp file, hashing on the way. Returns (size, sha256)."""
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_name(f".backup-{dest.name}")
+    hasher = hashlib.sha256()
+    size = 0
+    with source.open("rb") as src, tmp.open("wb") as out:
+        while chunk := src.read(HASH_CHUNK_SIZE):
+            hasher.update(chunk)
+            out.write(chunk)
+            size += len(chunk)
+    os.replace(tmp, dest)
+    return size, hasher.hexdigest()
+
+
+def copy_database(db_path: Path, dest: Path, pages: int = 256, pause: float = 0.01):
+    """Copy a live database with SQLite's online backup API, `pages` pages at a time.
+
+    Reads go through a separate read-only connection and the copy pauses
+    `pause` seconds between steps, so the bot's own connections are never held
+    up for more than one step. The copy is switched out of WAL mode so it is a
+    single self-contained file.
+    """
+    source = sqlite3.connect(f"{db_path.resolve().as_uri()}?mode=ro", uri=True)
+    target = sqlite3.connect(dest)
+    restarts = 0
+    last_remaining = None
+
+    def progress(status: int, remaining: int, total: int):
+        nonlocal restarts, last_remaining
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > MAX_RESTARTS:
+                raise _Restarted()
+        last_remaining = remaining
+        time.sleep(pause)
+
+    try:
+        try:
+            source.backup(target, pages=pages, progress=progress)
+        except _Restarted:
+            logger.info("Database kept changing during the stepped backup, copying the rest in one step")
+            source.backup(target)
+        target.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        source.close()
+        target.close()
+
+
+class BackupStore:
+    """Snapshots of the database and image store in `root`.
+
+    Each snapshot is a directory under `snapshots/` holding a copy of the
+    database and a manifest of the blobs it references, with their sizes and
+    SHA-256. Blob files themselves are shared between snapshots in `blobs/`,
+    laid out like the image store, and a blob is only copied the first time a
+    snapshot needs it, so each backup costs one database copy plus the media
+    added since the last one.
+
+    Creating, pruning and restoring hold an exclusive lock on the store, so
+    the bot and the command line tool never run them over each other.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.snapshots_dir = root / "snapshots"
+        self.blobs_dir = root / "blobs"
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        self.root.mkdir(parents=True, exist_ok=True)
+        with (self.root / LOCK_FILE).open("a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def snapshots(self) -> list[Manifest]:
+        """Finished snapshots, oldest first."""
+        if not self.snapshots_dir.is_dir():
+            return []
+        manifests = []
+        for directory in sorted(self.snapshots_dir.iterdir()):
+            manifest = directory / MANIFEST_FILE
+            if not directory.name.startswith(".") and manifest.exists():
+                manifests.append(Manifest.from_json(manifest.read_text()))
+        return manifests
+
+    def manifest(self, name: Optional[str] = None) -> Manifest:
+        snapshots = self.snapshots()
+        if not snapshots:
+            raise BackupError(f"No snapshots in {self.root}")
+        if name is None:
+            return snapshots[-1]
+        for manifest in snapshots:
+            if manifest.name == name:
+                return manifest
+        raise BackupError(f"No snapshot named {name}")
+
+    def create(self, db_path: Path, images_dir: Path, pages: int = 256, pause: float = 0.01) -> Manifest:
+        with self._locked():
+            return self._create(db_path, images_dir, pages, pause)
+
+    def _create(self, db_path: Path, images_dir: Path, pages: int, pause: float) -> Manifest:
+        started = time.time()
+        # Down to the microsecond, so back to back snapshots get their own names
+        name = datetime.fromtimestamp(started, timezone.utc).strftime("%Y%m%dT%H%M%S.%fZ")
+        work = self.snapshots_dir / f".{name}"
+        work.mkdir(parents=True, exist_ok=True)
+        manifest = Manifest(name, started)
+
+        database = work / DATABASE_FILE
+        copy_database(db_path, database, pages, pause)
+        manifest.database_size = database.stat().st_size
+        manifest.database_sha256 = file_sha256(database)
+
+        # Blobs the copied database references, whatever has changed on disk since
+        conn = sqlite3.connect(database)
+        try:
+            names = [row[0] for row in conn.execute("SELECT name FROM blob WHERE refs > 0 ORDER BY name")]
+        finally:
+            conn.close()
+        known: dict[str, tuple[int, str]] = {}
+        for previous in self.snapshots():
+            known.update(previous.blobs)
+        missing = 0
+        for blob in names:
+            dest = blob_path(self.blobs_dir, blob)
+            if blob in known and dest.exists():
+                manifest.blobs[blob] = known[blob]
+                continue
+            source = blob_path(images_dir, blob)
+            try:
+                manifest.blobs[blob] = _copy_hashed(source, dest)
+            except FileNotFoundError:
+                missing += 1
+                logger.warning("Blob %s is referenced but not in the image store", blob)
+                continue
+            manifest.copied_blobs += 1
+            manifest.copied_bytes += manifest.blobs[blob][0]
+        if missing:
+            logger.warning("%d referenced blobs were missing from the image store", missing)
+
+        (work / MANIFEST_FILE).write_text(manifest.to_json())
+        os.replace(work, self.snapshots_dir / name)
+        logger.info("Backup %s finished in %.1fs", manifest, time.time() - started)
+        return manifest
+
+    def verify(self, name: Optional[str] = None, full: bool = True) -> list[str]:
+        """Problems found in a snapshot (the latest by default); empty if it is intact.
+
+        Checks the database copy's checksum and SQLite's integrity check, and
+        that every blob in the manifest is present with the right size. With
+        `full`, every blob is hashed as well.
+        """
+        manifest = self.manifest(name)
+        directory = self.snapshots_dir / manifest.name
+        problems = []
+        database = directory / DATABASE_FILE
+        if not database.exists():
+            return [f"{DATABASE_FILE} is missing"]
+        if file_sha256(database) != manifest.database_sha256:
+            problems.append(f"{DATABASE_FILE} does not match its checksum")
+        conn = sqlite3.connect(f"{database.resolve().as_uri()}?mode=ro", uri=True)
+        try:
+            result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+        finally:
+            conn.close()
+        if result != "ok":
+            problems.append(f"integrity check: {result}")
+        for blob, (size, sha256) in manifest.blobs.items():
+            path = blob_path(self.blobs_dir, blob)
+            if not path.exists():
+                problems.append(f"{blob} is missing")
+            elif path.stat().st_size != size:
+                problems.append(f"{blob} is {path.stat().st_size} bytes, expected {size}")
+            elif full and file_sha256(path) != sha256:
+                problems.append(f"{blob} does not match its checksum")
+        return problems
+
+    def restore(self, data_dir: Path, name: Optional[str] = None) -> Manifest:
+        """Put a snapshot back in place in `data_dir`. The bot must not be running.
+
+        The current database is kept next to it as `keabot.sqlite3.before-<snapshot>`.
+        Blobs already in the image store are left alone; missing ones are copied back.
+        """
+        with self._locked():
+            return self._restore(data_dir, name)
+
+    def _restore(self, data_dir: Path, name: Optional[str]) -> Manifest:
+        manifest = self.manifest(name)
+        problems = self.verify(manifest.name, full=False)
+        if problems:
+            raise BackupError(f"Snapshot {manifest.name} is damaged: {'; '.join(problems[:5])}")
+        images_dir = data_dir / "images"
+        restored = 0
+        for blob, (size, _) in manifest.blobs.items():
+            dest = blob_path(images_dir, blob)
+            if dest.exists() and dest.stat().st_size == size:
+                continue
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            tmp = dest.with_name(f".restore-{dest.name}")
+            shutil.copyfile(blob_path(self.blobs_dir, blob), tmp)
+            os.replace(tmp, dest)
+            restored += 1
+
+        db_path = data_dir / "db" / DATABASE_FILE
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        if db_path.exists():
+            os.replace(db_path, db_path.with_name(f"{DATABASE_FILE}.before-{manifest.name}"))
+        # The old WAL belongs to the database that was moved aside
+        for suffix in ("-wal", "-shm"):
+            stale = db_path.with_name(DATABASE_FILE + suffix)
+            if stale.exists():
+                os.replace(stale, db_path.with_name(f"{DATABASE_FILE}.before-{manifest.name}{suffix}"))
+        tmp = db_path.with_name(f".restore-{DATABASE_FILE}")
+        shutil.copyfile(self.snapshots_dir / manifest.name / DATABASE_FILE, tmp)
+        os.replace(tmp, db_path)
+        logger.info("Restored snapshot %s (%d blobs copied back)", manifest.name, restored)
+        return manifest
+
+    def prune(self, keep: int) -> int:
+        """Delete all but the newest `keep` snapshots, then blobs no remaining snapshot lists. Returns snapshots deleted."""
+        with self._locked():
+            return self._prune(keep)
+
+    def _prune(self, keep: int) -> int:
+        snapshots = self.snapshots()
+        expired = snapshots[:-keep] if keep > 0 else []
+        if not expired:
+            return 0
+        for manifest in expired:
+            shutil.rmtree(self.snapshots_dir / manifest.name)
+        kept = {blob for manifest in snapshots[-keep:] for blob in manifest.blobs}
+        deleted = 0
+        for path in list(self.blobs_dir.rglob("*")):
+            # Temp files of a copy still in progress start with a dot
+            if not path.is_file() or path.name.startswith("."):
+                continue
+            parts = path.relative_to(self.blobs_dir).parts
+            # <sh>/<name> or derived/<sh>/<name>
+            blob = "/".join((*parts[:-2], parts[-1]))
+            if blob not in kept:
+                path.unlink()
+                deleted += 1
+        logger.info("Deleted %d old snapshots and %d blobs only they used", len(expired), deleted)
+        return len(expired)
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Callable
+
+from .database import Database
+from .image_helper import touch_blobs
+
+logger = logging.getLogger(__name__)
+
+# Leading characters of a blob name used as its directory
+SHARD_CHARS = 2
+
+
+def blob_path(root: Path, name: str) -> Path:
+    """Where blob `name` lives on disk: `<sha>.<ext>` goes in `<root>/<sh>/`, `derived/<sha>...` in `<root>/derived/<sh>/`."""
+    parent, _, base = name.rpartition("/")
+    return root / parent / base[:SHARD_CHARS] / base
+
+
+def _flat_files(directory: Path) -> list[str]:
+    if not directory.is_dir():
+        return []
+    with os.scandir(directory) as entries:
+        # Temp files from ingest and import start with a dot
+        return [entry.name for entry in entries if entry.is_file() and not entry.name.startswith(".")]
+
+
+def migrate_flat_layout(root: Path, db_path: Path, batch_size: int = 1000) -> int:
+    """Move files stored directly in `root` (and `root/derived`) into their shard directories.
+
+    Every moved file is registered in the blob table, so files no image ever
+    referenced become orphans the garbage collector will remove. Returns the
+    number of files moved; a no-op once the store is sharded.
+    """
+    names = [*_flat_files(root), *(f"derived/{name}" for name in _flat_files(root / "derived"))]
+    if not names:
+        return 0
+    logger.info("Moving %d files into the sharded image store", len(names))
+    conn = sqlite3.connect(db_path)
+    try:
+        for start in range(0, len(names), batch_size):
+            batch = names[start:start + batch_size]
+            # Registered first: a file moved but not registered would never be collected
+            touch_blobs(conn, batch, int(time.time()))
+            for name in batch:
+                dest = blob_path(root, name)
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(root / name, dest)
+    finally:
+        conn.close()
+    return len(names)
+
+
+def _put(tmp_path: str, dest: Path) -> bool:
+    if dest.exists():
+        os.unlink(tmp_path)
+        return True
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(tmp_path, dest)
+    return False
+
+
+def _unlink(paths: list[Path]):
+    for path in paths:
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class BlobStore:
+    """Content-addressed media files, sharded by hash prefix and reference counted in SQLite.
+
+    Blobs are named `<sha256>.<ext>` (derivatives `derived/<sha256>.<variant>.<ext>`)
+    and that name is what the database stores. Triggers on `image` and
+    `derivative` keep each blob's reference count. A blob nothing references
+    is deleted by `collect_garbage` once it has been unreferenced for `grace`
+    seconds, a few at a time, together with its derivatives, cached link and
+    hash.
+    """
+
+    def __init__(self, root: Path, db: Database, grace: int = 3600, batch_size: int = 100):
+        self.root = root
+        self.db = db
+        self.grace = grace
+        self.batch_size = batch_size
+        # Called with the names of every collected batch
+        self.collect_listeners: list[Callable[[list[str]], None]] = []
+        # Held while a batch is deleted so put() can't revive a blob mid-collection
+        self._lock = asyncio.Lock()
+        self.collected = 0
+
+    def path(self, name: str) -> Path:
+        return blob_path(self.root, name)
+
+    async def put(self, tmp_path: str, name: str) -> bool:
+        """Move a finished temp file into the store as `name`. Returns True if it was already stored.
+
+        The blob starts unreferenced, and has `grace` seconds for an image
+        row to reference it before it is collected.
+        """
+        async with self._lock:
+            existed = await asyncio.to_thread(_put, tmp_path, self.path(name))
+            await self.db.touch_blobs([name], int(time.time()))
+        return existed
+
+    async def collect_garbage(self, pause: float = 0.1) -> int:
+        """Delete unreferenced blobs in batches of `batch_size` until none are due. Returns the number deleted."""
+        total = 0
+        while True:
+            async with self._lock:
+                names = await self.db.collect_orphan_blobs(int(time.time()) - self.grace, self.batch_size)
+                await asyncio.to_thread(_unlink, [self.path(name) for name in names])
+            if not names:
+                break
+            total += len(names)
+            for listener in self.collect_listeners:
+                listener(names)
+            # Let the live bot's writes in between batches
+            await asyncio.sleep(pause)
+        if total:
+            self.collected += total
+            logger.info("Deleted %d unreferenced blobs", total)
+        return total
@@ -0,0 +1,313 @@
+import asyncio
+import functools
+import itertools
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from multiprocessing.connection import Client, Connection, Listener
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Optional
+
+from . import metrics
+from .database import Database
+
+logger = logging.getLogger(__name__)
+
+# How long a worker keeps trying to reach the writer before failing a write
+CONNECT_TIMEOUT = 30.0
+
+
+def assign_shards(shard_count: int, processes: int) -> list[list[int]]:
+    """Shard ids for each worker, dealt out in turn so every worker gets a similar share."""
+    return [list(range(index, shard_count, processes)) for index in range(processes)]
+
+
+@dataclass
+class WorkerSpec:
+    index: int
+    shard_ids: list[int]
+    shard_count: int
+    writer_address: str
+    authkey: bytes
+
+    @property
+    def primary(self) -> bool:
+        # The primary worker syncs commands and runs the background maintenance
+        return self.index == 0
+
+
+class ClusterDatabase(Database):
+    """Database for a cluster worker: reads are local, writes go to the writer process.
+
+    Reads use the worker's own read-only connections to the WAL database.
+    Writes are pickled (helper function, arguments) and sent over a Unix
+    socket to `serve_writes`, which runs them on the cluster's single writer
+    connection. The result is only returned once it has been committed, so a
+    read issued after a write sees it. If the writer restarts, the writes in
+    flight fail and the next write reconnects.
+    """
+
+    def __init__(self, db_path: Path, writer_address: str, authkey: bytes, readers: int = 4):
+        self.writer_address = writer_address
+        self.authkey = authkey
+        self._remote: Optional[Connection] = None
+        self._pending: dict[int, tuple[Future, str, float]] = {}
+        self._pending_lock = threading.Lock()
+        self._request_ids = itertools.count()
+        super().__init__(db_path, readers)
+
+    def _open_writer(self) -> None:
+        # The supervisor created and migrated the database before starting workers
+        return None
+
+    def _connect_remote(self) -> Connection:
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while True:
+            try:
+                remote = Client(self.writer_address, family="AF_UNIX", authkey=self.authkey)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.5)
+        threading.Thread(target=self._receive_loop, args=(remote,), name="keabot-db-results", daemon=True).start()
+        logger.info("Connected to the database writer at %s", self.writer_address)
+        return remote
+
+    def _write_loop(self):
+        # Forwards queued writes instead of running them
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                break
+            fn, args, kwargs, future, queued_at = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            metrics.DB_QUEUE_SECONDS.labels().observe(time.perf_counter() - queued_at)
+            request_id = next(self._request_ids)
+            with self._pending_lock:
+                self._pending[request_id] = (future, fn.__name__, time.perf_counter())
+            remote = self._remote
+            try:
+                if remote is None:
+                    remote = self._remote = self._connect_remote()
+                remote.send((request_id, fn, args, kwargs))
+            except Exception as e:
+                logger.exception("Could not send database write %s", fn.__name__)
+                with self._pending_lock:
+                    self._pending.pop(request_id, None)
+                self._drop_remote(remote)
+                future.set_exception(e)
+        self._drop_remote(self._remote)
+        logger.info("Database writer connection closed")
+
+    def _receive_loop(self, remote: Connection):
+        while True:
+            try:
+                request_id, ok, value = remote.recv()
+            except (EOFError, OSError):
+                break
+            with self._pending_lock:
+                future, name, sent = self._pending.pop(request_id, (None, "", 0.0))
+            if future is None:
+                continue
+            metrics.DB_SECONDS.labels(name, "write").observe(time.perf_counter() - sent)
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+        if self._remote is remote:
+            logger.warning("Lost the connection to the database writer")
+        self._drop_remote(remote)
+
+    def _drop_remote(self, remote: Optional[Connection]):
+        if remote is None:
+            return
+        if self._remote is remote:
+            self._remote = None
+        try:
+            remote.close()
+        except OSError:
+            pass
+        # Whatever was in flight on it may or may not have been applied
+        with self._pending_lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for future, name, _ in pending:
+            if not future.done():
+                future.set_exception(ConnectionError(f"Database writer went away during {name}"))
+
+
+def _send_result(remote: Connection, lock: threading.Lock, request_id: int, future: Future):
+    error = future.exception()
+    message = (request_id, True, future.result()) if error is None else (request_id, False, error)
+    with lock:
+        if remote.closed:
+            # The worker went away; its side already failed the write
+            return
+        try:
+            remote.send(message)
+        except OSError:
+            pass
+        except Exception as e:
+            # A result or exception that doesn't pickle
+            remote.send((request_id, False, RuntimeError(repr(error or e))))
+
+
+def _serve_connection(db: Database, remote: Connection):
+    lock = threading.Lock()
+    while True:
+        try:
+            request_id, fn, args, kwargs = remote.recv()
+        except (EOFError, OSError):
+            break
+        future = db.submit_write(fn, args, kwargs)
+        future.add_done_callback(functools.partial(_send_result, remote, lock, request_id))
+    remote.close()
+
+
+def _run_maintenance(loop: asyncio.AbstractEventLoop, task: Callable[[], Awaitable[None]]):
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(task())
+    except asyncio.CancelledError:
+        pass
+    finally:
+        loop.close()
+
+
+def serve_writes(db_path: Path, address: str, authkey: bytes,
+                 maintenance: Optional[Callable[[Database], Awaitable[None]]] = None):
+    """Run the cluster's database writer: accept workers on `address` and apply their writes in order.
+
+    Every worker connection gets a thread that feeds the one writer thread of
+    a local Database, so writes from all workers are serialised on a single
+    SQLite connection. `maintenance(db)`, if given, runs on its own event
+    loop thread for as long as the writer does. Returns on SIGTERM, once
+    queued writes are done.
+    """
+    db = Database(db_path, readers=1)
+    maintainer = None
+    if maintenance is not None:
+        loop = asyncio.new_event_loop()
+        maintainer = threading.Thread(
+            target=_run_maintenance, args=(loop, lambda: maintenance(db)), name="keabot-maintenance", daemon=True
+        )
+        maintainer.start()
+    if os.path.exists(address):
+        os.unlink(address)
+    listener = Listener(address, family="AF_UNIX", authkey=authkey)
+    stopping = threading.Event()
+
+    def stop(*_):
+        stopping.set()
+        # Unblocks accept()
+        listener.close()
+
+    signal.signal(signal.SIGTERM, stop)
+    # Ctrl+C reaches every process in the group; the writer stays up until
+    # the supervisor stops it, after the workers' last writes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger.info("Database writer listening on %s", address)
+    while not stopping.is_set():
+        try:
+            remote = listener.accept()
+        except (OSError, EOFError, multiprocessing.AuthenticationError):
+            if not stopping.is_set():
+                logger.warning("Rejected a connection to the database writer", exc_info=True)
+            continue
+        threading.Thread(target=_serve_connection, args=(db, remote), name="keabot-db-client", daemon=True).start()
+    if maintainer is not None:
+        loop.call_soon_threadsafe(lambda: [task.cancel() for task in asyncio.all_tasks(loop)])
+        maintainer.join(30)
+    # Finishes what was already queued
+    asyncio.run(db.close())
+
+
+class _Child:
+    def __init__(self, name: str, target: Callable, args: tuple, heartbeat: Optional[Any] = None):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.heartbeat = heartbeat
+        self.process: Optional[multiprocessing.Process] = None
+        self.started = 0.0
+        self.failures = 0
+        self.restart_at = 0.0
+
+
+class Supervisor:
+    """Starts the writer and worker processes, and restarts any that die or stop responding.
+
+    Workers are handed a shared heartbeat value they update from their event
+    loop; one that hasn't been updated for `heartbeat_timeout` seconds is
+    presumed hung and is killed. Restarts back off exponentially (up to a
+    minute) for processes that keep failing soon after starting.
+    """
+
+    def __init__(self, heartbeat_timeout: float = 60.0, check_interval: float = 2.0):
+        self.context = multiprocessing.get_context("spawn")
+        self.heartbeat_timeout = heartbeat_timeout
+        self.check_interval = check_interval
+        self._children: list[_Child] = []
+        self._stopping = threading.Event()
+
+    def add(self, name: str, target: Callable, args: tuple, heartbeat: bool = False):
+        """Register a process. With `heartbeat`, `target` is called with a shared double as its last argument."""
+        value = self.context.Value("d", time.time()) if heartbeat else None
+        self._children.append(_Child(name, target, args, value))
+
+    def _start(self, child: _Child):
+        args = child.args if child.heartbeat is None else (*child.args, child.heartbeat)
+        if child.heartbeat is not None:
+            child.heartbeat.value = time.time()
+        child.process = self.context.Process(target=child.target, args=args, name=child.name)
+        child.process.start()
+        child.started = time.time()
+        logger.info("Started %s (pid %d)", child.name, child.process.pid)
+
+    def _check(self, child: _Child):
+        now = time.time()
+        process = child.process
+        if process is None:
+            if now >= child.restart_at:
+                self._start(child)
+            return
+        if process.is_alive():
+            if child.heartbeat is None or now - child.heartbeat.value < self.heartbeat_timeout:
+                return
+            logger.error("%s has not sent a heartbeat for %.0fs, killing it", child.name, now - child.heartbeat.value)
+            process.kill()
+            process.join(10)
+        else:
+            logger.error("%s exited with code %s", child.name, process.exitcode)
+        # Only back off for processes that keep dying shortly after they start
+        child.failures = child.failures + 1 if now - child.started < 300 else 0
+        child.restart_at = now + min(60, 2 ** child.failures - 1)
+        child.process = None
+
+    def stop(self, *_):
+        self._stopping.set()
+
+    def run(self) -> int:
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for child in self._children:
+            self._start(child)
+        while not self._stopping.wait(self.check_interval):
+            for child in self._children:
+                self._check(child)
+        # Workers first, so their last writes still reach the writer
+        for child in reversed(self._children):
+            if child.process is not None and child.process.is_alive():
+                child.process.terminate()
+                child.process.join(30)
+                if child.process.is_alive():
+                    child.process.kill()
+        logger.info("Cluster stopped")
+        return 0
@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from sqlite3 import Connection, Row
+from typing import Any, Callable, Optional
+
+from . import db, db_stats, image_helper, metrics, score_helper
+
+logger = logging.getLogger(__name__)
+
+
+class Database:
+    """Async access to the keabot database.
+
+    Every helper from score_helper/image_helper runs on a worker thread so the
+    event loop never touches SQLite. All writes are funnelled through one writer
+    thread fed by a queue; reads go to a small pool of read-only connections.
+    """
+
+    def __init__(self, db_path: Path, readers: int = 4):
+        self.db_path = Path(db_path)
+        self._write_queue: queue.Queue = queue.Queue()
+        self._reader_conns: list[Connection] = []
+        self._reader_lock = threading.Lock()
+        self._local = threading.local()
+        self._closed = False
+
+        # Opening the writer first creates the database file so the
+        # read-only connections have something to attach to.
+        self._writer_conn = self._open_writer()
+        self._writer = threading.Thread(target=self._write_loop, name="keabot-db-writer", daemon=True)
+        self._writer.start()
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="keabot-db-reader")
+
+    def _connect(self, read_only: bool = False) -> Connection:
+        if read_only:
+            uri = f"{self.db_path.resolve().as_uri()}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        db.configure_connection(conn, read_only=read_only)
+        return conn
+
+    def _open_writer(self) -> Optional[Connection]:
+        return self._connect()
+
+    def _write_loop(self):
+        conn = self._writer_conn
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                break
+            fn, args, kwargs, future, queued_at = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.perf_counter()
+            metrics.DB_QUEUE_SECONDS.labels().observe(started - queued_at)
+            try:
+                result = fn(conn, *args, **kwargs)
+            except BaseException as e:
+                logger.exception("Database write %s failed", fn.__name__)
+                conn.rollback()
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                metrics.DB_SECONDS.labels(fn.__name__, "write").observe(time.perf_counter() - started)
+        conn.close()
+        logger.info("Database writer stopped")
+
+    def _reader_conn(self) -> Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect(read_only=True)
+            self._local.conn = conn
+            with self._reader_lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    def _run_read(self, fn: Callable, args, kwargs):
+        with metrics.DB_SECONDS.labels(fn.__name__, "read").time():
+            return fn(self._reader_conn(), *args, **kwargs)
+
+    async def read(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run fn(conn, *args) on one of the read-only connections."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._run_read, fn, args, kwargs)
+
+    def submit_write(self, fn: Callable[..., Any], args: tuple, kwargs: dict) -> Future:
+        """Queue fn(conn, *args) for the writer thread. Safe to call from any thread."""
+        if self._closed:
+            raise RuntimeError("Database is closed")
+        future: Future = Future()
+        self._write_queue.put((fn, args, kwargs, future, time.perf_counter()))
+        return future
+
+    async def write(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Queue fn(conn, *args) for the writer thread and wait for its result."""
+        return await asyncio.wrap_future(self.submit_write(fn, args, kwargs))
+
+    async def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._write_queue.put(None)
+        await asyncio.to_thread(self._writer.join)
+        self._readers.shutdown(wait=True)
+        with self._reader_lock:
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns.clear()
+
+    # score_helper
+    async def check_user(self, server_id: int, user_id: int) -> bool:
+        return await self.read(score_helper.check_user, server_id, user_id)
+
+    async def add_user(self, server_id: int, user_id: int):
+        return await self.write(score_helper.add_user, server_id, user_id)
+
+    async def increment_score(self, server_id: int, user_id: int):
+        return await self.write(score_helper.increment_score, server_id, user_id)
+
+    async def decrement_score(self, server_id: int, user_id: int):
+        return await self.write(score_helper.decrement_score, server_id, user_id)
+
+    async def get_score(self, server_id: int, user_id: int) -> int:
+        return await self.read(score_helper.get_score, server_id, user_id)
+
+    async def get_server_scores(self, server_id: int) -> list[Row]:
+        return await self.read(score_helper.get_server_scores, server_id)
+
+    async def get_top_scores(self, server_id: int, num: int = 5, window: str = "all") -> list[Row]:
+        return await self.read(score_helper.get_top_scores, server_id, num, window)
+
+    async def increment_self(self, server_id: int, user_id: int):
+        return await self.write(score_helper.increment_self, server_id, user_id)
+
+    async def decrement_self(self, server_id: int, user_id: int):
+        return await self.write(score_helper.decrement_self, server_id, user_id)
+
+    async def increment_given(self, server_id: int, user_id: int):
+        return await self.write(score_helper.increment_given, server_id, user_id)
+
+    async def decrement_given(self, server_id: int, user_id: int):
+        return await self.write(score_helper.decrement_given, server_id, user_id)
+
+    async def apply_score_deltas(self, deltas: dict[tuple[int, int], list[int]]):
+        return await self.write(score_helper.apply_score_deltas, deltas)
+
+    async def apply_reactions(self, reactions: list[dict]) -> dict[tuple[int, int], list[int]]:
+        return await self.write(score_helper.apply_reactions, reactions)
+
+    async def reconcile_reactions(self, server_id: int, channel_id: int, messages: list[tuple[int, int, list[tuple[str, int]]]],
+                                  last_message_id: int, done: bool, updated_at: int):
+        return await self.write(
+            score_helper.reconcile_reactions, server_id, channel_id, messages, last_message_id, done, updated_at
+        )
+
+    async def get_ledger_states(self, keys: list[tuple[int, int, str]]) -> dict[tuple[int, int, str], int]:
+        return await self.read(score_helper.get_ledger_states, keys)
+
+    async def rebuild_scores(self, server_id: int):
+        return await self.write(score_helper.rebuild_scores, server_id)
+
+    async def compact_rollups(self, keep: dict[str, int]) -> int:
+        return await self.write(score_helper.compact_rollups, keep)
+
+    async def get_backfill_checkpoints(self, server_id: int) -> dict[int, Row]:
+        return await self.read(score_helper.get_backfill_checkpoints, server_id)
+
+    # image_helper
+    async def get_random_image(self, server_id: int, tag: str) -> Optional[Path]:
+        return await self.read(image_helper.get_random_image, server_id, tag)
+
+    async def add_tag(self, server_id: int, tag: str):
+        return await self.write(image_helper.add_tag, server_id, tag)
+
+    async def check_tag(self, server_id: int, tag: str) -> bool:
+        return await self.read(image_helper.check_tag, server_id, tag)
+
+    async def get_tags(self, server_id: int) -> list[str]:
+        return await self.read(image_helper.get_tags, server_id)
+
+    async def add_image(self, server_id: int, tags: list[str], filename: str) -> tuple[int, list[str]]:
+        return await self.write(image_helper.add_image, server_id, tags, filename)
+
+    async def get_tag_counts(self, server_id: int) -> list[Row]:
+        return await self.read(image_helper.get_tag_counts, server_id)
+
+    async def get_tag_images(self, server_id: int, tag: str) -> list[Row]:
+        return await self.read(image_helper.get_tag_images, server_id, tag)
+
+    async def get_guild_image_tags(self, server_id: int) -> list[Row]:
+        return await self.read(image_helper.get_guild_image_tags, server_id)
+
+    async def get_shuffle_bag(self, server_id: int, tag: str) -> Optional[Row]:
+        return await self.read(image_helper.get_shuffle_bag, server_id, tag)
+
+    async def save_shuffle_bag(self, server_id: int, tag: str, seed: int, size: int, position: int):
+        return await self.write(image_helper.save_shuffle_bag, server_id, tag, seed, size, position)
+
+    async def get_media_url(self, server_id: int, file_path: str) -> Optional[Row]:
+        return await self.read(image_helper.get_media_url, server_id, file_path)
+
+    async def save_media_url(self, server_id: int, file_path: str, url: str, channel_id: int, message_id: int, last_used: int):
+        return await self.write(image_helper.save_media_url, server_id, file_path, url, channel_id, message_id, last_used)
+
+    async def delete_media_url(self, server_id: int, file_path: str):
+        return await self.write(image_helper.delete_media_url, server_id, file_path)
+
+    async def prune_media_urls(self, max_entries: int) -> int:
+        return await self.write(image_helper.prune_media_urls, max_entries)
+
+    async def get_derivatives(self, file_path: str) -> list[Row]:
+        return await self.read(image_helper.get_derivatives, file_path)
+
+    async def save_derivatives(self, file_path: str, derivatives: list[tuple[str, str, int]]):
+        return await self.write(image_helper.save_derivatives, file_path, derivatives)
+
+    async def save_image_hashes(self, hashes: list[tuple[str, int]]):
+        return await self.write(image_helper.save_image_hashes, hashes)
+
+    async def get_guild_image_hashes(self, server_id: int) -> list[tuple[int, str, int]]:
+        return await self.read(image_helper.get_guild_image_hashes, server_id)
+
+    async def touch_blobs(self, names: list[str], now: int):
+        return await self.write(image_helper.touch_blobs, names, now)
+
+    async def collect_orphan_blobs(self, orphaned_before: int, limit: int) -> list[str]:
+        return await self.write(image_helper.collect_orphan_blobs, orphaned_before, limit)
+
+    async def get_media_file(self, message_id: int) -> Optional[str]:
+        return await self.read(image_helper.get_media_file, message_id)
+
+    async def delete_image(self, server_id: int, file_path: str) -> int:
+        return await self.write(image_helper.delete_image, server_id, file_path)
+
+    async def delete_tag(self, server_id: int, tag: str) -> Optional[int]:
+        return await self.write(image_helper.delete_tag, server_id, tag)
+
+    # diagnostics
+    async def query_plans(self) -> list[tuple[str, str, list[str]]]:
+        return await self.read(db_stats.query_plans)
+
+    async def summary(self) -> str:
+        return await self.read(db_stats.database_summary)
@@ -1,12 +1,56 @@
 import sqlite3
 from pathlib import Path
+from typing import Callable
+import logging
 import sys
 
+logger = logging.getLogger(__name__)
+
+# Connection settings applied to every connection the bot opens
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE_KIB = 16 * 1024
+BUSY_TIMEOUT_MS = 5000
+
+def configure_connection(conn: sqlite3.Connection, read_only: bool = False):
+    if not read_only:
+        # WAL is persistent in the database file, so only the writer sets it
+        conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+
 def initialize_database(db_name: Path):
     # Connect to SQLite database (it will create the database if it doesn't exist)
     conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
+    configure_connection(conn)
+    migrate(conn)
+    conn.close()
 
+def migrate(conn: sqlite3.Connection) -> int:
+    """Apply every migration newer than the database's user_version."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        logger.info("Applying database migration %d (%s)", number, migration.__name__)
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        try:
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {number}")
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        cursor.close()
+        version = number
+    return version
+
+# Migrations run in order, each in its own transaction. Never edit one that has
+# shipped; append a new one instead.
+def _base_schema(cursor: sqlite3.Cursor):
     # Create 'image' table to store file paths and server IDs
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS image (
@@ -50,9 +94,260 @@ def initialize_database(db_name: Path):
         )
     ''')
 
-    # Commit the changes and close the connection
-    conn.commit()
-    conn.close()
+def _shuffle_bag(cursor: sqlite3.Cursor):
+    # Persisted position of the per-tag shuffle bag used by postimage
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shuffle_bag (
+            server_id TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            seed INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (server_id, tag)
+        )
+    ''')
+
+def _hot_query_indexes(cursor: sqlite3.Cursor):
+    # Leaderboard reads the top N scores of a server straight from this index
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS user_server_score ON user (server_id, score DESC)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS image_server ON image (server_id)
+    ''')
+    # image_tag's primary key starts with image_id, so tag -> images needs its own index
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS image_tag_tag ON image_tag (tag_id, image_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS tag_server ON tag (server_id)
+    ''')
+
+def _image_file_index(cursor: sqlite3.Cursor):
+    # add_image looks up an existing row for the same file before inserting
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS image_server_file ON image (server_id, file_path)
+    ''')
+
+def _media_url(cursor: sqlite3.Cursor):
+    # Discord attachment an image was last seen in, so postimage can link it
+    # instead of uploading the same bytes again
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS media_url (
+            file_path TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            channel_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            last_used INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS media_url_last_used ON media_url (last_used)
+    ''')
+
+def _gold_ledger(cursor: sqlite3.Cursor):
+    # One row per gold reaction ever seen. Rows are never deleted; a removed
+    # reaction is marked inactive, so replaying an add or remove is a no-op
+    # and the user counters can be rebuilt from the active rows.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS gold_ledger (
+            message_id INTEGER NOT NULL,
+            gifter_id TEXT NOT NULL,
+            emoji TEXT NOT NULL,
+            server_id TEXT NOT NULL,
+            channel_id INTEGER NOT NULL,
+            receiver_id TEXT NOT NULL,
+            active INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (message_id, gifter_id, emoji)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS gold_ledger_server ON gold_ledger (server_id, active)
+    ''')
+    # How far the history backfill got in each channel
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS backfill_checkpoint (
+            channel_id INTEGER PRIMARY KEY,
+            server_id TEXT NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            done INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    ''')
+
+def _score_rollup(cursor: sqlite3.Cursor):
+    # Gold per user per calendar day, week and month, so a windowed
+    # leaderboard reads the top of a single bucket from the index
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS score_rollup (
+            server_id TEXT NOT NULL,
+            period TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            user_id TEXT NOT NULL,
+            score INTEGER NOT NULL,
+            given INTEGER NOT NULL,
+            self INTEGER NOT NULL,
+            PRIMARY KEY (server_id, period, bucket, user_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS score_rollup_top ON score_rollup (server_id, period, bucket, score DESC)
+    ''')
+    # Compaction deletes whole buckets across every server
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS score_rollup_bucket ON score_rollup (period, bucket)
+    ''')
+
+def _derivative(cursor: sqlite3.Cursor):
+    # Every version of a stored file postimage may upload, the original
+    # included (variant 'original'), so a file is only processed once
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS derivative (
+            file_path TEXT NOT NULL,
+            variant TEXT NOT NULL,
+            derived_path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            PRIMARY KEY (file_path, variant)
+        )
+    ''')
+
+def _image_hash(cursor: sqlite3.Cursor):
+    # Perceptual hash of each stored file, for near-duplicate detection.
+    # Stored as a signed 64-bit integer.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS image_hash (
+            file_path TEXT PRIMARY KEY,
+            phash INTEGER NOT NULL
+        )
+    ''')
+
+def _blob_triggers(cursor: sqlite3.Cursor, table: str, column: str, condition: str):
+    """Keep blob.refs in step with the rows of `table` whose `column` names a blob and that match `condition`."""
+    new, old = condition.format(row="NEW"), condition.format(row="OLD")
+    increment = f'''
+        INSERT OR IGNORE INTO blob (name, refs) VALUES (NEW.{column}, 0);
+        UPDATE blob SET refs = refs + 1, orphaned_at = NULL WHERE name = NEW.{column};
+    '''
+    decrement = f'''
+        UPDATE blob SET
+            refs = refs - 1,
+            orphaned_at = CASE WHEN refs = 1 THEN CAST(strftime('%s', 'now') AS INTEGER) END
+        WHERE name = OLD.{column};
+    '''
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_blob_insert AFTER INSERT ON {table} WHEN {new} BEGIN {increment} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_blob_delete AFTER DELETE ON {table} WHEN {old} BEGIN {decrement} END")
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_blob_update AFTER UPDATE OF {column} ON {table}
+        WHEN OLD.{column} IS NOT NEW.{column} AND {new}
+        BEGIN {decrement} {increment} END
+    ''')
+
+def _blob(cursor: sqlite3.Cursor):
+    # Reference count of every stored file. Images reference their file and
+    # derivatives their derived file (the 'original' row points back at the
+    # image's own file, so it doesn't count). A blob whose count drops to zero
+    # is stamped with the time, and the garbage collector deletes it once it
+    # has stayed unreferenced for a while.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS blob (
+            name TEXT PRIMARY KEY,
+            refs INTEGER NOT NULL,
+            orphaned_at INTEGER
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS blob_orphaned ON blob (orphaned_at) WHERE refs = 0
+    ''')
+    cursor.execute('''
+        INSERT OR IGNORE INTO blob (name, refs)
+        SELECT name, COUNT(*) FROM (
+            SELECT file_path AS name FROM image
+            UNION ALL
+            SELECT derived_path FROM derivative WHERE variant != 'original'
+        )
+        GROUP BY name
+    ''')
+    _blob_triggers(cursor, "image", "file_path", "1")
+    _blob_triggers(cursor, "derivative", "derived_path", "{row}.variant != 'original'")
+    # deleteimage finds the file behind a message it (or addimage) posted
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS media_url_message ON media_url (message_id)
+    ''')
+
+def _ledger_started_at(cursor: sqlite3.Cursor):
+    # When the gold ledger started recording reactions. Gold on older messages
+    # may have been counted without a ledger row, so a removal with no row on
+    # one of them still takes the point back. Databases that already have a
+    # ledger use its earliest row.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS setting (
+            name TEXT PRIMARY KEY,
+            value
+        )
+    ''')
+    cursor.execute('''
+        INSERT OR IGNORE INTO setting (name, value)
+        SELECT 'ledger_started_at', COALESCE(MIN(updated_at), CAST(strftime('%s', 'now') AS INTEGER))
+        FROM gold_ledger
+    ''')
+
+def _ledger_given_at(cursor: sqlite3.Cursor):
+    # When each active reaction was given, so rollups are bucketed by when
+    # gold was given and a removal undoes the buckets its add went into.
+    # Existing rows were bucketed by their message's time, so they keep it.
+    cursor.execute('''
+        ALTER TABLE gold_ledger ADD COLUMN given_at INTEGER
+    ''')
+    cursor.execute('''
+        UPDATE gold_ledger SET given_at = ((message_id >> 22) + 1420070400000) / 1000
+    ''')
+
+def _media_url_server(cursor: sqlite3.Cursor):
+    # Links are only reused in the server they were posted in: another
+    # server's link exposes its channel and breaks if that message is
+    # deleted. Older rows don't say which server they are from, so they are
+    # dropped; the next upload in each server remembers its own link.
+    cursor.execute('''
+        DROP TABLE media_url
+    ''')
+    cursor.execute('''
+        CREATE TABLE media_url (
+            server_id TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            url TEXT NOT NULL,
+            channel_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            last_used INTEGER NOT NULL,
+            PRIMARY KEY (server_id, file_path)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS media_url_last_used ON media_url (last_used)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS media_url_message ON media_url (message_id)
+    ''')
+    # Collecting a blob drops its links in every server
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS media_url_file ON media_url (file_path)
+    ''')
+
+MIGRATIONS: list[Callable[[sqlite3.Cursor], None]] = [
+    _base_schema,
+    _shuffle_bag,
+    _hot_query_indexes,
+    _image_file_index,
+    _media_url,
+    _gold_ledger,
+    _score_rollup,
+    _derivative,
+    _image_hash,
+    _blob,
+    _ledger_started_at,
+    _ledger_given_at,
+    _media_url_server,
+]
 
 if __name__ == "__main__":
-    initialize_database(sys.argv[1])
\ No newline at end of file
+    initialize_database(sys.argv[1])
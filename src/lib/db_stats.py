@@ -0,0 +1,120 @@
+import sqlite3
+import sys
+from pathlib import Path
+from sqlite3 import Connection
+
+from . import image_helper, score_helper
+
+# Plan details that usually mean a hot query lost its index
+WARN_MARKERS = ("SCAN ", "USE TEMP B-TREE")
+
+
+def _sample_args(conn: Connection) -> dict:
+    row = conn.execute("SELECT server_id, user_id FROM user LIMIT 1").fetchone()
+    server_id, user_id = (row[0], row[1]) if row else (0, 0)
+    row = conn.execute("SELECT server_id, name FROM tag LIMIT 1").fetchone()
+    tag_server_id, tag = (row[0], row[1]) if row else (server_id, "tag")
+    return {"server_id": server_id, "user_id": user_id, "tag_server_id": tag_server_id, "tag": tag}
+
+
+def helper_calls(args: dict) -> list[tuple]:
+    server_id, user_id = args["server_id"], args["user_id"]
+    tag_server_id, tag = args["tag_server_id"], args["tag"]
+    return [
+        (score_helper.check_user, server_id, user_id),
+        (score_helper.get_score, server_id, user_id),
+        (score_helper.get_server_scores, server_id),
+        (score_helper.get_top_scores, server_id, 5),
+        (score_helper.get_top_scores, server_id, 5, "week"),
+        (score_helper.increment_score, server_id, user_id),
+        (score_helper.increment_given, server_id, user_id),
+        (score_helper.increment_self, server_id, user_id),
+        (score_helper.apply_score_deltas, {(server_id, user_id): [1, 0, 0]}),
+        (score_helper.apply_reactions, [{
+            "message_id": 1, "gifter_id": user_id, "emoji": "gold", "server_id": server_id,
+            "channel_id": 1, "receiver_id": user_id, "active": 1, "updated_at": 0
+        }]),
+        (score_helper.reconcile_reactions, server_id, 1, [(1, user_id, [("gold", user_id)])], 1, False, 0),
+        (score_helper.get_ledger_states, [(1, user_id, "gold")]),
+        (score_helper.get_backfill_checkpoints, server_id),
+        (score_helper.rebuild_scores, server_id),
+        (score_helper.compact_rollups, {"day": 14, "week": 8, "month": 12}),
+        (image_helper.get_random_image, tag_server_id, tag),
+        (image_helper.get_tag_images, tag_server_id, tag),
+        (image_helper.get_guild_image_tags, tag_server_id),
+        (image_helper.check_tag, tag_server_id, tag),
+        (image_helper.get_tags, tag_server_id),
+        (image_helper.get_tag_counts, tag_server_id),
+        (image_helper.get_shuffle_bag, tag_server_id, tag),
+        (image_helper.save_shuffle_bag, tag_server_id, tag, 1, 1, 0),
+        (image_helper.add_image, tag_server_id, [tag], "dbstats.png"),
+        (image_helper.save_media_url, tag_server_id, "dbstats.png", "https://example.invalid/dbstats.png", 0, 0, 0),
+        (image_helper.get_media_url, tag_server_id, "dbstats.png"),
+        (image_helper.prune_media_urls, 1000),
+        (image_helper.save_derivatives, "dbstats.png", [("original", "dbstats.png", 1)]),
+        (image_helper.get_derivatives, "dbstats.png"),
+        (image_helper.save_image_hashes, [("dbstats.png", 1)]),
+        (image_helper.get_guild_image_hashes, tag_server_id),
+        (image_helper.get_unhashed_files,),
+        (image_helper.touch_blobs, ["dbstats.png"], 0),
+        (image_helper.get_media_file, 0),
+        (image_helper.delete_image, tag_server_id, "dbstats.png"),
+        (image_helper.collect_orphan_blobs, 0, 100),
+        (image_helper.delete_tag, tag_server_id, "dbstats-deleted"),
+    ]
+
+
+def query_plans(conn: Connection) -> list[tuple[str, str, list[str]]]:
+    """Run every helper against an in-memory copy of `conn` and EXPLAIN what it executed.
+
+    Returns (helper name, sql, plan lines) for each statement.
+    """
+    scratch = sqlite3.connect(":memory:")
+    conn.backup(scratch)
+    scratch.row_factory = sqlite3.Row
+    results = []
+    for fn, *fn_args in helper_calls(_sample_args(scratch)):
+        statements = []
+        scratch.set_trace_callback(statements.append)
+        try:
+            fn(scratch, *fn_args)
+        except sqlite3.Error as e:
+            results.append((fn.__name__, "", [f"error: {e}"]))
+        finally:
+            scratch.set_trace_callback(None)
+        for sql in statements:
+            if not sql.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE")):
+                continue
+            plan = scratch.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+            results.append((fn.__name__, " ".join(sql.split()), [row[3] for row in plan]))
+    scratch.close()
+    return results
+
+
+def format_report(plans: list[tuple[str, str, list[str]]]) -> str:
+    lines = []
+    for name, sql, plan in plans:
+        lines.append(f"{name}: {sql}")
+        for detail in plan:
+            warn = "!" if any(marker in detail for marker in WARN_MARKERS) else " "
+            lines.append(f"  {warn} {detail}")
+    return "\n".join(lines)
+
+
+def database_summary(conn: Connection) -> str:
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    journal = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    pages = conn.execute("PRAGMA page_count").fetchone()[0]
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    counts = ", ".join(
+        f"{table}={conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]}"
+        for table in ("user", "image", "tag", "image_tag", "blob")
+    )
+    return f"schema v{version}, {journal}, {pages * page_size / 1024 / 1024:.1f} MiB, {counts}"
+
+
+if __name__ == "__main__":
+    conn = sqlite3.connect(Path(sys.argv[1]))
+    print(database_summary(conn))
+    print(format_report(query_plans(conn)))
+    conn.close()
@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import os
+import shutil
+import subprocess
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from .blob_store import BlobStore
+from .database import Database
+from .media_pool import MediaPool
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {"jpg", "jpeg", "png", "webp", "bmp", "tiff", "heic"}
+VIDEO_EXTENSIONS = {"mp4", "mov", "webm", "mkv", "avi", "m4v"}
+
+# (variant, longest side in pixels, quality)
+IMAGE_VARIANTS = [("1600", 1600, 82)]
+# (variant, height, crf). The smaller one is only made if the first is still
+# above SMALL_VIDEO_BYTES, i.e. wouldn't fit in an unboosted server.
+VIDEO_VARIANTS = [("720p", 720, 28), ("480p", 480, 32)]
+SMALL_VIDEO_BYTES = 10 * 1024 * 1024
+VIDEO_TIMEOUT = 600
+
+
+class Derivative(NamedTuple):
+    variant: str
+    file_path: str
+    size: int
+
+
+def _temp_path(dest_dir: Path, name: str) -> Path:
+    # Dot files are never mistaken for blobs; DerivativeStore moves them into place
+    return dest_dir / f".{name}"
+
+
+def _resize_image(source: Path, dest_dir: Path, stem: str) -> list[Derivative]:
+    derivatives = []
+    with Image.open(source) as image:
+        if getattr(image, "is_animated", False):
+            # Re-encoding would drop the animation
+            return []
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        ext, image_format = ("webp", "WEBP") if has_alpha else ("jpg", "JPEG")
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        for variant, longest, quality in IMAGE_VARIANTS:
+            resized = image.copy()
+            resized.thumbnail((longest, longest))
+            name = f"{stem}.{variant}.{ext}"
+            dest = _temp_path(dest_dir, name)
+            resized.save(dest, image_format, quality=quality, optimize=True)
+            derivatives.append(Derivative(variant, name, dest.stat().st_size))
+    return derivatives
+
+
+def _transcode_video(source: Path, dest_dir: Path, stem: str, ffmpeg: str) -> list[Derivative]:
+    derivatives = []
+    for variant, height, crf in VIDEO_VARIANTS:
+        if derivatives and derivatives[-1].size <= SMALL_VIDEO_BYTES:
+            break
+        name = f"{stem}.{variant}.mp4"
+        dest = _temp_path(dest_dir, name)
+        subprocess.run(
+            [
+                ffmpeg, "-nostdin", "-loglevel", "error", "-y", "-i", str(source),
+                # Never upscale; keep the width even for libx264
+                "-vf", f"scale=-2:'min({height},ih)'",
+                "-c:v", "libx264", "-preset", "veryfast", "-crf", str(crf),
+                "-c:a", "aac", "-b:a", "96k", "-movflags", "+faststart",
+                str(dest)
+            ],
+            check=True,
+            timeout=VIDEO_TIMEOUT
+        )
+        derivatives.append(Derivative(variant, name, dest.stat().st_size))
+    return derivatives
+
+
+def make_derivatives(source: str, dest_dir: str) -> list[Derivative]:
+    """Write size-bounded versions of `source` into `dest_dir`, as temp files named `.<file_path>`.
+
+    Runs in a worker process. Only derivatives smaller than the original are
+    kept. Returns nothing for formats there is no encoder for. On failure no
+    temp files are left behind.
+    """
+    source_path, dest_path = Path(source), Path(dest_dir)
+    dest_path.mkdir(parents=True, exist_ok=True)
+    stem, _, ext = source_path.name.partition(".")
+    ext = ext.lower()
+    original_size = source_path.stat().st_size
+    ffmpeg = shutil.which("ffmpeg")
+    try:
+        if ext in IMAGE_EXTENSIONS and Image is not None:
+            derivatives = _resize_image(source_path, dest_path, stem)
+        elif ext in VIDEO_EXTENSIONS and ffmpeg is not None:
+            derivatives = _transcode_video(source_path, dest_path, stem, ffmpeg)
+        else:
+            return []
+    except BaseException:
+        for partial in dest_path.glob(f".{stem}.*"):
+            partial.unlink(missing_ok=True)
+        raise
+    kept = []
+    for derivative in derivatives:
+        if derivative.size < original_size:
+            kept.append(derivative)
+        else:
+            os.unlink(_temp_path(dest_path, derivative.file_path))
+    return kept
+
+
+class DerivativeStore:
+    """Smaller copies of large media, made once in a process pool and picked per guild upload limit.
+
+    Derivatives are blobs named `derived/<sha256>.<variant>.<ext>`, referenced
+    by their derivative row and collected with the original. Originals are
+    never modified, so derivatives can always be regenerated. Files at or
+    below `min_bytes` are posted as they are. Generation only ever runs in
+    the background: until it is done, the original is posted.
+    """
+
+    def __init__(self, blobs: BlobStore, db: Database, pool: MediaPool, min_bytes: int = 1024 * 1024):
+        self.blobs = blobs
+        self.db = db
+        self.pool = pool
+        self.min_bytes = min_bytes
+        # file_path -> candidates (original included), once known
+        self._candidates: dict[str, list[Derivative]] = {}
+        self._pending: dict[str, asyncio.Task] = {}
+
+    async def candidates(self, file_path: str) -> list[Derivative]:
+        """The original and every derivative of it, generating them first if that has not happened yet."""
+        candidates = self._candidates.get(file_path)
+        if candidates is not None:
+            return candidates
+        return await asyncio.shield(self._start(file_path, check_stored=True))
+
+    def _start(self, file_path: str, check_stored: bool) -> asyncio.Task:
+        task = self._pending.get(file_path)
+        if task is None:
+            task = asyncio.create_task(self._load(file_path, check_stored))
+            self._pending[file_path] = task
+            task.add_done_callback(lambda _: self._pending.pop(file_path, None))
+        return task
+
+    async def _stored(self, file_path: str) -> Optional[list[Derivative]]:
+        rows = await self.db.get_derivatives(file_path)
+        if not rows:
+            return None
+        candidates = [Derivative(row["variant"], row["derived_path"], row["size"]) for row in rows]
+        self._candidates[file_path] = candidates
+        return candidates
+
+    async def _load(self, file_path: str, check_stored: bool) -> list[Derivative]:
+        candidates = await self._stored(file_path) if check_stored else None
+        if candidates is None:
+            candidates = await self._generate(file_path)
+            self._candidates[file_path] = candidates
+        return candidates
+
+    async def _generate(self, file_path: str) -> list[Derivative]:
+        original = self.blobs.path(file_path)
+        size = (await asyncio.to_thread(original.stat)).st_size
+        candidates = [Derivative("original", file_path, size)]
+        if size > self.min_bytes:
+            dest_dir = self.blobs.path(f"derived/{file_path}").parent
+            try:
+                derivatives = await self.pool.run(make_derivatives, str(original), str(dest_dir))
+            except Exception:
+                # Still recorded below, so a file the encoders choke on is not retried on every post
+                logger.exception("Could not make derivatives of %s", file_path)
+                derivatives = []
+            for d in derivatives:
+                # Registered as unreferenced blobs until their rows are saved,
+                # so the garbage collector removes them if that never happens
+                await self.blobs.put(str(_temp_path(dest_dir, d.file_path)), f"derived/{d.file_path}")
+                candidates.append(Derivative(d.variant, f"derived/{d.file_path}", d.size))
+            logger.info("Made %d derivatives of %s (%d bytes)", len(derivatives), file_path, size)
+        await self.db.save_derivatives(file_path, [tuple(candidate) for candidate in candidates])
+        return candidates
+
+    def forget(self, file_paths: list[str]):
+        for file_path in file_paths:
+            self._candidates.pop(file_path, None)
+
+    def generate_later(self, file_path: str):
+        """Start making derivatives of a newly stored file in the background."""
+        self._start(file_path, check_stored=True)
+
+    async def choose(self, file_path: str, limit: int) -> Optional[str]:
+        """Path (relative to the image store) of the smallest version of `file_path` that fits in `limit` bytes.
+
+        Never waits for derivatives to be made. If a file has none yet, they
+        are started in the background and the original is returned. None if
+        nothing fits; `generating` tells whether a smaller version may still
+        be on its way.
+        """
+        candidates = self._candidates.get(file_path)
+        if candidates is None and file_path not in self._pending:
+            candidates = await self._stored(file_path)
+        if candidates is None:
+            # No rows, or not read because derivatives are already being made
+            self._start(file_path, check_stored=False)
+            candidates = [Derivative("original", file_path, (await asyncio.to_thread(self.blobs.path(file_path).stat)).st_size)]
+        fitting = [candidate for candidate in candidates if candidate.size <= limit]
+        if not fitting:
+            return None
+        return min(fitting, key=lambda candidate: candidate.size).file_path
+
+    def generating(self, file_path: str) -> bool:
+        return file_path in self._pending
@@ -62,31 +62,441 @@ def get_tags(conn: Connection, server_id: int) -> list[str]:
     # Step 4: Return the list of tags (if any) as a list of tag names
     return [tag[0] for tag in tags]
     
-def add_image(conn: Connection, server_id: int, tags: list[str], filename: str):
+def add_image(conn: Connection, server_id: int, tags: list[str], filename: str) -> tuple[int, list[str]]:
+    """Returns the image id and the tags it did not already have."""
+    # Tags, the image row and its links all go in with one bulk upsert
+    image_ids, added = add_images_bulk(conn, server_id, [(str(filename), list(dict.fromkeys(tags)))])
+    return image_ids[str(filename)], [tag for _, tag in added]
+
+def get_tag_counts(conn: Connection, server_id: int) -> list[Row]:
     cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO image (file_path, server_id)
-        VALUES (?, ?)
-    ''', (str(filename), server_id))
+    res = cursor.execute(
+            """SELECT t.name, COUNT(it.image_id) AS images
+            FROM tag t
+            LEFT JOIN image_tag it ON it.tag_id = t.id
+            WHERE t.server_id = :server_id
+            GROUP BY t.id;""",
+            {
+                "server_id": server_id
+            }
+            )
+    rows = res.fetchall()
+    cursor.close()
+    return rows
+
+def get_tag_images(conn: Connection, server_id: int, tag: str) -> list[Row]:
+    cursor = conn.cursor()
+    res = cursor.execute(
+            """SELECT i.id, i.file_path
+            FROM image i
+            JOIN image_tag it ON i.id = it.image_id
+            JOIN tag t ON it.tag_id = t.id
+            WHERE i.server_id = :server_id
+                AND t.name = :tag
+                AND t.server_id = i.server_id
+            ORDER BY i.id;""",
+            {
+                "server_id": server_id,
+                "tag": tag
+            }
+            )
+    rows = res.fetchall()
+    cursor.close()
+    return rows
 
-    # Get the ID of the newly inserted image
-    image_id = cursor.lastrowid
+def get_guild_image_tags(conn: Connection, server_id: int) -> list[Row]:
+    """(id, file_path, name) for every tag of every image in a server; name is NULL for untagged images."""
+    cursor = conn.cursor()
+    res = cursor.execute(
+            """SELECT i.id, i.file_path, t.name
+            FROM image i
+            LEFT JOIN image_tag it ON i.id = it.image_id
+            LEFT JOIN tag t ON it.tag_id = t.id
+            WHERE i.server_id = :server_id
+            ORDER BY i.id;""",
+            {
+                "server_id": server_id
+            }
+            )
+    rows = res.fetchall()
+    cursor.close()
+    return rows
 
-    # Step 2: Insert each tag into the 'tag' table if it doesn't already exist
-    for tag_name in tags:
-        if not check_tag(conn, server_id, tag_name):
-            add_tag(conn, server_id, tag_name)
+def get_shuffle_bag(conn: Connection, server_id: int, tag: str) -> Optional[Row]:
+    cursor = conn.cursor()
+    res = cursor.execute(
+            """SELECT seed, size, position FROM shuffle_bag
+            WHERE server_id = :server_id AND tag = :tag;""",
+            {
+                "server_id": server_id,
+                "tag": tag
+            }
+            )
+    row = res.fetchone()
+    cursor.close()
+    return row
 
-        # Step 3: Get the tag_id for the inserted tag (whether newly inserted or existing)
-        cursor.execute('''
-            SELECT id FROM tag WHERE name = ? AND server_id = ?
-        ''', (tag_name, server_id))
-        tag_id = cursor.fetchone()[0]
-
-        # Step 4: Create the many-to-many relationship in the 'image_tag' table
-        cursor.execute('''
-            INSERT INTO image_tag (image_id, tag_id)
-            VALUES (?, ?)
-        ''', (image_id, tag_id))
+def save_shuffle_bag(conn: Connection, server_id: int, tag: str, seed: int, size: int, position: int):
+    cursor = conn.cursor()
+    cursor.execute(
+            """INSERT INTO shuffle_bag (server_id, tag, seed, size, position)
+            VALUES (:server_id, :tag, :seed, :size, :position)
+            ON CONFLICT(server_id, tag) DO UPDATE SET
+                seed = excluded.seed,
+                size = excluded.size,
+                position = excluded.position;""",
+            {
+                "server_id": server_id,
+                "tag": tag,
+                "seed": seed,
+                "size": size,
+                "position": position
+            }
+            )
+    conn.commit()
+    cursor.close()
+
+def get_media_url(conn: Connection, server_id: int, file_path: str) -> Optional[Row]:
+    cursor = conn.cursor()
+    res = cursor.execute(
+            """SELECT url, channel_id, message_id, last_used FROM media_url
+            WHERE server_id = :server_id AND file_path = :file_path;""",
+            {
+                "server_id": server_id,
+                "file_path": file_path
+            }
+            )
+    row = res.fetchone()
+    cursor.close()
+    return row
+
+def save_media_url(conn: Connection, server_id: int, file_path: str, url: str, channel_id: int, message_id: int, last_used: int):
+    cursor = conn.cursor()
+    cursor.execute(
+            """INSERT INTO media_url (server_id, file_path, url, channel_id, message_id, last_used)
+            VALUES (:server_id, :file_path, :url, :channel_id, :message_id, :last_used)
+            ON CONFLICT(server_id, file_path) DO UPDATE SET
+                url = excluded.url,
+                channel_id = excluded.channel_id,
+                message_id = excluded.message_id,
+                last_used = excluded.last_used;""",
+            {
+                "server_id": server_id,
+                "file_path": file_path,
+                "url": url,
+                "channel_id": channel_id,
+                "message_id": message_id,
+                "last_used": last_used
+            }
+            )
+    conn.commit()
+    cursor.close()
+
+def delete_media_url(conn: Connection, server_id: int, file_path: str):
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM media_url WHERE server_id = ? AND file_path = ?", (server_id, file_path))
+    conn.commit()
+    cursor.close()
+
+def prune_media_urls(conn: Connection, max_entries: int) -> int:
+    """Drop the least recently used references beyond max_entries."""
+    cursor = conn.cursor()
+    cursor.execute(
+            """DELETE FROM media_url WHERE rowid IN (
+                SELECT rowid FROM media_url
+                ORDER BY last_used DESC
+                LIMIT -1 OFFSET :max_entries
+            );""",
+            {
+                "max_entries": max_entries
+            }
+            )
+    deleted = cursor.rowcount
+    conn.commit()
+    cursor.close()
+    return deleted
+
+def add_images_bulk(conn: Connection, server_id: int, images: list[tuple[str, list[str]]]) -> tuple[dict[str, int], list[tuple[str, str]]]:
+    """Insert many (filename, tags) pairs in a single transaction.
+
+    Returns the id of every image and the (filename, tag) links that were
+    new, leaving out those the image already had.
+    """
+    cursor = conn.cursor()
+    tag_names = sorted({tag for _, tags in images for tag in tags})
+    cursor.executemany(
+            """INSERT OR IGNORE INTO tag (name, server_id) VALUES (?, ?);""",
+            [(tag, server_id) for tag in tag_names]
+            )
+    cursor.executemany(
+            """INSERT INTO image (file_path, server_id)
+            SELECT :file_path, :server_id
+            WHERE NOT EXISTS (
+                SELECT 1 FROM image WHERE server_id = :server_id AND file_path = :file_path
+            );""",
+            [{"file_path": filename, "server_id": server_id} for filename, _ in images]
+            )
+
+    tag_ids = {}
+    image_ids = {}
+    # Stay well below SQLite's bound parameter limit
+    for start in range(0, len(tag_names), 500):
+        chunk = tag_names[start:start + 500]
+        cursor.execute(
+                f"""SELECT id, name FROM tag
+                WHERE server_id = ? AND name IN ({",".join("?" * len(chunk))});""",
+                [server_id, *chunk]
+                )
+        tag_ids.update({row[1]: row[0] for row in cursor.fetchall()})
+    filenames = sorted({filename for filename, _ in images})
+    for start in range(0, len(filenames), 500):
+        chunk = filenames[start:start + 500]
+        cursor.execute(
+                f"""SELECT id, file_path FROM image
+                WHERE server_id = ? AND file_path IN ({",".join("?" * len(chunk))});""",
+                [server_id, *chunk]
+                )
+        image_ids.update({row[1]: row[0] for row in cursor.fetchall()})
+
+    # Links the images already have, so only new ones are reported
+    linked = set()
+    ids = sorted(set(image_ids.values()))
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        cursor.execute(
+                f"""SELECT image_id, tag_id FROM image_tag
+                WHERE image_id IN ({",".join("?" * len(chunk))});""",
+                chunk
+                )
+        linked.update((row[0], row[1]) for row in cursor.fetchall())
+    links = []
+    added = []
+    for filename, tags in images:
+        for tag in tags:
+            link = (image_ids[filename], tag_ids[tag])
+            if link not in linked:
+                linked.add(link)
+                links.append(link)
+                added.append((filename, tag))
+    cursor.executemany(
+            """INSERT OR IGNORE INTO image_tag (image_id, tag_id) VALUES (?, ?);""",
+            links
+            )
     conn.commit()
-    cursor.close()
\ No newline at end of file
+    cursor.close()
+    return image_ids, added
+
+def get_derivatives(conn: Connection, file_path: str) -> list[Row]:
+    cursor = conn.cursor()
+    res = cursor.execute(
+            """SELECT variant, derived_path, size FROM derivative
+            WHERE file_path = :file_path;""",
+            {
+                "file_path": file_path
+            }
+            )
+    rows = res.fetchall()
+    cursor.close()
+    return rows
+
+def save_derivatives(conn: Connection, file_path: str, derivatives: list[tuple[str, str, int]]):
+    """Record (variant, derived_path, size) for every version of a file."""
+    cursor = conn.cursor()
+    cursor.executemany(
+            """INSERT INTO derivative (file_path, variant, derived_path, size)
+            VALUES (:file_path, :variant, :derived_path, :size)
+            ON CONFLICT(file_path, variant) DO UPDATE SET
+                derived_path = excluded.derived_path,
+                size = excluded.size;""",
+            [
+                {
+                    "file_path": file_path,
+                    "variant": variant,
+                    "derived_path": derived_path,
+                    "size": size
+                }
+                for variant, derived_path, size in derivatives
+            ]
+            )
+    conn.commit()
+    cursor.close()
+
+def _signed_hash(phash: int) -> int:
+    # SQLite integers are signed 64-bit
+    return phash - (1 << 64) if phash >= 1 << 63 else phash
+
+def save_image_hashes(conn: Connection, hashes: list[tuple[str, int]]):
+    """Store (file_path, 64-bit perceptual hash) pairs."""
+    cursor = conn.cursor()
+    cursor.executemany(
+            """INSERT INTO image_hash (file_path, phash)
+            VALUES (:file_path, :phash)
+            ON CONFLICT(file_path) DO UPDATE SET phash = excluded.phash;""",
+            [{"file_path": file_path, "phash": _signed_hash(phash)} for file_path, phash in hashes]
+            )
+    conn.commit()
+    cursor.close()
+
+def get_guild_image_hashes(conn: Connection, server_id: int) -> list[tuple[int, str, int]]:
+    """(image id, file_path, perceptual hash) for every hashed image of a server, oldest first."""
+    cursor = conn.cursor()
+    res = cursor.execute(
+            """SELECT i.id, i.file_path, h.phash
+            FROM image i
+            JOIN image_hash h ON h.file_path = i.file_path
+            WHERE i.server_id = :server_id
+            ORDER BY i.id;""",
+            {
+                "server_id": server_id
+            }
+            )
+    rows = [(row[0], row[1], row[2] & 0xFFFFFFFFFFFFFFFF) for row in res.fetchall()]
+    cursor.close()
+    return rows
+
+def get_unhashed_files(conn: Connection) -> list[str]:
+    cursor = conn.cursor()
+    res = cursor.execute(
+            """SELECT DISTINCT i.file_path
+            FROM image i
+            LEFT JOIN image_hash h ON h.file_path = i.file_path
+            WHERE h.file_path IS NULL;"""
+            )
+    files = [row[0] for row in res.fetchall()]
+    cursor.close()
+    return files
+
+def merge_images(conn: Connection, keep_id: int, duplicate_id: int) -> list[str]:
+    """Move every tag of image `duplicate_id` onto `keep_id` and delete the duplicate's row.
+
+    Returns the names of the tags `keep_id` did not already have.
+    """
+    cursor = conn.cursor()
+    params = {"keep_id": keep_id, "duplicate_id": duplicate_id}
+    res = cursor.execute(
+            """SELECT tag.name FROM image_tag JOIN tag ON tag.id = image_tag.tag_id
+            WHERE image_tag.image_id = :duplicate_id
+            AND NOT EXISTS (
+                SELECT 1 FROM image_tag kept WHERE kept.image_id = :keep_id AND kept.tag_id = image_tag.tag_id
+            );""",
+            params
+            )
+    added = [row[0] for row in res.fetchall()]
+    cursor.execute(
+            """INSERT OR IGNORE INTO image_tag (image_id, tag_id)
+            SELECT :keep_id, tag_id FROM image_tag WHERE image_id = :duplicate_id;""",
+            params
+            )
+    cursor.execute("DELETE FROM image_tag WHERE image_id = :duplicate_id;", params)
+    cursor.execute("DELETE FROM image WHERE id = :duplicate_id;", params)
+    conn.commit()
+    cursor.close()
+    return added
+
+def touch_blobs(conn: Connection, names: list[str], now: int):
+    """Register stored blobs. Unreferenced ones (new or not) become due for collection `now` plus the grace period."""
+    cursor = conn.cursor()
+    cursor.executemany(
+            """INSERT INTO blob (name, refs, orphaned_at)
+            VALUES (:name, 0, :now)
+            ON CONFLICT(name) DO UPDATE SET orphaned_at = excluded.orphaned_at
+            WHERE blob.refs = 0;""",
+            [{"name": name, "now": now} for name in names]
+            )
+    conn.commit()
+    cursor.close()
+
+def collect_orphan_blobs(conn: Connection, orphaned_before: int, limit: int) -> list[str]:
+    """Forget up to `limit` blobs unreferenced since before `orphaned_before`, and everything keyed by them.
+
+    Returns their names; the caller deletes the files. Dropping the derivative
+    rows of a collected original leaves its derived blobs unreferenced in turn.
+    """
+    cursor = conn.cursor()
+    res = cursor.execute(
+            """SELECT name FROM blob
+            WHERE refs = 0 AND orphaned_at <= :orphaned_before
+            ORDER BY orphaned_at
+            LIMIT :limit;""",
+            {
+                "orphaned_before": orphaned_before,
+                "limit": limit
+            }
+            )
+    names = [row[0] for row in res.fetchall()]
+    if names:
+        params = [(name,) for name in names]
+        cursor.executemany("DELETE FROM derivative WHERE file_path = ?;", params)
+        cursor.executemany("DELETE FROM media_url WHERE file_path = ?;", params)
+        cursor.executemany("DELETE FROM image_hash WHERE file_path = ?;", params)
+        cursor.executemany("DELETE FROM blob WHERE name = ? AND refs = 0;", params)
+    conn.commit()
+    cursor.close()
+    return names
+
+def get_media_file(conn: Connection, message_id: int) -> Optional[str]:
+    """File posted in (or uploaded with) a message, if its link is still remembered."""
+    cursor = conn.cursor()
+    res = cursor.execute(
+            """SELECT file_path FROM media_url
+            WHERE message_id = :message_id;""",
+            {
+                "message_id": message_id
+            }
+            )
+    row = res.fetchone()
+    cursor.close()
+    return row[0] if row else None
+
+def delete_image(conn: Connection, server_id: int, file_path: str) -> int:
+    """Remove an image and its tags from a server. Returns the number of image rows deleted."""
+    cursor = conn.cursor()
+    params = {"server_id": server_id, "file_path": file_path}
+    cursor.execute(
+            """DELETE FROM image_tag WHERE image_id IN (
+                SELECT id FROM image WHERE server_id = :server_id AND file_path = :file_path
+            );""",
+            params
+            )
+    cursor.execute("DELETE FROM image WHERE server_id = :server_id AND file_path = :file_path;", params)
+    deleted = cursor.rowcount
+    conn.commit()
+    cursor.close()
+    return deleted
+
+def delete_tag(conn: Connection, server_id: int, tag: str) -> Optional[int]:
+    """Remove a tag from a server, and every image that has no tag left without it.
+
+    Returns the number of images deleted, or None if the tag doesn't exist.
+    """
+    cursor = conn.cursor()
+    res = cursor.execute(
+            """SELECT id FROM tag WHERE server_id = :server_id AND name = :tag;""",
+            {
+                "server_id": server_id,
+                "tag": tag
+            }
+            )
+    row = res.fetchone()
+    if row is None:
+        cursor.close()
+        return None
+    params = {"tag_id": row[0], "server_id": server_id, "tag": tag}
+    # Images only this tag was keeping
+    cursor.execute(
+            """DELETE FROM image WHERE id IN (
+                SELECT it.image_id FROM image_tag it
+                WHERE it.tag_id = :tag_id AND NOT EXISTS (
+                    SELECT 1 FROM image_tag other
+                    WHERE other.image_id = it.image_id AND other.tag_id != :tag_id
+                )
+            );""",
+            params
+            )
+    deleted = cursor.rowcount
+    cursor.execute("DELETE FROM image_tag WHERE tag_id = :tag_id;", params)
+    cursor.execute("DELETE FROM tag WHERE id = :tag_id;", params)
+    cursor.execute("DELETE FROM shuffle_bag WHERE server_id = :server_id AND tag = :tag;", params)
+    conn.commit()
+    cursor.close()
+    return deleted
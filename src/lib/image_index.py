@@ -0,0 +1,113 @@
+import logging
+import random
+from pathlib import Path
+from typing import Optional
+
+from .database import Database
+from .lazy_cache import LazyCache
+
+logger = logging.getLogger(__name__)
+
+
+class ShuffleBag:
+    """Draw order for one tag that repeats no image until all have been drawn.
+
+    Only (seed, size, position) is persisted: the first `size` image ids are
+    shuffled with `seed`, and images added since the bag was filled follow in
+    insertion order. That is enough to rebuild the same order after a restart.
+    """
+
+    def __init__(self, ids: list[int], seed: int, size: int, position: int):
+        self.seed = seed
+        self.size = min(size, len(ids))
+        self.position = position
+        self.order = ids[:self.size]
+        random.Random(seed).shuffle(self.order)
+        self.order.extend(ids[self.size:])
+
+    @classmethod
+    def new(cls, ids: list[int], last: Optional[int] = None) -> "ShuffleBag":
+        bag = cls(ids, random.getrandbits(63), len(ids), 0)
+        # Don't let a new cycle start with the image that ended the previous
+        # one. Reseeding rather than swapping keeps the order reproducible.
+        while last is not None and len(ids) > 1 and bag.order[0] == last:
+            bag = cls(ids, random.getrandbits(63), len(ids), 0)
+        return bag
+
+    def draw(self) -> int:
+        image_id = self.order[self.position]
+        self.position += 1
+        return image_id
+
+    def exhausted(self) -> bool:
+        return self.position >= len(self.order)
+
+
+class TagImages:
+    def __init__(self):
+        self.ids: list[int] = []
+        self.paths: dict[int, str] = {}
+        self.bag: Optional[ShuffleBag] = None
+
+    def add(self, image_id: int, file_path: str):
+        if image_id in self.paths:
+            return
+        self.ids.append(image_id)
+        self.paths[image_id] = file_path
+        if self.bag is not None:
+            self.bag.order.append(image_id)
+
+
+class ImageIndex:
+    """In-memory (guild, tag) -> image ids, so postimage can pick in O(1).
+
+    Tags are loaded from the database the first time they are requested and
+    kept current by `image_added`. With `shuffle` on, every tag cycles through
+    all of its images before any repeats, and the position survives restarts.
+    """
+
+    def __init__(self, db: Database, shuffle: bool = False):
+        self.db = db
+        self.shuffle = shuffle
+        # Unknown tags (typos mostly) are not cached
+        self._tags: LazyCache[tuple[int, str], TagImages] = LazyCache(self._load, keep=lambda images: bool(images.ids))
+
+    async def _get(self, guild_id: int, tag: str) -> TagImages:
+        return await self._tags.get((guild_id, tag))
+
+    async def _load(self, key: tuple[int, str]) -> TagImages:
+        guild_id, tag = key
+        images = TagImages()
+        for row in await self.db.get_tag_images(guild_id, tag):
+            images.add(row["id"], row["file_path"])
+        if self.shuffle and images.ids:
+            row = await self.db.get_shuffle_bag(guild_id, tag)
+            if row is not None:
+                images.bag = ShuffleBag(images.ids, row["seed"], row["size"], row["position"])
+        logger.debug("Loaded %d images for tag '%s' in guild %d", len(images.ids), tag, guild_id)
+        return images
+
+    async def random_image(self, guild_id: int, tag: str) -> Optional[Path]:
+        images = await self._get(guild_id, tag)
+        if not images.ids:
+            return None
+        if not self.shuffle:
+            return Path(images.paths[random.choice(images.ids)])
+
+        last = None
+        if images.bag is not None and images.bag.exhausted():
+            last = images.bag.order[-1]
+            images.bag = None
+        if images.bag is None:
+            images.bag = ShuffleBag.new(images.ids, last)
+        bag = images.bag
+        image_id = bag.draw()
+        await self.db.save_shuffle_bag(guild_id, tag, bag.seed, bag.size, bag.position)
+        return Path(images.paths[image_id])
+
+    def image_added(self, guild_id: int, tags: list[str], image_id: int, file_path: str):
+        for tag in tags:
+            self._tags.update((guild_id, tag), lambda images: images.add(image_id, file_path))
+
+    def invalidate(self, guild_id: int, tag: Optional[str] = None):
+        self._tags.invalidate(lambda key: key[0] == guild_id and (tag is None or key[1] == tag))
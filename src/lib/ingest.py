@@ -0,0 +1,102 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+from typing import NamedTuple, Optional
+
+import aiohttp
+import discord
+
+from .blob_store import BlobStore
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+
+
+class IngestResult(NamedTuple):
+    filename: str
+    size: int
+    existed: bool
+
+
+def _write_chunk(file, hasher, chunk: bytes):
+    hasher.update(chunk)
+    file.write(chunk)
+
+
+def _discard(file):
+    file.close()
+    try:
+        os.unlink(file.name)
+    except FileNotFoundError:
+        pass
+
+
+class AttachmentIngester:
+    """Streams attachments into the image store.
+
+    Each download is hashed incrementally while a worker thread writes it to a
+    temp file next to the store, then moved into the blob store as
+    `<sha256>.<ext>` atomically. Content that is already stored is dropped
+    instead of rewritten. At most `concurrency` downloads run at once.
+    """
+
+    def __init__(self, blobs: BlobStore, concurrency: int = 3):
+        self.blobs = blobs
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def ingest(self, attachment: discord.Attachment) -> IngestResult:
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            tmp = await asyncio.to_thread(
+                tempfile.NamedTemporaryFile, dir=self.blobs.root, prefix=".ingest-", delete=False
+            )
+            hasher = hashlib.sha256()
+            size = 0
+            try:
+                async with self._get_session().get(attachment.url) as resp:
+                    resp.raise_for_status()
+                    # Overlap the next network read with the previous chunk's write
+                    pending = None
+                    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                        if pending:
+                            await pending
+                        size += len(chunk)
+                        pending = loop.run_in_executor(None, _write_chunk, tmp, hasher, chunk)
+                    if pending:
+                        await pending
+                await asyncio.to_thread(tmp.close)
+            except BaseException:
+                await asyncio.to_thread(_discard, tmp)
+                raise
+
+            ext = attachment.filename.split('.')[-1]
+            filename = f"{hasher.hexdigest()}.{ext}"
+            existed = await self.blobs.put(tmp.name, filename)
+            if existed:
+                logger.info("%s is already stored as %s", attachment.filename, filename)
+            else:
+                logger.info("Wrote %d bytes to %s", size, filename)
+            return IngestResult(filename, size, existed)
+
+    async def identify(self, url: str, filename: str) -> str:
+        """Blob name the file at `url` is (or would be) stored under, without storing it."""
+        async with self._semaphore:
+            hasher = hashlib.sha256()
+            async with self._get_session().get(url) as resp:
+                resp.raise_for_status()
+                async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                    hasher.update(chunk)
+            return f"{hasher.hexdigest()}.{filename.split('.')[-1]}"
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
@@ -3,154 +3,615 @@ from discord import Member, Guild, User
 import discord.ext
 from discord.ext import commands
 from discord.ext.commands import Context
+from discord import app_commands
 from typing import Optional, Union, Literal
 
 import logging
 from sqlite3 import Row, Connection
 from pathlib import Path
 import tempfile
+import asyncio
 import hashlib
+import io
+import json
+import time
 
+import aiohttp
 
-from .score_helper import *
-from .image_helper import *
+
+from . import metrics
+from .database import Database
+from .startup import StartupTimer
+from .db_stats import format_report
+from .score_aggregator import ScoreAggregator
+from .score_ranks import ScoreRanks
+from .image_index import ImageIndex
+from .maintenance import run_maintenance
+from .tag_index import TagIndex
+from .tag_query import TagBitmapIndex, parse_query
+from .ingest import AttachmentIngester
+from .media_cache import MediaUrlCache
+from .derivatives import DerivativeStore
+from .media_pool import MediaPool
+from .blob_store import BlobStore
+from .backup import BackupStore
+from .scheduler import Overloaded, Scheduler
+from .near_duplicates import HASH_EXTENSIONS, DuplicateIndex, perceptual_hash
+from .leaderboard import LeaderboardCache, render_leaderboard, MAX_ROWS
+from .member_cache import MemberCache
+from .backfill import Backfill, BackfillProgress
+from .score_helper import PERIODS, rollup_bucket
+from .message_authors import MessageAuthorCache
 
 
 logger = logging.getLogger(__name__)
 
+# Per-reaction log lines are rate limited by the logging pipeline
+SAMPLED = {"sampled": True}
+
+# Discord embeds hold at most 25 fields
+TAGS_PER_PAGE = 25
+
 
 
 class Keabot(commands.Bot):
     
-    def __init__(self, *args, db_conn: Connection, root_dir: Path, data_dir: Path, **kwargs):
+    def __init__(self, *args, db: Database, root_dir: Path, data_dir: Path, config: Optional[dict] = None,
+                 startup: Optional[StartupTimer] = None, force_sync: bool = False, primary: bool = True,
+                 maintenance: bool = True, **kwargs):
         super().__init__(*args, **kwargs)
         self.ROOT_DIR = root_dir
         self.DATA_DIR = data_dir
-        self.db_conn = db_conn
+        self.config = config or {}
+        self.startup = startup or StartupTimer()
+        self.force_sync = force_sync
+        # In cluster mode only one worker syncs commands and runs backups, the
+        # rest just serve their shards
+        self.primary = primary
+        # Rollup compaction and blob garbage collection; in cluster mode the
+        # writer process runs them instead
+        self.maintenance = maintenance
+        self.db = db
+        self.scores = ScoreAggregator(
+            db,
+            flush_interval=self.config.get("score_flush_interval", 2.0),
+            max_pending=self.config.get("score_flush_threshold", 500)
+        )
+        self.ranks = ScoreRanks(db, self.scores)
+        self.leaderboards = LeaderboardCache()
+        self.scheduler = Scheduler(self.config.get("scheduler"))
+        self.backfiller = Backfill(
+            db,
+            concurrency=self.config.get("backfill_concurrency", 3),
+            rate=self.config.get("backfill_rate", 5.0)
+        )
+        self._backfills: dict[int, asyncio.Task] = {}
+        self._backfill_progress: dict[int, BackfillProgress] = {}
+        self.message_authors = MessageAuthorCache(
+            self._fetch_message, max_entries=self.config.get("message_author_cache_size", 100000)
+        )
+        self.members = MemberCache(
+            max_entries=self.config.get("member_cache_size", 10000),
+            ttl=self.config.get("member_cache_ttl", 3600)
+        )
+        self.images = ImageIndex(db, shuffle=self.config.get("image_shuffle_bag", False))
+        self.tag_index = TagIndex(db)
+        self.tag_bitmaps = TagBitmapIndex(db)
+        self.duplicates = DuplicateIndex(db, max_distance=self.config.get("duplicate_max_distance", 5))
+        self.media_urls = MediaUrlCache(self, db, max_entries=self.config.get("media_url_cache_size", 5000))
+        self.media_pool = MediaPool(workers=self.config.get("transcode_workers", 2))
+        self.blobs = BlobStore(
+            self.DATA_DIR / "images",
+            db,
+            grace=self.config.get("blob_gc_grace", 3600),
+            batch_size=self.config.get("blob_gc_batch", 100)
+        )
+        self.derivatives = DerivativeStore(
+            self.blobs,
+            db,
+            self.media_pool,
+            min_bytes=self.config.get("derivative_min_bytes", 1024 * 1024)
+        )
+        backup_dir = self.config.get("backup_dir")
+        self.backups = BackupStore(Path(backup_dir)) if backup_dir else None
+        # Only one backup (scheduled or from the command) runs at a time
+        self._backup_lock = asyncio.Lock()
+        self.ingester = AttachmentIngester(self.blobs, concurrency=self.config.get("ingest_concurrency", 3))
+        self.scores.delta_listeners.append(self.ranks.apply)
+        self.scores.flush_listeners.append(self.leaderboards.invalidate)
+        self.blobs.collect_listeners.append(self.media_urls.discard)
+        self.blobs.collect_listeners.append(self.derivatives.forget)
+        self._lag_sampler: Optional[asyncio.Task] = None
+        self._maintainer: Optional[asyncio.Task] = None
+        self._backup_runner: Optional[asyncio.Task] = None
+        self._metrics_server = None
         @self.event
         async def on_ready():
             logger.info('We have logged in as %s', self.user)
             logger.info("ROOT_DIR: %s", self.ROOT_DIR)
             logger.info("DATA_DIR: %s", self.DATA_DIR)   
-            await self.tree.sync() 
+            # on_ready fires again after every reconnect; only the first one counts
+            if not self.startup.reported:
+                self.startup.mark("first READY")
+                self.startup.log_once()
             logger.info("Ready")
+        @self.event
+        async def on_socket_event_type(event_type: str):
+            metrics.GATEWAY_EVENTS.labels(event_type).inc()
+        @self.event
+        async def on_member_update(before: Member, after: Member):
+            self.members.update(after)
+        @self.event
+        async def on_member_remove(member: Member):
+            self.members.forget(member.guild.id, member.id)
+        @self.event
+        async def on_app_command_completion(interaction: discord.Interaction, command):
+            elapsed = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+            metrics.COMMAND_SECONDS.labels(command.qualified_name, "slash").observe(elapsed)
         @self.command(name="leaderboard")
-        async def leaderboard(ctx:Context, number:Optional[int]=5):
+        async def leaderboard(ctx:Context, number:Optional[int]=5, window:Literal["day", "week", "month", "all"]="all"):
             logger.info("leaderboard called")
-            
-            scoreboard = discord.Embed(title="Scoreboard", color=discord.Color.from_rgb(255, 0, 0))
-            i = 0
-            for user in get_top_scores(self.db_conn, ctx.guild.id):
-                i += 1
-                if i == number:
-                    break
-                user: Row
-                members = await ctx.guild.query_members(user_ids=[user["user_id"]], limit=1)
-                if members:
-                    member = members[0]
-                    scoreboard.add_field(name = f"{i}.", value = f"{member.display_name}: {user['score']}")
-                
-            await ctx.reply(embed = scoreboard)
+            number = max(1, min(number or 5, MAX_ROWS))
+            bucket = rollup_bucket(window, time.time()) if window in PERIODS else None
+            key = (number, window, bucket)
+            scoreboard = self.leaderboards.get(ctx.guild.id, key)
+            if scoreboard is None:
+                async def build() -> discord.Embed:
+                    if window == "all":
+                        rows = await self.ranks.top(ctx.guild.id, number)
+                    else:
+                        rows = await self.db.get_top_scores(ctx.guild.id, number, window)
+                    members = await self.members.resolve(ctx.guild, [int(row["user_id"]) for row in rows])
+                    scoreboard = render_leaderboard(rows, members, window)
+                    self.leaderboards.put(ctx.guild.id, key, scoreboard)
+                    return scoreboard
+                # Concurrent requests for the same board share one build
+                scoreboard = await self.scheduler.run("members", ctx.guild.id, build, key=("leaderboard", ctx.guild.id, key))
+            if window == "all":
+                # Per caller, so it goes next to the shared embed rather than in it
+                standing = await self.ranks.standing(ctx.guild.id, ctx.author.id)
+                await ctx.reply(f"You are {standing}", embed = scoreboard)
+            else:
+                await ctx.reply(embed = scoreboard)
             return
         @self.command(name="score")
         async def score(ctx:Context, member:Optional[Member]):
             if not member:
                 member = ctx.author
             
-            score = get_score(self.db_conn, ctx.guild.id, member.id)
-            await ctx.reply(f"Your score is: {score}")
+            score = await self.scores.get_score(ctx.guild.id, member.id)
+            standing = await self.ranks.standing(ctx.guild.id, member.id, score)
+            neighbours = [user for user in (standing.above, standing.below) if user is not None]
+            members = await self.members.resolve(ctx.guild, [user_id for user_id, _ in neighbours])
+            reply = f"Your score is: {score}, {standing}"
+            for label, user in (("Just above", standing.above), ("Just below", standing.below)):
+                if user is not None and user[0] in members:
+                    reply += f"\n{label}: {members[user[0]].display_name} ({user[1]})"
+            await ctx.reply(reply)
         @self.command(name="addimage")
         async def addImage(ctx: Context, *tags, attachments:commands.Greedy[discord.Attachment]):
-            VALID_FILE_EXTENSIONS = ["audio", "image", "video"]
             tags = list(tags)
-            for attachment in attachments:
-                if not attachment.content_type:
-                    await ctx.reply(f"{attachment.filename} does not have a content type. Skipping for safety")
-                file_extension = None
-                for valid_type in VALID_FILE_EXTENSIONS:
-                    if valid_type in attachment.content_type:
-                        file_extension = valid_type
-                        break
-                else:
-                    await ctx.reply(f"{attachment.filename} does not appear to be a supported type ({attachment.content_type}). Skipping")
-                    continue
-                logger.info("Attachment %s is valid type %s", attachment.filename, file_extension)
-                
-                attachment_content = await attachment.read()
-                file_hash = hashlib.sha256(attachment_content).hexdigest()
-                ext = attachment.filename.split('.')[-1]
-                new_filename = f"{file_hash}.{ext}"
-                file_path = self.DATA_DIR / "images" / new_filename
-                if file_path.exists():
-                    logger.warning("File already exists")
-
-                file_path.write_bytes(attachment_content)
-                logger.info("Wrote file to disk: %s", file_path)
-                add_image(self.db_conn, ctx.guild.id, tags, new_filename)
-                await ctx.reply(f"{attachment.filename} added to {", ".join(tags)}")
+            await asyncio.gather(*(self.add_attachment(ctx, tags, attachment) for attachment in attachments))
+
+        @self.tree.command(name="addimage", description="Add an image with one or more space separated tags")
+        async def addImageSlash(interaction: discord.Interaction, tags: str, attachment: discord.Attachment):
+            await interaction.response.defer()
+            ctx = await Context.from_interaction(interaction)
+            await self.add_attachment(ctx, tags.split(), attachment)
+
+        @addImageSlash.autocomplete("tags")
+        async def addImageTagsAutocomplete(interaction: discord.Interaction, current: str):
+            # Complete the last word, keeping the tags already typed
+            typed, _, last = current.rpartition(" ")
+            prefix = f"{typed} " if typed else ""
+            return [
+                app_commands.Choice(name=f"{prefix}{tag}", value=f"{prefix}{tag}")
+                for tag in await self.tag_index.search(interaction.guild_id, last)
+            ]
+
         @self.command(name="tags")
-        async def tags(ctx: Context):
-            tags = get_tags(self.db_conn, ctx.guild.id)
-            if not tags:
+        async def tags(ctx: Context, page: Optional[int]=1):
+            guild_tags = (await self.tag_index.get(ctx.guild.id)).ranked()
+            if not guild_tags:
                 await ctx.reply("There are no tags registered in this server")
                 return
+            pages = (len(guild_tags) + TAGS_PER_PAGE - 1) // TAGS_PER_PAGE
+            page = max(1, min(page, pages))
             tags_embed = discord.Embed(title="Tags", color=discord.Color.from_rgb(255, 0, 0))
-            for tag in tags:
-                tags_embed.add_field(name=tag, value="")
-                i += 1
+            for tag, count in guild_tags[(page - 1) * TAGS_PER_PAGE:page * TAGS_PER_PAGE]:
+                tags_embed.add_field(name=tag, value=f"{count} images")
+            if pages > 1:
+                tags_embed.set_footer(text=f"Page {page}/{pages}. Use {ctx.clean_prefix}tags <page> to see more")
             await ctx.reply(embed=tags_embed)
         @self.command(name="deletetag")
+        @commands.check_any(commands.is_owner(), commands.has_permissions(manage_messages=True))
         async def deleteTag(ctx: Context, tag:str):
-            await ctx.reply("Not implemented yet")
+            deleted = await self.db.delete_tag(ctx.guild.id, tag)
+            if deleted is None:
+                await ctx.reply(f"There is no tag {tag} in this server")
+                return
+            self.images_changed(ctx.guild.id)
+            await ctx.reply(f"Deleted {tag}" + (f" and {deleted} images that had no other tag" if deleted else ""))
         @self.command(name="deleteimage")
-        async def deleteImage(ctx: Context, message:discord.Message):
-            await ctx.reply("Not implemented yet")
-        @self.command(name="postimage")
-        async def postImage(ctx: Context, tag:str):
+        @commands.check_any(commands.is_owner(), commands.has_permissions(manage_messages=True))
+        async def deleteImage(ctx: Context, message:Optional[discord.Message]):
+            # Either a message link/id, or a reply to the message with the image
+            if message is None and ctx.message.reference is not None:
+                message = ctx.message.reference.resolved
+            if not isinstance(message, discord.Message):
+                await ctx.reply("Reply to the image, or give a link to its message")
+                return
+            filename = await self.message_media(message)
+            if filename is None or not await self.db.delete_image(ctx.guild.id, filename):
+                await ctx.reply("That message has no image stored in this server")
+                return
+            self.images_changed(ctx.guild.id)
+            await ctx.reply("Image deleted")
+        @self.hybrid_command(name="postimage", description="Post a random image matching these tags (a b, a|b, -c)")
+        async def postImage(ctx: Context, *, tag:str):
             logger.info("Images requested for tag '%s'", tag)
-            image_filename = get_random_image(self.db_conn, ctx.guild.id, tag)
+            query = parse_query(tag)
+            if len(query.required) == 1 and len(query.required[0]) == 1 and not query.excluded:
+                # Single tags keep the per-tag shuffle bag
+                image_filename = await self.images.random_image(ctx.guild.id, query.required[0][0])
+            else:
+                _, image_filename = await self.tag_bitmaps.query(ctx.guild.id, tag)
             if not image_filename:
                 await ctx.reply("An image could not be found for that tag.")
                 return
-            image_filepath = self.DATA_DIR / "images" / image_filename
-            await ctx.reply(file=discord.File(image_filepath))
+            async with self.scheduler.slot("upload", ctx.guild.id):
+                # Smallest version that fits this server's upload limit
+                upload_filename = await self.derivatives.choose(str(image_filename), ctx.guild.filesize_limit)
+                if upload_filename is None:
+                    if self.derivatives.generating(str(image_filename)):
+                        await ctx.reply("That file is too large for this server. A smaller copy is being made, try again in a few minutes.")
+                    else:
+                        await ctx.reply("That file is too large for this server, even after shrinking it.")
+                    return
+                url = await self.media_urls.lookup(ctx.guild.id, upload_filename)
+                if url:
+                    await ctx.reply(url)
+                    return
+                image_filepath = self.blobs.path(upload_filename)
+                message = await ctx.reply(file=discord.File(image_filepath))
+                metrics.BYTES.labels("upload").inc(image_filepath.stat().st_size)
+                if message.attachments:
+                    await self.media_urls.store(ctx.guild.id, upload_filename, message.attachments[0], message)
             return
 
-        @self.event
-        async def on_reaction_add(reaction: discord.Reaction, user: discord.User):
-            if not reaction.is_custom_emoji() or reaction.emoji.name != "gold":
-                return
-            receiver = reaction.message.author
-            server_id = reaction.message.guild.id
-            gifter = user
-            
-            logger.info("Gold add reaction event. Gifter: %s, Receiver: %s, Server: %d", gifter.display_name, receiver.display_name, server_id)
-            
-            increment_score(self.db_conn, server_id, receiver.id)
+        @postImage.autocomplete("tag")
+        async def postImageTagAutocomplete(interaction: discord.Interaction, current: str):
+            return await self.complete_tag_query(interaction.guild_id, current)
 
-            #check for selfish
-            if gifter == receiver:
-                logger.info("%s gave themself gold", gifter)
-                increment_self(self.db_conn, server_id, gifter.id)
+        @self.hybrid_command(name="countimages", description="Count the images matching these tags (a b, a|b, -c)")
+        async def countImages(ctx: Context, *, tag:str):
+            count, _ = await self.tag_bitmaps.query(ctx.guild.id, tag)
+            await ctx.reply(f"{count} image{'' if count == 1 else 's'} match `{tag}`")
+
+        @countImages.autocomplete("tag")
+        async def countImagesTagAutocomplete(interaction: discord.Interaction, current: str):
+            return await self.complete_tag_query(interaction.guild_id, current)
+
+        @self.command(name="dbstats")
+        @commands.is_owner()
+        async def dbStats(ctx: Context):
+            report = f"{await self.db.summary()}\n\n{format_report(await self.db.query_plans())}"
+            if len(report) < 1900:
+                await ctx.reply(f"```\n{report}\n```")
             else:
-                increment_given(self.db_conn, server_id, gifter.id)
+                await ctx.reply(file=discord.File(io.BytesIO(report.encode()), filename="dbstats.txt"))
 
-        @self.event
-        async def on_reaction_remove(reaction, user):
-            if not reaction.is_custom_emoji() or reaction.emoji.name != "gold":
-                return
-            receiver = reaction.message.author
-            server_id = reaction.message.guild.id
-            gifter = user
-            
-            logger.info("Gold remove reaction event. Gifter: %s, Receiver: %s, Server: %d", gifter.display_name, receiver.display_name, server_id)
-            
-            decrement_score(self.db_conn, server_id, receiver.id)
+        @self.command(name="backup")
+        @commands.is_owner()
+        async def backup(ctx: Context, action: Literal["now", "list", "verify"] = "list"):
+            if self.backups is None:
+                await ctx.reply("Backups are off, set `backup_dir` in the config to turn them on")
+            elif action == "now":
+                if self._backup_lock.locked():
+                    await ctx.reply("A backup is already running")
+                    return
+                await ctx.reply("Backup started")
+                manifest = await self.run_backup()
+                await ctx.reply(f"Backup finished: {manifest}")
+            elif action == "verify":
+                problems = await asyncio.to_thread(self.backups.verify)
+                summary = "\n".join(problems[:20]) if problems else "no problems found"
+                await ctx.reply(f"```\n{summary}\n```"[:2000])
+            else:
+                snapshots = await asyncio.to_thread(self.backups.snapshots)
+                lines = "\n".join(str(manifest) for manifest in snapshots[-10:]) or "No backups yet"
+                await ctx.reply(f"```\n{lines}\n```"[:2000])
+
+        @self.command(name="stats")
+        @commands.check_any(commands.is_owner(), commands.has_permissions(administrator=True))
+        async def stats(ctx: Context):
+            media = ", ".join(f"{key}={value}" for key, value in self.media_urls.stats().items())
+            mode = "lean" if self.config.get("lean_mode", False) else "full"
+            library = sum(len(guild.members) for guild in self.guilds)
+            members = f"Members cached ({mode} mode): {library} by discord.py, {len(self.members)} in LRU"
+            authors = self.message_authors
+            authors = f"Message authors: {len(authors)} cached, {authors.hits} hits, {authors.fetches} fetches"
+            blobs = f"Blobs collected: {self.blobs.collected}"
+            scheduler = "Scheduler: " + ", ".join(
+                f"{name} {stats['running']} running/{stats['waiting']} waiting/{stats['rejected']} rejected"
+                for name, stats in self.scheduler.stats().items()
+            )
+            await ctx.reply(f"```\n{metrics.summary()}\nMedia link cache: {media}\n{members}\n{authors}\n{blobs}\n{scheduler}\n```"[:2000])
 
-            #check for selfish
-            if gifter == receiver:
-                logger.info("%s took gold from themself", gifter)
-                decrement_self(self.db_conn, server_id, gifter.id)
+        @self.command(name="backfill")
+        @commands.check_any(commands.is_owner(), commands.has_permissions(administrator=True))
+        async def backfill(ctx: Context, action: Literal["start", "stop", "status"] = "start"):
+            task = self._backfills.get(ctx.guild.id)
+            running = task is not None and not task.done()
+            if action == "status":
+                progress = self._backfill_progress.get(ctx.guild.id)
+                state = "running" if running else "not running"
+                await ctx.reply(f"Backfill {state}" + (f": {progress}" if progress else ""))
+            elif action == "stop":
+                if running:
+                    task.cancel()
+                await ctx.reply("Backfill stopped, it will resume from where it got to" if running else "No backfill running")
+            elif running:
+                await ctx.reply("Backfill already running")
             else:
-                decrement_given(self.db_conn, server_id, gifter.id) 
+                progress = self._backfill_progress[ctx.guild.id] = BackfillProgress()
+                self._backfills[ctx.guild.id] = asyncio.create_task(self._run_backfill(ctx, progress))
+                await ctx.reply("Backfill started")
+
+        @self.event
+        @metrics.timed(metrics.EVENT_SECONDS.labels("reaction_add"))
+        async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
+            await self.track_gold(payload, added=True)
+
+        @self.event
+        @metrics.timed(metrics.EVENT_SECONDS.labels("reaction_remove"))
+        async def on_raw_reaction_remove(payload: discord.RawReactionActionEvent):
+            await self.track_gold(payload, added=False)
+
+        # A listener rather than an event so Bot.on_message still processes commands
+        async def remember_author(message: discord.Message):
+            if message.guild is not None:
+                self.message_authors.remember(message.id, message.author.id, message.guild.id)
+        self.add_listener(remember_author, "on_message")
+
+    async def track_gold(self, payload: discord.RawReactionActionEvent, added: bool):
+        """Record a gold reaction being added or removed, whether or not the message is cached."""
+        if not payload.emoji.is_custom_emoji() or payload.emoji.name != "gold" or payload.guild_id is None:
+            return
+        author = await self.message_authors.get(payload.channel_id, payload.guild_id, payload.message_id)
+        if author is None:
+            return
+        receiver_id, server_id = author[0], payload.guild_id
+        gifter_id = payload.user_id
+
+        logger.info("Gold %s. Gifter: %d, Receiver: %d, Server: %d", "added" if added else "removed", gifter_id, receiver_id, server_id, extra=SAMPLED)
+
+        # The ledger makes repeated adds/removes of the same reaction no-ops,
+        # and credits gifter and receiver (or self) when the flush applies it
+        self.scores.add(payload.message_id, gifter_id, str(payload.emoji.id), server_id, payload.channel_id, receiver_id, added)
+
+    async def _run_backfill(self, ctx: Context, progress: BackfillProgress):
+        # Reactions still buffered would otherwise land after the counters are rebuilt
+        await self.scores.flush()
+        progress = await self.backfiller.run(ctx.guild, progress)
+        self.ranks.invalidate(ctx.guild.id)
+        self.leaderboards.invalidate({ctx.guild.id})
+        if progress.failed:
+            await ctx.send(f"Backfill finished with errors, scores were not rebuilt: {progress}")
+        else:
+            await ctx.send(f"Backfill finished, scores rebuilt: {progress}")
+
+    async def run_backup(self):
+        """Snapshot the database and image store, then drop snapshots past `backup_keep`."""
+        async with self._backup_lock:
+            # Buffered reactions go in this snapshot rather than the next
+            await self.scores.flush()
+            manifest = await asyncio.to_thread(
+                self.backups.create,
+                self.db.db_path,
+                self.blobs.root,
+                self.config.get("backup_pages_per_step", 256),
+                self.config.get("backup_step_pause", 0.01)
+            )
+            await asyncio.to_thread(self.backups.prune, self.config.get("backup_keep", 7))
+        return manifest
+
+    async def _backup_periodically(self):
+        interval = self.config.get("backup_interval", 24 * 3600)
+        while True:
+            # Counted from the last snapshot, so restarts don't delay or repeat backups
+            snapshots = await asyncio.to_thread(self.backups.snapshots)
+            due = snapshots[-1].created + interval if snapshots else 0
+            await asyncio.sleep(max(0, due - time.time()))
+            try:
+                await self.run_backup()
+            except Exception:
+                logger.exception("Backup failed")
+                await asyncio.sleep(min(interval, 3600))
+
+    async def message_media(self, message: discord.Message) -> Optional[str]:
+        """Blob name of the image a message posted or uploaded."""
+        filename = await self.db.get_media_file(message.id)
+        if filename is not None:
+            return filename
+        # Not remembered: hash what the message carries, an attachment or a linked CDN file
+        if message.attachments:
+            url, name = message.attachments[0].url, message.attachments[0].filename
+        elif message.content.startswith(("https://cdn.discordapp.com/", "https://media.discordapp.net/")):
+            url = message.content.split()[0]
+            name = url.split("?")[0].rsplit("/", 1)[-1]
+        else:
+            return None
+        try:
+            return await self.ingester.identify(url, name)
+        except aiohttp.ClientError:
+            logger.exception("Could not download %s", url)
+            return None
+
+    def images_changed(self, guild_id: int):
+        """Drop a guild's in-memory image indexes after images or tags were deleted."""
+        self.images.invalidate(guild_id)
+        self.tag_bitmaps.invalidate(guild_id)
+        self.tag_index.invalidate(guild_id)
+        self.duplicates.invalidate(guild_id)
+
+    async def _fetch_message(self, channel_id: int, guild_id: Optional[int], message_id: int) -> discord.Message:
+        return await self.get_partial_messageable(channel_id, guild_id=guild_id).fetch_message(message_id)
+
+    async def add_attachment(self, ctx: Context, tags: list[str], attachment: discord.Attachment):
+        try:
+            await self.scheduler.run("ingest", ctx.guild.id, lambda: self._add_attachment(ctx, tags, attachment))
+        except Overloaded as e:
+            await ctx.reply(f"{attachment.filename} was not added. {e}")
+
+    async def _add_attachment(self, ctx: Context, tags: list[str], attachment: discord.Attachment):
+        VALID_FILE_EXTENSIONS = ["audio", "image", "video"]
+        if not attachment.content_type:
+            await ctx.reply(f"{attachment.filename} does not have a content type. Skipping for safety")
+            return
+        file_extension = None
+        for valid_type in VALID_FILE_EXTENSIONS:
+            if valid_type in attachment.content_type:
+                file_extension = valid_type
+                break
+        else:
+            await ctx.reply(f"{attachment.filename} does not appear to be a supported type ({attachment.content_type}). Skipping")
+            return
+        logger.info("Attachment %s is valid type %s", attachment.filename, file_extension)
+
+        try:
+            result = await self.ingester.ingest(attachment)
+        except aiohttp.ClientError:
+            logger.exception("Failed to download %s", attachment.filename)
+            await ctx.reply(f"{attachment.filename} could not be downloaded")
+            return
+        metrics.BYTES.labels("download").inc(result.size)
+        phash = None
+        if result.filename.rsplit(".", 1)[-1].lower() in HASH_EXTENSIONS:
+            try:
+                phash = await self.media_pool.run(perceptual_hash, str(self.blobs.path(result.filename)))
+            except Exception:
+                logger.exception("Could not hash %s", result.filename)
+        duplicate = None
+        if phash is not None:
+            duplicate = await self.duplicates.find(ctx.guild.id, phash, exclude=result.filename)
+        if duplicate is not None:
+            # Re-saved or recompressed copy of an image this server already has:
+            # tag that one instead. Nothing references the copy, so the blob
+            # garbage collector removes it.
+            _, filename = duplicate
+            logger.info("%s is a near duplicate of %s", attachment.filename, filename)
+        else:
+            filename = result.filename
+            if phash is not None:
+                await self.db.save_image_hashes([(filename, phash)])
+            if not result.existed:
+                self.derivatives.generate_later(filename)
+        image_id, added_tags = await self.db.add_image(ctx.guild.id, tags, filename)
+        self.images.image_added(ctx.guild.id, tags, image_id, filename)
+        self.tag_bitmaps.image_added(ctx.guild.id, tags, image_id, filename)
+        if phash is not None and duplicate is None:
+            self.duplicates.image_added(ctx.guild.id, phash, image_id, filename)
+        # Re-adds and duplicate merges only count tags the image didn't have
+        self.tag_index.tags_added(ctx.guild.id, added_tags)
+        if duplicate is not None:
+            await ctx.reply(f"{attachment.filename} looks like an image that is already stored, added {', '.join(tags)} to it")
+            return
+        # Slash command attachments don't belong to a message we can refetch later
+        if ctx.interaction is None:
+            await self.media_urls.store(ctx.guild.id, result.filename, attachment, ctx.message)
+        await ctx.reply(f"{attachment.filename} added to {', '.join(tags)}")
+
+    async def complete_tag_query(self, guild_id: int, current: str) -> list[app_commands.Choice[str]]:
+        # Complete only the tag being typed, keeping the rest of the query as is
+        split = max(current.rfind(" "), current.rfind("|")) + 1
+        if current.startswith("-", split):
+            split += 1
+        head, partial = current[:split], current[split:]
+        return [
+            app_commands.Choice(name=head + tag, value=head + tag)
+            for tag in await self.tag_index.search(guild_id, partial)
+            if len(head + tag) <= 100
+        ]
+
+    async def on_command_error(self, ctx: Context, error: commands.CommandError):
+        if isinstance(error, Overloaded):
+            await ctx.reply(str(error))
+            return
+        await super().on_command_error(ctx, error)
+
+    async def invoke(self, ctx: Context):
+        if ctx.command is None:
+            return await super().invoke(ctx)
+        with metrics.COMMAND_SECONDS.labels(ctx.command.qualified_name, "prefix").time():
+            await super().invoke(ctx)
+
+    def command_tree_hash(self) -> str:
+        commands = sorted((command.to_dict() for command in self.tree.get_commands()), key=lambda c: c["name"])
+        payload = json.dumps({"application_id": self.application_id, "commands": commands}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    async def sync_commands(self):
+        """Sync the command tree with Discord, but only when it changed since the last sync."""
+        if self.application_id is None:
+            # Not logged in, e.g. the offline benchmarks
+            return
+        hash_file = self.DATA_DIR / "command_tree.sha256"
+        tree_hash = self.command_tree_hash()
+        try:
+            synced_hash = await asyncio.to_thread(hash_file.read_text)
+        except FileNotFoundError:
+            synced_hash = None
+        if not self.force_sync and synced_hash == tree_hash:
+            logger.info("Command tree unchanged, skipping sync")
+            return
+        await self.tree.sync()
+        await asyncio.to_thread(hash_file.write_text, tree_hash)
+        logger.info("Synced command tree %s", tree_hash[:12])
+
+    async def setup_hook(self):
+        # Called from login() once the token has been checked and the application info fetched
+        self.startup.mark("login")
+        self.scores.start()
+        if self.primary:
+            await self.sync_commands()
+        self.startup.mark("command sync")
+        self._lag_sampler = asyncio.create_task(metrics.sample_loop_lag())
+        if self.maintenance:
+            self._maintainer = asyncio.create_task(run_maintenance(self.db, self.blobs, self.config))
+        if self.primary and self.backups is not None:
+            self._backup_runner = asyncio.create_task(self._backup_periodically())
+        metrics.GATEWAY_LATENCY.labels().set_function(lambda: self.latency)
+        metrics.MEMBER_CACHE.labels("lru").set_function(lambda: len(self.members))
+        metrics.MEMBER_CACHE.labels("library").set_function(lambda: sum(len(guild.members) for guild in self.guilds))
+        for stat in ("hits", "misses", "refreshes", "expired", "entries"):
+            metrics.MEDIA_CACHE.labels(stat).set_function(lambda stat=stat: self.media_urls.stats()[stat])
+        if self.config.get("metrics_port"):
+            self._metrics_server = await metrics.start_http_server(
+                self.config.get("metrics_host", "127.0.0.1"), self.config["metrics_port"]
+            )
+
+    async def close(self):
+        await super().close()
+        for task in self._backfills.values():
+            task.cancel()
+        if self._lag_sampler is not None:
+            self._lag_sampler.cancel()
+        if self._maintainer is not None:
+            self._maintainer.cancel()
+        if self._backup_runner is not None:
+            self._backup_runner.cancel()
+        if self._metrics_server is not None:
+            await self._metrics_server.cleanup()
+        await self.scores.close()
+        await self.ingester.close()
+        await self.media_urls.close()
+        self.media_pool.close()
+        await self.db.close()
+
+
+class ShardedKeabot(Keabot, commands.AutoShardedBot):
+    """Keabot over several shards in one process, for the workers of cluster mode.
 
+    Pass `shard_ids` and `shard_count` to run a subset of the bot's shards.
+    """
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Generic, Hashable, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LazyCache(Generic[K, V]):
+    """Values loaded from the database on first use and then kept current in memory.
+
+    Concurrent requests for a key that isn't loaded yet share one load. A
+    write reported through `update` while its key is loading may or may not
+    have been seen by the load's read, so that load is redone once it ends
+    rather than risk dropping the write or applying it twice.
+    """
+
+    def __init__(self, load: Callable[[K], Awaitable[V]], keep: Optional[Callable[[V], bool]] = None):
+        self._load = load
+        # Loaded values failing `keep` are returned but not cached
+        self._keep = keep
+        self._values: dict[K, V] = {}
+        self._loading: dict[K, asyncio.Task] = {}
+        self._stale: set[K] = set()
+
+    def cached(self, key: K) -> Optional[V]:
+        return self._values.get(key)
+
+    async def get(self, key: K) -> V:
+        value = self._values.get(key)
+        if value is not None:
+            return value
+        task = self._loading.get(key)
+        if task is None:
+            task = asyncio.create_task(self._run(key))
+            self._loading[key] = task
+            task.add_done_callback(lambda done: self._loading.pop(key) if self._loading.get(key) is done else None)
+        return await asyncio.shield(task)
+
+    async def _run(self, key: K) -> V:
+        while True:
+            self._stale.discard(key)
+            value = await self._load(key)
+            if key not in self._stale:
+                break
+            logger.debug("%r changed while it was loading, loading it again", key)
+        # Stored without awaiting after the load, so no update falls in between
+        if self._keep is None or self._keep(value):
+            self._values[key] = value
+        return value
+
+    def update(self, key: K, change: Callable[[V], None]):
+        """Apply `change` to the cached value, or have a load in progress start over."""
+        value = self._values.get(key)
+        if value is not None:
+            change(value)
+        elif key in self._loading:
+            self._stale.add(key)
+
+    def invalidate(self, match: Callable[[K], bool]):
+        """Drop every value whose key `match`es, including ones being loaded."""
+        for key in [key for key in self._values if match(key)]:
+            del self._values[key]
+        self._stale.update(key for key in self._loading if match(key))
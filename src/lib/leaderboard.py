@@ -0,0 +1,44 @@
+import logging
+from sqlite3 import Row
+
+import discord
+from discord import Member
+
+logger = logging.getLogger(__name__)
+
+# Embeds are limited to 25 fields
+MAX_ROWS = 25
+
+
+WINDOW_TITLES = {"day": "today", "week": "this week", "month": "this month"}
+
+
+def render_leaderboard(rows: list[Row], members: dict[int, Member], window: str = "all") -> discord.Embed:
+    title = f"Scoreboard ({WINDOW_TITLES[window]})" if window in WINDOW_TITLES else "Scoreboard"
+    scoreboard = discord.Embed(title=title, color=discord.Color.from_rgb(255, 0, 0))
+    for i, row in enumerate(rows, start=1):
+        member = members.get(int(row["user_id"]))
+        if member:
+            scoreboard.add_field(name=f"{i}.", value=f"{member.display_name}: {row['score']}")
+    return scoreboard
+
+
+class LeaderboardCache:
+    """Rendered leaderboard embeds per guild, dropped whenever its scores change.
+
+    Keys are (number, window, bucket), so a windowed embed also expires when
+    a new day, week or month starts.
+    """
+
+    def __init__(self):
+        self._embeds: dict[int, dict[tuple, discord.Embed]] = {}
+
+    def get(self, guild_id: int, key: tuple) -> discord.Embed | None:
+        return self._embeds.get(guild_id, {}).get(key)
+
+    def put(self, guild_id: int, key: tuple, embed: discord.Embed):
+        self._embeds.setdefault(guild_id, {})[key] = embed
+
+    def invalidate(self, guild_ids: set[int]):
+        for guild_id in guild_ids:
+            self._embeds.pop(guild_id, None)
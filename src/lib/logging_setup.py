@@ -0,0 +1,147 @@
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler.prepare formats the message on the calling thread. Everything
+    # stays in this process, so hand the record over as is and let the listener
+    # thread do the formatting.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """Rate limits records logged with extra={"sampled": True}.
+
+    Each call site (logger + message template) may emit `rate` records per
+    second. The next record that gets through says how many were dropped.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+        self._windows: dict[tuple[str, str], list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sampled", False) or self.rate <= 0:
+            return True
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.setdefault(key, [now, 0, 0])  # start, emitted, dropped
+            if now - window[0] >= 1.0:
+                window[0], window[1] = now, 0
+            if window[1] >= self.rate:
+                window[2] += 1
+                return False
+            window[1] += 1
+            dropped, window[2] = window[2], 0
+        if dropped:
+            record.msg = f"{record.msg} [{dropped} similar messages suppressed]"
+        return True
+
+
+_configured_loggers: set[str] = set()
+
+def apply_levels(config: dict):
+    logging.getLogger().setLevel(config.get("log_level", "DEBUG"))
+    levels = config.get("log_levels", {})
+    # Loggers dropped from the config go back to inheriting the root level
+    for name in _configured_loggers - set(levels):
+        logging.getLogger(name).setLevel(logging.NOTSET)
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+    _configured_loggers.clear()
+    _configured_loggers.update(levels)
+
+
+class LogConfigWatcher(threading.Thread):
+    """Re-applies log levels whenever config.json changes on disk."""
+
+    def __init__(self, config_path: Path, interval: float = 5.0):
+        super().__init__(name="keabot-log-config", daemon=True)
+        self.config_path = config_path
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._mtime = self._current_mtime()
+
+    def _current_mtime(self) -> Optional[float]:
+        try:
+            return self.config_path.stat().st_mtime
+        except OSError:
+            return None
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            mtime = self._current_mtime()
+            if mtime == self._mtime:
+                continue
+            self._mtime = mtime
+            try:
+                apply_levels(json.loads(self.config_path.read_text()))
+            except (OSError, ValueError):
+                logging.getLogger(__name__).exception("Could not reload log levels from %s", self.config_path)
+                continue
+            logging.getLogger(__name__).info("Reloaded log levels from %s", self.config_path)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+class LoggingPipeline:
+    """Root logger -> queue -> background thread that formats and writes the rotating log file."""
+
+    def __init__(self, log_file: Path, config: dict, config_path: Optional[Path] = None):
+        file_handler = logging.handlers.RotatingFileHandler(
+            filename=log_file,
+            maxBytes=config.get("log_max_bytes", 1000*1000*50),
+            backupCount=config.get("log_backup_count", 7)
+        )
+        if config.get("log_json", False):
+            file_handler.setFormatter(JsonFormatter())
+        else:
+            file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        queue_handler = _DeferredQueueHandler(self._queue)
+        queue_handler.addFilter(SamplingFilter(config.get("log_sample_rate", 5)))
+        self.listener = logging.handlers.QueueListener(self._queue, file_handler, respect_handler_level=True)
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+        apply_levels(config)
+
+        self.watcher = LogConfigWatcher(config_path) if config_path else None
+
+    def start(self):
+        self.listener.start()
+        if self.watcher:
+            self.watcher.start()
+
+    def stop(self):
+        if self.watcher:
+            self.watcher.stop()
+        # Drains whatever is still queued before returning
+        self.listener.stop()
@@ -0,0 +1,32 @@
+import asyncio
+import logging
+
+from .blob_store import BlobStore
+from .database import Database
+
+logger = logging.getLogger(__name__)
+
+
+async def compact_rollups_periodically(db: Database, config: dict):
+    # Buckets older than this many days/weeks/months are deleted
+    keep = config.get("rollup_retention", {"day": 14, "week": 8, "month": 12})
+    while True:
+        try:
+            await db.compact_rollups(keep)
+        except Exception:
+            logger.exception("Score rollup compaction failed")
+        await asyncio.sleep(config.get("rollup_compact_interval", 6 * 3600))
+
+
+async def collect_garbage_periodically(blobs: BlobStore, config: dict):
+    while True:
+        try:
+            await blobs.collect_garbage()
+        except Exception:
+            logger.exception("Blob garbage collection failed")
+        await asyncio.sleep(config.get("blob_gc_interval", 600))
+
+
+async def run_maintenance(db: Database, blobs: BlobStore, config: dict):
+    """Rollup compaction and blob garbage collection, until cancelled."""
+    await asyncio.gather(compact_rollups_periodically(db, config), collect_garbage_periodically(blobs, config))
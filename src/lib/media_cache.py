@@ -0,0 +1,171 @@
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+import aiohttp
+import discord
+
+from .database import Database
+
+logger = logging.getLogger(__name__)
+
+# Refresh links this close to their signed expiry
+EXPIRY_MARGIN = 60 * 60
+# Re-check that a link still resolves at most this often
+VALIDATE_INTERVAL = 60 * 60
+
+
+def url_expiry(url: str) -> Optional[int]:
+    """Unix time a signed Discord CDN URL stops working, if it is signed."""
+    ex = parse_qs(urlparse(url).query).get("ex")
+    if not ex:
+        return None
+    try:
+        return int(ex[0], 16)
+    except ValueError:
+        return None
+
+
+def url_attachment_id(url: str) -> Optional[int]:
+    # https://cdn.discordapp.com/attachments/<channel_id>/<attachment_id>/<filename>
+    parts = urlparse(url).path.split("/")
+    try:
+        return int(parts[-2])
+    except (IndexError, ValueError):
+        return None
+
+
+@dataclass
+class MediaRef:
+    url: str
+    channel_id: int
+    message_id: int
+    validated_at: float = 0
+
+
+class MediaUrlCache:
+    """Remembers where each stored file already lives on Discord's CDN, per server.
+
+    A link is only reused in the server it was posted in. postimage links the remembered attachment instead of uploading the file
+    again. Links are checked before reuse: signed URLs close to expiry are
+    re-signed by fetching the message they belong to, and anything that no
+    longer resolves is forgotten so the caller falls back to an upload.
+    The most recently used `max_entries` references are kept.
+    """
+
+    def __init__(self, bot: discord.Client, db: Database, max_entries: int = 5000):
+        self.bot = bot
+        self.db = db
+        self.max_entries = max_entries
+        # (server_id, file_path) -> where that server last saw the file
+        self._entries: OrderedDict[tuple[int, str], MediaRef] = OrderedDict()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._saves = 0
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.expired = 0
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def lookup(self, server_id: int, file_path: str) -> Optional[str]:
+        key = (server_id, file_path)
+        entry = self._entries.get(key)
+        if entry is None:
+            row = await self.db.get_media_url(server_id, file_path)
+            if row:
+                entry = MediaRef(row["url"], row["channel_id"], row["message_id"])
+                self._remember(key, entry)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        if not await self._validate(key, entry):
+            logger.info("Cached link for %s in guild %d no longer works", file_path, server_id)
+            self.expired += 1
+            self.misses += 1
+            await self.forget(server_id, file_path)
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry.url
+
+    async def _validate(self, key: tuple[int, str], entry: MediaRef) -> bool:
+        now = time.time()
+        expiry = url_expiry(entry.url)
+        if expiry is not None and expiry - now < EXPIRY_MARGIN:
+            return await self._refresh(key, entry)
+        if now - entry.validated_at < VALIDATE_INTERVAL:
+            return True
+        try:
+            async with self._get_session().head(entry.url) as resp:
+                if resp.status == 200:
+                    entry.validated_at = now
+                    return True
+        except aiohttp.ClientError:
+            logger.warning("Could not check %s", entry.url, exc_info=True)
+        return await self._refresh(key, entry)
+
+    async def _refresh(self, key: tuple[int, str], entry: MediaRef) -> bool:
+        """Get a freshly signed URL from the message the attachment was posted in."""
+        attachment_id = url_attachment_id(entry.url)
+        try:
+            channel = self.bot.get_channel(entry.channel_id) or await self.bot.fetch_channel(entry.channel_id)
+            message = await channel.fetch_message(entry.message_id)
+        except discord.HTTPException:
+            return False
+        for attachment in message.attachments:
+            if attachment.id == attachment_id:
+                break
+        else:
+            return False
+        self.refreshes += 1
+        entry.url = attachment.url
+        entry.validated_at = time.time()
+        await self.db.save_media_url(*key, entry.url, entry.channel_id, entry.message_id, int(entry.validated_at))
+        return True
+
+    def _remember(self, key: tuple[int, str], entry: MediaRef):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def store(self, server_id: int, file_path: str, attachment: discord.Attachment, message: discord.Message):
+        entry = MediaRef(attachment.url, message.channel.id, message.id, time.time())
+        self._remember((server_id, file_path), entry)
+        await self.db.save_media_url(server_id, file_path, entry.url, entry.channel_id, entry.message_id, int(entry.validated_at))
+        self._saves += 1
+        if self._saves % 100 == 0:
+            pruned = await self.db.prune_media_urls(self.max_entries)
+            if pruned:
+                logger.info("Evicted %d cached media links", pruned)
+
+    async def forget(self, server_id: int, file_path: str):
+        self._entries.pop((server_id, file_path), None)
+        await self.db.delete_media_url(server_id, file_path)
+
+    def discard(self, file_paths: list[str]):
+        """Drop in-memory references, in every server, whose rows are already gone from the database."""
+        gone = set(file_paths)
+        for key in [key for key in self._entries if key[1] in gone]:
+            del self._entries[key]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "expired": self.expired,
+        }
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
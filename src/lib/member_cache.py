@@ -0,0 +1,67 @@
+import logging
+import time
+from collections import OrderedDict
+
+from discord import Guild, Member
+
+logger = logging.getLogger(__name__)
+
+
+class MemberCache:
+    """Bounded LRU of members fetched on demand, each kept for at most `ttl` seconds.
+
+    In lean mode discord.py keeps no member cache of its own, so this is
+    what stops every leaderboard from querying the gateway for all its rows.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._members: OrderedDict[tuple[int, int], tuple[Member, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    def get(self, guild_id: int, user_id: int) -> Member | None:
+        key = (guild_id, user_id)
+        entry = self._members.get(key)
+        if entry is None:
+            return None
+        member, expires = entry
+        if expires < time.monotonic():
+            del self._members[key]
+            return None
+        self._members.move_to_end(key)
+        return member
+
+    def put(self, member: Member):
+        key = (member.guild.id, member.id)
+        self._members[key] = (member, time.monotonic() + self.ttl)
+        self._members.move_to_end(key)
+        while len(self._members) > self.max_entries:
+            self._members.popitem(last=False)
+
+    def update(self, member: Member):
+        """Refresh an entry from a gateway event, without adding members nobody asked for."""
+        if (member.guild.id, member.id) in self._members:
+            self.put(member)
+
+    def forget(self, guild_id: int, user_id: int):
+        self._members.pop((guild_id, user_id), None)
+
+    async def resolve(self, guild: Guild, user_ids: list[int]) -> dict[int, Member]:
+        """Look members up in discord.py's cache, then this one, then fetch all misses in one request."""
+        members = {}
+        misses = []
+        for user_id in user_ids:
+            member = guild.get_member(user_id) or self.get(guild.id, user_id)
+            if member:
+                members[user_id] = member
+            else:
+                misses.append(user_id)
+        if misses:
+            logger.debug("Fetching %d uncached members for guild %d", len(misses), guild.id)
+            for member in await guild.query_members(user_ids=misses, limit=len(misses), cache=False):
+                members[member.id] = member
+                self.put(member)
+        return members
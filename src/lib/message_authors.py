@@ -0,0 +1,66 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+import discord
+
+logger = logging.getLogger(__name__)
+
+# (channel_id, guild_id, message_id) -> message
+MessageFetcher = Callable[[int, Optional[int], int], Awaitable[discord.Message]]
+
+
+class MessageAuthorCache:
+    """Message id -> (author id, guild id) for messages the bot may see reactions on.
+
+    Raw reaction events only carry ids. Messages posted while the bot is
+    running are remembered from on_message; anything older is fetched once,
+    with concurrent lookups for the same message sharing one request.
+    Two ints per message instead of discord.py's full Message objects.
+    """
+
+    def __init__(self, fetch_message: MessageFetcher, max_entries: int = 100000):
+        self.fetch_message = fetch_message
+        self.max_entries = max_entries
+        self._authors: OrderedDict[int, tuple[int, Optional[int]]] = OrderedDict()
+        self._pending: dict[int, asyncio.Future] = {}
+        self.hits = 0
+        self.fetches = 0
+
+    def __len__(self) -> int:
+        return len(self._authors)
+
+    def remember(self, message_id: int, author_id: int, guild_id: Optional[int]):
+        self._authors[message_id] = (author_id, guild_id)
+        self._authors.move_to_end(message_id)
+        while len(self._authors) > self.max_entries:
+            self._authors.popitem(last=False)
+
+    def forget(self, message_id: int):
+        self._authors.pop(message_id, None)
+
+    async def get(self, channel_id: int, guild_id: Optional[int], message_id: int) -> Optional[tuple[int, Optional[int]]]:
+        """(author id, guild id) of a message, or None if it can no longer be fetched."""
+        entry = self._authors.get(message_id)
+        if entry is not None:
+            self._authors.move_to_end(message_id)
+            self.hits += 1
+            return entry
+        pending = self._pending.get(message_id)
+        if pending is None:
+            pending = asyncio.ensure_future(self._fetch(channel_id, guild_id, message_id))
+            self._pending[message_id] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(message_id, None))
+        # Shielded so one cancelled waiter does not cancel the fetch for the rest
+        return await asyncio.shield(pending)
+
+    async def _fetch(self, channel_id: int, guild_id: Optional[int], message_id: int) -> Optional[tuple[int, Optional[int]]]:
+        self.fetches += 1
+        try:
+            message = await self.fetch_message(channel_id, guild_id, message_id)
+        except (discord.NotFound, discord.Forbidden):
+            logger.debug("Message %d in channel %d could not be fetched", message_id, channel_id)
+            return None
+        self.remember(message_id, message.author.id, guild_id)
+        return message.author.id, guild_id
@@ -0,0 +1,270 @@
+import asyncio
+import bisect
+import functools
+import logging
+import math
+import os
+import resource
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# Seconds. Covers sub-millisecond SQLite reads up to slow uploads.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _HistogramChild:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by interpolating inside the bucket it falls in."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= target:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (target - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float):
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]):
+        self.function = function
+
+    def get(self) -> float:
+        return self.function() if self.function else self.value
+
+
+class _Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.children: dict[tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    @abstractmethod
+    def _new_child(self):
+        """A fresh child for one combination of label values."""
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        child = self.children.get(key)
+        if child is None:
+            with self._lock:
+                child = self.children.setdefault(key, self._new_child())
+        return child
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        for key, child in list(self.children.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), child.counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else repr(bound)
+                labels = _format_labels(self.labelnames, key, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {child.sum}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {child.count}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        for key, child in list(self.children.items()):
+            lines.append(f"{self.name}_total{_format_labels(self.labelnames, key)} {child.value}")
+        return lines
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        for key, child in list(self.children.items()):
+            value = child.get()
+            if value is not None and not math.isnan(value) and not math.isinf(value):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+REGISTRY: list[_Metric] = []
+_STARTED = time.monotonic()
+
+
+def render_prometheus() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+COMMAND_SECONDS = Histogram("keabot_command_seconds", "Time spent handling a command", ("command", "source"))
+EVENT_SECONDS = Histogram("keabot_event_seconds", "Time spent in a gateway event handler", ("event",))
+DB_SECONDS = Histogram("keabot_db_seconds", "Time spent running a database helper", ("helper", "kind"))
+DB_QUEUE_SECONDS = Histogram("keabot_db_queue_seconds", "Time a write waited for the writer thread")
+LOOP_LAG_SECONDS = Histogram("keabot_loop_lag_seconds", "How late the event loop woke a sleeping task")
+BYTES = Counter("keabot_bytes", "Media bytes moved to or from Discord", ("direction",))
+GATEWAY_LATENCY = Gauge("keabot_gateway_latency_seconds", "Heartbeat round trip to the Discord gateway")
+MEDIA_CACHE = Gauge("keabot_media_cache", "CDN link cache counters", ("stat",))
+GATEWAY_EVENTS = Counter("keabot_gateway_events", "Gateway dispatch events received", ("event",))
+MEMBER_CACHE = Gauge("keabot_cached_members", "Members held in memory", ("cache",))
+SCHEDULER_WAIT_SECONDS = Histogram("keabot_scheduler_wait_seconds", "Time a command waited for a scheduler slot", ("class",))
+SCHEDULER_REQUESTS = Counter("keabot_scheduler_requests", "Scheduled requests by outcome", ("class", "outcome"))
+RESIDENT_MEMORY = Gauge("keabot_resident_memory_bytes", "Resident set size of the bot process")
+
+
+def resident_memory() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Peak rather than current, but better than nothing off Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+RESIDENT_MEMORY.labels().set_function(resident_memory)
+
+
+def summary() -> str:
+    """Short human readable digest for the ..stats command."""
+    lines = []
+    for metric in (COMMAND_SECONDS, EVENT_SECONDS, DB_SECONDS):
+        rows = sorted((item for item in metric.children.items() if item[1].count), key=lambda item: -item[1].count)
+        if not rows:
+            continue
+        lines.append(f"{metric.documentation}:")
+        for key, child in rows[:10]:
+            lines.append(
+                f"  {'/'.join(key):28} n={child.count:<7} p50={child.quantile(0.5) * 1000:7.1f}ms"
+                f" p99={child.quantile(0.99) * 1000:7.1f}ms"
+            )
+    lag = LOOP_LAG_SECONDS.labels()
+    lines.append(f"Event loop lag: p50={lag.quantile(0.5) * 1000:.1f}ms p99={lag.quantile(0.99) * 1000:.1f}ms")
+    latency = GATEWAY_LATENCY.labels().get()
+    if latency is not None and math.isfinite(latency):
+        lines.append(f"Gateway latency: {latency * 1000:.0f}ms")
+    for key, child in BYTES.children.items():
+        lines.append(f"Bytes {key[0]}: {child.value / 1024 / 1024:.1f} MiB")
+    events = sorted(((key[0], child.value) for key, child in GATEWAY_EVENTS.children.items()), key=lambda item: -item[1])
+    if events:
+        uptime = time.monotonic() - _STARTED
+        total = sum(count for _, count in events)
+        top = ", ".join(f"{name} {count / uptime:.2f}/s" for name, count in events[:4])
+        lines.append(f"Gateway events: {total / uptime:.2f}/s ({top})")
+    lines.append(f"Resident memory: {resident_memory() / 1024 / 1024:.1f} MiB")
+    return "\n".join(lines)
+
+
+async def start_http_server(host: str, port: int):
+    """Serve /metrics in Prometheus text format. Returns the runner so it can be stopped."""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+    return runner
+
+
+async def sample_loop_lag(interval: float = 0.5):
+    loop = asyncio.get_running_loop()
+    child = LOOP_LAG_SECONDS.labels()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        child.observe(max(0.0, loop.time() - start - interval))
+
+
+def timed(child: _HistogramChild):
+    """Decorator recording how long a coroutine function takes."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with child.time():
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,128 @@
+import logging
+from pathlib import Path
+from typing import Generic, Optional, TypeVar
+
+from .database import Database
+from .lazy_cache import LazyCache
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+HASH_EXTENSIONS = {"jpg", "jpeg", "png", "webp", "bmp", "tiff", "gif"}
+
+T = TypeVar("T")
+
+
+def perceptual_hash(path: str) -> Optional[int]:
+    """64-bit difference hash: each bit says whether a pixel of a 9x8 greyscale thumbnail is brighter than its right neighbour.
+
+    Survives recompression, resizing and small colour changes. Returns None
+    for files that are not images (or when Pillow is missing).
+    """
+    if Image is None or Path(path).suffix.lower().lstrip(".") not in HASH_EXTENSIONS:
+        return None
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image)
+        pixels = list(image.convert("L").resize((9, 8), Image.Resampling.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            left, right = pixels[row * 9 + column], pixels[row * 9 + column + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree(Generic[T]):
+    """Metric tree over Hamming distance.
+
+    Each child edge is labelled with its distance to the parent, and the
+    triangle inequality limits a search to edges within `max_distance` of
+    the query's distance to each node visited.
+    """
+
+    def __init__(self):
+        # node: [hash, items, {distance: child}]
+        self._root: Optional[list] = None
+        self.size = 0
+
+    def add(self, value: int, item: T):
+        if self._root is None:
+            self._root = [value, [item], {}]
+            self.size += 1
+            return
+        node = self._root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                if item not in node[1]:
+                    node[1].append(item)
+                    self.size += 1
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                self.size += 1
+                return
+            node = child
+
+    def search(self, value: int, max_distance: int) -> list[tuple[int, T]]:
+        """(distance, item) for every item within `max_distance`, closest first."""
+        if self._root is None:
+            return []
+        matches = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                matches.extend((distance, item) for item in node[1])
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+
+class DuplicateIndex:
+    """Per-guild BK-trees of image perceptual hashes, loaded on first use.
+
+    Items are (image id, file path).
+    """
+
+    def __init__(self, db: Database, max_distance: int = 5):
+        self.db = db
+        self.max_distance = max_distance
+        self._guilds: LazyCache[int, BKTree[tuple[int, str]]] = LazyCache(self._load)
+
+    async def get(self, guild_id: int) -> BKTree[tuple[int, str]]:
+        return await self._guilds.get(guild_id)
+
+    async def _load(self, guild_id: int) -> BKTree[tuple[int, str]]:
+        tree: BKTree[tuple[int, str]] = BKTree()
+        for image_id, file_path, phash in await self.db.get_guild_image_hashes(guild_id):
+            tree.add(phash, (image_id, file_path))
+        logger.debug("Loaded %d image hashes for guild %d", tree.size, guild_id)
+        return tree
+
+    async def find(self, guild_id: int, phash: int, exclude: str = "") -> Optional[tuple[int, str]]:
+        """Closest stored image within max_distance, other than `exclude` itself."""
+        if self.max_distance < 0:
+            return None
+        for _, (image_id, file_path) in (await self.get(guild_id)).search(phash, self.max_distance):
+            if file_path != exclude:
+                return image_id, file_path
+        return None
+
+    def image_added(self, guild_id: int, phash: int, image_id: int, file_path: str):
+        self._guilds.update(guild_id, lambda tree: tree.add(phash, (image_id, file_path)))
+
+    def invalidate(self, guild_id: int):
+        self._guilds.invalidate(lambda key: key == guild_id)
@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable, Optional, TypeVar
+
+from discord.ext import commands
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Weight of the newest run time in the moving average used to predict waits
+SERVICE_ALPHA = 0.2
+
+
+@dataclass
+class CostClass:
+    name: str
+    # Requests of this class running at once, in total and per guild
+    global_limit: int
+    guild_limit: int
+    # Longest a request may wait for a slot before it is turned away
+    deadline: float
+
+
+# Overridden per class by the "scheduler" config section
+DEFAULT_CLASSES = {
+    # Uploading files to Discord: postimage
+    "upload": CostClass("upload", global_limit=4, guild_limit=2, deadline=20.0),
+    # Downloading, hashing and storing attachments: addimage
+    "ingest": CostClass("ingest", global_limit=4, guild_limit=2, deadline=60.0),
+    # Database reads plus member lookups: leaderboard
+    "members": CostClass("members", global_limit=8, guild_limit=2, deadline=10.0),
+}
+
+
+class Overloaded(commands.CommandError):
+    """Raised instead of queueing a request that would wait longer than its class's deadline."""
+
+    def __init__(self, cost_class: str, wait: float):
+        self.cost_class = cost_class
+        self.wait = wait
+        super().__init__(f"Keabot is busy right now, try again in {max(1, round(wait))} seconds")
+
+
+class _Lane:
+    """Slots and waiting requests of one cost class."""
+
+    def __init__(self, cost_class: CostClass):
+        self.cost_class = cost_class
+        self.running = 0
+        self.guild_running: Counter[int] = Counter()
+        self.queues: dict[int, deque[asyncio.Future]] = {}
+        # Guilds with waiting requests, in the order they will be served
+        self.ready: deque[int] = deque()
+        self.waiting = 0
+        # Moving average of how long a request holds its slot
+        self.service_time = 0.0
+        self.rejected = 0
+
+    def can_start(self, guild_id: int) -> bool:
+        return (self.running < self.cost_class.global_limit
+                and self.guild_running[guild_id] < self.cost_class.guild_limit)
+
+    def expected_wait(self, guild_id: int) -> float:
+        """Rough wait for a new request: everything queued ahead of it, served `limit` at a time."""
+        queued_total = self.waiting + 1
+        queued_guild = len(self.queues.get(guild_id, ())) + 1
+        return self.service_time * max(
+            queued_total / self.cost_class.global_limit,
+            queued_guild / self.cost_class.guild_limit
+        )
+
+    def start(self, guild_id: int):
+        self.running += 1
+        self.guild_running[guild_id] += 1
+
+    def finish(self, guild_id: int, elapsed: Optional[float]):
+        self.running -= 1
+        self.guild_running[guild_id] -= 1
+        if not self.guild_running[guild_id]:
+            del self.guild_running[guild_id]
+        if elapsed is not None:
+            self.service_time += SERVICE_ALPHA * (elapsed - self.service_time)
+
+    def withdraw(self, guild_id: int, waiter: asyncio.Future):
+        queue = self.queues.get(guild_id)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        self.waiting -= 1
+        if not queue:
+            del self.queues[guild_id]
+            self.ready.remove(guild_id)
+
+    def dispatch(self):
+        """Hand free slots to waiting requests, one guild at a time in turn."""
+        skipped = 0
+        while self.running < self.cost_class.global_limit and skipped < len(self.ready):
+            guild_id = self.ready.popleft()
+            queue = self.queues[guild_id]
+            if self.guild_running[guild_id] >= self.cost_class.guild_limit:
+                self.ready.append(guild_id)
+                skipped += 1
+                continue
+            waiter = queue.popleft()
+            self.waiting -= 1
+            # A waiter past its deadline is cancelled before _acquire gets to
+            # withdraw it; it doesn't get (and mustn't use up) the slot
+            if not waiter.done():
+                waiter.set_result(None)
+                self.start(guild_id)
+            skipped = 0
+            if queue:
+                # Back of the line, so every guild gets a turn
+                self.ready.append(guild_id)
+            else:
+                del self.queues[guild_id]
+
+
+class Scheduler:
+    """Fair admission control for expensive commands.
+
+    Work is sorted into cost classes, each with a global and a per-guild cap
+    on how many requests run at once. Requests over a cap wait in a queue per
+    guild and guilds are served round-robin, so one busy guild can't starve
+    the rest. A request whose predicted wait exceeds its class's deadline is
+    rejected with `Overloaded` straight away, and one still waiting when the
+    deadline passes is rejected then. Identical requests in flight at the
+    same time can share one execution through `run(..., key=...)`.
+    """
+
+    def __init__(self, classes: Optional[dict[str, dict]] = None):
+        self._lanes: dict[str, _Lane] = {}
+        for name, default in DEFAULT_CLASSES.items():
+            overrides = (classes or {}).get(name, {})
+            self._lanes[name] = _Lane(CostClass(
+                name,
+                global_limit=overrides.get("global", default.global_limit),
+                guild_limit=overrides.get("guild", default.guild_limit),
+                deadline=overrides.get("deadline", default.deadline)
+            ))
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+
+    async def _acquire(self, lane: _Lane, guild_id: int):
+        if lane.can_start(guild_id) and guild_id not in lane.queues:
+            lane.start(guild_id)
+            return
+        expected = lane.expected_wait(guild_id)
+        if expected > lane.cost_class.deadline:
+            self._reject(lane, expected)
+        waiter = asyncio.get_running_loop().create_future()
+        queue = lane.queues.get(guild_id)
+        if queue is None:
+            queue = lane.queues[guild_id] = deque()
+            lane.ready.append(guild_id)
+        queue.append(waiter)
+        lane.waiting += 1
+        try:
+            await asyncio.wait_for(waiter, lane.cost_class.deadline)
+        except asyncio.TimeoutError:
+            lane.withdraw(guild_id, waiter)
+            self._reject(lane, lane.cost_class.deadline)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Cancelled just after being handed a slot: pass it on
+                lane.finish(guild_id, None)
+                lane.dispatch()
+            else:
+                lane.withdraw(guild_id, waiter)
+            raise
+
+    def _reject(self, lane: _Lane, expected: float):
+        lane.rejected += 1
+        metrics.SCHEDULER_REQUESTS.labels(lane.cost_class.name, "rejected").inc()
+        raise Overloaded(lane.cost_class.name, max(expected, lane.service_time))
+
+    @asynccontextmanager
+    async def slot(self, cost_class: str, guild_id: Optional[int]) -> AsyncIterator[None]:
+        """Hold one of `cost_class`'s slots for `guild_id` while the block runs."""
+        lane = self._lanes[cost_class]
+        guild_id = guild_id or 0
+        queued_at = time.perf_counter()
+        await self._acquire(lane, guild_id)
+        started = time.perf_counter()
+        metrics.SCHEDULER_WAIT_SECONDS.labels(cost_class).observe(started - queued_at)
+        metrics.SCHEDULER_REQUESTS.labels(cost_class, "run").inc()
+        try:
+            yield
+        finally:
+            lane.finish(guild_id, time.perf_counter() - started)
+            lane.dispatch()
+
+    async def run(self, cost_class: str, guild_id: Optional[int], fn: Callable[[], Awaitable[T]],
+                  key: Optional[Hashable] = None) -> T:
+        """Await `fn()` in a slot. Calls with the same `key` while one is in flight share its result."""
+        if key is None:
+            async with self.slot(cost_class, guild_id):
+                return await fn()
+        task = self._inflight.get(key)
+        if task is not None:
+            metrics.SCHEDULER_REQUESTS.labels(cost_class, "coalesced").inc()
+            return await asyncio.shield(task)
+
+        async def execute() -> Any:
+            async with self.slot(cost_class, guild_id):
+                return await fn()
+
+        task = asyncio.create_task(execute())
+        self._inflight[key] = task
+        task.add_done_callback(lambda done: self._inflight.pop(key) if self._inflight.get(key) is done else None)
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        return {
+            name: {
+                "running": lane.running,
+                "waiting": lane.waiting,
+                "guilds": len(lane.queues),
+                "rejected": lane.rejected,
+                "service_ms": lane.service_time * 1000,
+            }
+            for name, lane in self._lanes.items()
+        }
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from .database import Database
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class ScoreAggregator:
+    """Write-behind buffer for gold reactions.
+
+    Reaction handlers record reactions in memory, keyed like the ledger by
+    (message, gifter, emoji) so only the latest state of each is kept. They
+    are flushed as a single transaction every `flush_interval` seconds, or
+    sooner once `max_pending` reactions are outstanding. The ledger decides
+    which of them actually change a counter.
+    """
+
+    def __init__(self, db: Database, flush_interval: float = 2.0, max_pending: int = 500):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # (message_id, gifter_id, emoji) -> reaction row for score_helper.apply_reactions
+        self._pending: dict[tuple[int, int, str], dict] = {}
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        self._threshold_flush: Optional[asyncio.Task] = None
+        # Called with the set of server ids whose scores were just written
+        self.flush_listeners: list[Callable[[set[int]], None]] = []
+        # Called with the {(server_id, user_id): [score, given, self]} deltas each flush applied
+        self.delta_listeners: list[Callable[[dict[tuple[int, int], list[int]]], None]] = []
+
+    def start(self):
+        if self._timer is None:
+            self._timer = asyncio.create_task(self._flush_periodically(), name="score-aggregator")
+
+    def add(self, message_id: int, gifter_id: int, emoji: str, server_id: int, channel_id: int, receiver_id: int, active: bool):
+        self._pending[(message_id, gifter_id, emoji)] = {
+            "message_id": message_id,
+            "gifter_id": gifter_id,
+            "emoji": emoji,
+            "server_id": server_id,
+            "channel_id": channel_id,
+            "receiver_id": receiver_id,
+            "active": int(active),
+            "updated_at": int(time.time())
+        }
+        if len(self._pending) >= self.max_pending and (self._threshold_flush is None or self._threshold_flush.done()):
+            self._threshold_flush = asyncio.create_task(self.flush())
+
+    def pending(self, server_id: int, user_id: int) -> list[dict]:
+        """Buffered reactions on messages by this user."""
+        return [
+            reaction for reaction in self._pending.values()
+            if reaction["server_id"] == server_id and reaction["receiver_id"] == user_id
+        ]
+
+    async def get_score(self, server_id: int, user_id: int) -> int:
+        # Holding the lock means no flush is half applied, so the stored score
+        # plus whichever pending reactions the ledger will accept is exact.
+        async with self._lock:
+            pending = self.pending(server_id, user_id)
+            score = await self.db.get_score(server_id, user_id)
+            if pending:
+                states = await self.db.get_ledger_states([
+                    (reaction["message_id"], reaction["gifter_id"], reaction["emoji"]) for reaction in pending
+                ])
+                for reaction in pending:
+                    key = (reaction["message_id"], reaction["gifter_id"], reaction["emoji"])
+                    if states.get(key, 0) != reaction["active"]:
+                        score += 1 if reaction["active"] else -1
+            return score
+
+    async def consistent(self, fn: Callable[[], Awaitable[T]]) -> T:
+        """Await `fn()` while no flush is being applied, e.g. to load state the listeners then keep current."""
+        async with self._lock:
+            return await fn()
+
+    async def flush(self):
+        async with self._lock:
+            await self._flush_locked()
+
+    async def _flush_locked(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        try:
+            # Shielded so cancelling the timer on shutdown cannot drop a batch
+            # that is already queued for the writer.
+            deltas = await asyncio.shield(self.db.apply_reactions(list(batch.values())))
+        except Exception:
+            logger.exception("Failed to flush %d gold reactions, will retry", len(batch))
+            # Anything recorded since is newer and wins
+            for key, reaction in batch.items():
+                self._pending.setdefault(key, reaction)
+            return
+        for listener in self.delta_listeners:
+            listener(deltas)
+        servers = {reaction["server_id"] for reaction in batch.values()}
+        for listener in self.flush_listeners:
+            listener(servers)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
@@ -1,11 +1,39 @@
+import json
+import time
 import sqlite3
 from sqlite3 import Connection, Cursor, Row
+from datetime import datetime, timezone
 from pathlib import Path
 from typing import Optional
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Leaderboard windows backed by score_rollup; "all" reads the user table
+PERIODS = ("day", "week", "month")
+WINDOWS = (*PERIODS, "all")
+DISCORD_EPOCH_MS = 1420070400000
+# Ledger state of a reaction with no row on a message from before the ledger
+# started: it may or may not have been counted, so both an add and a remove
+# change the counters
+LEGACY_STATE = -1
+
+def snowflake_time(snowflake: int) -> float:
+    return ((snowflake >> 22) + DISCORD_EPOCH_MS) / 1000
+
+def rollup_bucket(period: str, timestamp: float) -> int:
+    """Start (unix seconds, UTC) of the calendar day, ISO week or month containing timestamp."""
+    day = int(timestamp // 86400)
+    if period == "day":
+        return day * 86400
+    if period == "week":
+        # 1970-01-01 was a Thursday; weeks start on Monday
+        return (day - (day + 3) % 7) * 86400
+    if period == "month":
+        date = datetime.fromtimestamp(timestamp, timezone.utc)
+        return int(datetime(date.year, date.month, 1, tzinfo=timezone.utc).timestamp())
+    raise ValueError(f"Unknown period {period}")
+
 def check_user(conn: Connection, server_id:int, user_id: int) -> bool:
     cursor = conn.cursor()
     res = cursor.execute(
@@ -74,8 +102,7 @@ def decrement_score(conn: Connection, server_id: int, user_id: int):
     cursor.close()
 
 def get_score(conn: Connection, server_id: int, user_id: int) -> int:
-    if not check_user(conn, server_id, user_id):
-        add_user(conn, server_id, user_id)
+    """Score of a user, 0 for users with no row yet."""
     cursor = conn.cursor()
     res = cursor.execute(
             """SELECT score FROM user
@@ -88,12 +115,12 @@ def get_score(conn: Connection, server_id: int, user_id: int) -> int:
     row:Row = res.fetchone()
     conn.commit()
     cursor.close()
-    return row["score"]
+    return row["score"] if row else 0
 
 def get_server_scores(conn: Connection, server_id: int) -> list[Row]:
     cursor = conn.cursor()
     res = cursor.execute(
-            """SELECT score FROM user
+            """SELECT user_id, score FROM user
             WHERE server_id = :server_id;""",
             {
                 "server_id": server_id,
@@ -104,18 +131,35 @@ def get_server_scores(conn: Connection, server_id: int) -> list[Row]:
     cursor.close()
     return scores
 
-def get_top_scores(conn: Connection, server_id: int, num:int=5) -> list[Row]:
-    logger.info("Getting top %d scores for server %d", num, server_id)
+def get_top_scores(conn: Connection, server_id: int, num:int=5, window:str="all", now:Optional[float]=None) -> list[Row]:
+    """Top `num` scores of all time, or of the current calendar day/week/month."""
+    logger.info("Getting top %d scores (%s) for server %d", num, window, server_id)
     cursor = conn.cursor()
-    res = cursor.execute(
-            """SELECT score, user_id FROM user
-            WHERE server_id = :server_id
-            ORDER BY score DESC;""",
-            {
-                "server_id": server_id,
-            }
-            )
-    scores:list[Row] = res.fetchmany(num)
+    if window == "all":
+        res = cursor.execute(
+                """SELECT score, user_id FROM user
+                WHERE server_id = :server_id
+                ORDER BY score DESC
+                LIMIT :num;""",
+                {
+                    "server_id": server_id,
+                    "num": num
+                }
+                )
+    else:
+        res = cursor.execute(
+                """SELECT score, user_id FROM score_rollup
+                WHERE server_id = :server_id AND period = :period AND bucket = :bucket
+                ORDER BY score DESC
+                LIMIT :num;""",
+                {
+                    "server_id": server_id,
+                    "period": window,
+                    "bucket": rollup_bucket(window, time.time() if now is None else now),
+                    "num": num
+                }
+                )
+    scores:list[Row] = res.fetchall()
     conn.commit()
     cursor.close()
     return scores
@@ -187,3 +231,290 @@ def decrement_given(conn: Connection, server_id: int, user_id: int):
             )
     conn.commit()
     cursor.close()
+
+def apply_score_deltas(conn: Connection, deltas: dict[tuple[int, int], list[int]]):
+    """Apply {(server_id, user_id): [score, given, self]} in one transaction."""
+    logger.info("Applying score deltas for %d users", len(deltas))
+    cursor = conn.cursor()
+    _upsert_score_deltas(cursor, deltas)
+    conn.commit()
+    cursor.close()
+
+def _upsert_score_deltas(cursor: Cursor, deltas: dict[tuple[int, int], list[int]]):
+    cursor.executemany(
+            """INSERT INTO user (server_id, user_id, score, given, self)
+            VALUES (:server_id, :user_id, :score, :given, :self)
+            ON CONFLICT(server_id, user_id) DO UPDATE SET
+                score = score + excluded.score,
+                given = given + excluded.given,
+                self = self + excluded.self;""",
+            [
+                {
+                    "server_id": server_id,
+                    "user_id": user_id,
+                    "score": score,
+                    "given": given,
+                    "self": selfish
+                }
+                for (server_id, user_id), (score, given, selfish) in deltas.items()
+            ]
+            )
+
+def _add_reaction_delta(deltas: dict[tuple, list[int]], key: tuple, gifter_id: int, receiver_id: int, amount: int):
+    # key is (server_id,) for the user table or (server_id, period, bucket) for score_rollup
+    deltas.setdefault((*key, receiver_id), [0, 0, 0])[0] += amount
+    if gifter_id == receiver_id:
+        deltas.setdefault((*key, gifter_id), [0, 0, 0])[2] += amount
+    else:
+        deltas.setdefault((*key, gifter_id), [0, 0, 0])[1] += amount
+
+def _add_rollup_deltas(rollups: dict[tuple, list[int]], server_id: int, given_at: float, gifter_id: int, receiver_id: int, amount: int):
+    # Gold counts towards the window it was given in. Removals pass the
+    # ledger's given_at too, so taking gold back undoes it in the same buckets
+    for period in PERIODS:
+        _add_reaction_delta(rollups, (server_id, period, rollup_bucket(period, given_at)), gifter_id, receiver_id, amount)
+
+def _upsert_rollup_deltas(cursor: Cursor, rollups: dict[tuple, list[int]]):
+    cursor.executemany(
+            """INSERT INTO score_rollup (server_id, period, bucket, user_id, score, given, self)
+            VALUES (:server_id, :period, :bucket, :user_id, :score, :given, :self)
+            ON CONFLICT(server_id, period, bucket, user_id) DO UPDATE SET
+                score = score + excluded.score,
+                given = given + excluded.given,
+                self = self + excluded.self;""",
+            [
+                {
+                    "server_id": server_id,
+                    "period": period,
+                    "bucket": bucket,
+                    "user_id": user_id,
+                    "score": score,
+                    "given": given,
+                    "self": selfish
+                }
+                for (server_id, period, bucket, user_id), (score, given, selfish) in rollups.items()
+            ]
+            )
+
+def _ledger_started_at(cursor: Cursor) -> float:
+    row = cursor.execute("SELECT value FROM setting WHERE name = 'ledger_started_at';").fetchone()
+    return row[0] if row else 0
+
+def _ledger_state(cursor: Cursor, message_id: int, gifter_id: int, emoji: str, started_at: float) -> tuple[int, Optional[int]]:
+    """(state, given_at) of a reaction."""
+    row = cursor.execute(
+            """SELECT active, given_at FROM gold_ledger
+            WHERE message_id = :message_id AND gifter_id = :gifter_id AND emoji = :emoji;""",
+            {
+                "message_id": message_id,
+                "gifter_id": gifter_id,
+                "emoji": emoji
+            }
+            ).fetchone()
+    if row is not None:
+        return row[0], row[1]
+    return (LEGACY_STATE if snowflake_time(message_id) < started_at else 0), None
+
+def apply_reactions(conn: Connection, reactions: list[dict]) -> dict[tuple[int, int], list[int]]:
+    """Record gold reactions in the ledger and update the counters of those that changed state.
+
+    Each reaction is a dict with message_id, gifter_id, emoji, server_id,
+    channel_id, receiver_id, active (1 added, 0 removed) and updated_at, the
+    time the event arrived. An add is recorded as given at updated_at.
+    An add for a reaction that is already active, or a remove for one that
+    is not, changes nothing. A remove with no ledger row on a message from
+    before the ledger started takes back gold counted before it existed.
+    Returns the counter deltas that were applied.
+    """
+    logger.info("Applying %d gold reactions", len(reactions))
+    cursor = conn.cursor()
+    deltas: dict[tuple[int, int], list[int]] = {}
+    rollups: dict[tuple, list[int]] = {}
+    started_at = _ledger_started_at(cursor)
+    for reaction in reactions:
+        state, given_at = _ledger_state(cursor, reaction["message_id"], reaction["gifter_id"], reaction["emoji"], started_at)
+        if state == reaction["active"]:
+            continue
+        if reaction["active"] or given_at is None:
+            given_at = reaction["updated_at"]
+        cursor.execute(
+                """INSERT INTO gold_ledger (message_id, gifter_id, emoji, server_id, channel_id, receiver_id, active, updated_at, given_at)
+                VALUES (:message_id, :gifter_id, :emoji, :server_id, :channel_id, :receiver_id, :active, :updated_at, :given_at)
+                ON CONFLICT(message_id, gifter_id, emoji) DO UPDATE SET
+                    active = excluded.active,
+                    updated_at = excluded.updated_at,
+                    given_at = excluded.given_at;""",
+                {**reaction, "given_at": given_at}
+                )
+        amount = 1 if reaction["active"] else -1
+        _add_reaction_delta(deltas, (reaction["server_id"],), reaction["gifter_id"], reaction["receiver_id"], amount)
+        if state == LEGACY_STATE and amount < 0:
+            # Given before the ledger, so it was never in a rollup
+            continue
+        _add_rollup_deltas(rollups, reaction["server_id"], given_at, reaction["gifter_id"], reaction["receiver_id"], amount)
+    _upsert_score_deltas(cursor, deltas)
+    _upsert_rollup_deltas(cursor, rollups)
+    conn.commit()
+    cursor.close()
+    return deltas
+
+def get_ledger_states(conn: Connection, keys: list[tuple[int, int, str]]) -> dict[tuple[int, int, str], int]:
+    """Ledger state of each (message_id, gifter_id, emoji): 1 active, 0 inactive or unknown, LEGACY_STATE for
+    unknown reactions on messages from before the ledger started."""
+    cursor = conn.cursor()
+    started_at = _ledger_started_at(cursor)
+    states = {
+        (message_id, gifter_id, emoji): _ledger_state(cursor, message_id, gifter_id, emoji, started_at)[0]
+        for message_id, gifter_id, emoji in keys
+    }
+    conn.commit()
+    cursor.close()
+    return states
+
+def reconcile_reactions(
+        conn: Connection,
+        server_id: int,
+        channel_id: int,
+        messages: list[tuple[int, int, list[tuple[str, int]]]],
+        last_message_id: int,
+        done: bool,
+        updated_at: int):
+    """Make the ledger match a page of channel history and checkpoint the channel.
+
+    `messages` holds (message_id, author_id, [(emoji, gifter_id)] for every
+    gold reaction currently on it) for every message on the page. Counters
+    are left alone; rebuild_scores brings them in line once the backfill is
+    finished. When the gold was given isn't known, so reactions found here
+    are counted as given when their message was posted.
+    """
+    cursor = conn.cursor()
+    for message_id, author_id, reactions in messages:
+        params = {
+            "message_id": message_id,
+            "server_id": server_id,
+            "channel_id": channel_id,
+            "receiver_id": author_id,
+            "updated_at": updated_at,
+            "given_at": int(snowflake_time(message_id))
+        }
+        cursor.executemany(
+                """INSERT INTO gold_ledger (message_id, gifter_id, emoji, server_id, channel_id, receiver_id, active, updated_at, given_at)
+                VALUES (:message_id, :gifter_id, :emoji, :server_id, :channel_id, :receiver_id, 1, :updated_at, :given_at)
+                ON CONFLICT(message_id, gifter_id, emoji) DO UPDATE SET
+                    active = 1,
+                    updated_at = excluded.updated_at,
+                    given_at = excluded.given_at
+                WHERE active = 0;""",
+                [{**params, "emoji": emoji, "gifter_id": gifter_id} for emoji, gifter_id in reactions]
+                )
+        # Anyone no longer reacting took their gold back while the bot was not looking
+        cursor.execute(
+                """UPDATE gold_ledger SET active = 0, updated_at = :updated_at
+                WHERE message_id = :message_id AND active = 1
+                AND emoji || ':' || gifter_id NOT IN (SELECT value FROM json_each(:present));""",
+                {**params, "present": json.dumps([f"{emoji}:{gifter_id}" for emoji, gifter_id in reactions])}
+                )
+    cursor.execute(
+            """INSERT INTO backfill_checkpoint (channel_id, server_id, last_message_id, done, updated_at)
+            VALUES (:channel_id, :server_id, :last_message_id, :done, :updated_at)
+            ON CONFLICT(channel_id) DO UPDATE SET
+                last_message_id = excluded.last_message_id,
+                done = excluded.done,
+                updated_at = excluded.updated_at;""",
+            {
+                "channel_id": channel_id,
+                "server_id": server_id,
+                "last_message_id": last_message_id,
+                "done": int(done),
+                "updated_at": updated_at
+            }
+            )
+    conn.commit()
+    cursor.close()
+
+def rebuild_scores(conn: Connection, server_id: int):
+    """Recompute the counters and rollups of a server from the active rows of the ledger.
+
+    Only counters the ledger has rows for are recomputed. A user's score with
+    no ledger row naming them as receiver (or given/self with none naming
+    them as gifter), such as a seeded starting score, is kept as it is.
+    """
+    logger.info("Rebuilding scores for server %d from the gold ledger", server_id)
+    cursor = conn.cursor()
+    params = {"server_id": server_id}
+    counters = (
+            ("score", "receiver_id", "1"),
+            ("given", "gifter_id", "gifter_id != receiver_id"),
+            ("self", "gifter_id", "gifter_id = receiver_id"))
+    for column, user_column, condition in counters:
+        cursor.execute(
+                f"""UPDATE user SET {column} = 0
+                WHERE server_id = :server_id AND user_id IN (
+                    SELECT {user_column} FROM gold_ledger
+                    WHERE server_id = :server_id AND {condition}
+                );""",
+                params
+                )
+    cursor.execute(
+            """DELETE FROM score_rollup
+            WHERE server_id = :server_id;""",
+            params
+            )
+    rollups: dict[tuple, list[int]] = {}
+    for row in cursor.execute(
+            """SELECT given_at, gifter_id, receiver_id FROM gold_ledger
+            WHERE server_id = :server_id AND active = 1;""",
+            params
+            ).fetchall():
+        _add_rollup_deltas(rollups, server_id, row[0], row[1], row[2], 1)
+    _upsert_rollup_deltas(cursor, rollups)
+    for column, user_column, condition in counters:
+        counts = ", ".join("COUNT(*)" if name == column else "0" for name in ("score", "given", "self"))
+        cursor.execute(
+                f"""INSERT INTO user (server_id, user_id, score, given, self)
+                SELECT server_id, {user_column}, {counts}
+                FROM gold_ledger
+                WHERE server_id = :server_id AND active = 1 AND {condition}
+                GROUP BY {user_column}
+                ON CONFLICT(server_id, user_id) DO UPDATE SET {column} = excluded.{column};""",
+                params
+                )
+    conn.commit()
+    cursor.close()
+
+def get_backfill_checkpoints(conn: Connection, server_id: int) -> dict[int, Row]:
+    cursor = conn.cursor()
+    res = cursor.execute(
+            """SELECT channel_id, last_message_id, done FROM backfill_checkpoint
+            WHERE server_id = :server_id;""",
+            {
+                "server_id": server_id
+            }
+            )
+    checkpoints = {row["channel_id"]: row for row in res.fetchall()}
+    conn.commit()
+    cursor.close()
+    return checkpoints
+
+def compact_rollups(conn: Connection, keep: dict[str, int], now: Optional[float] = None) -> int:
+    """Delete rollup buckets older than the newest `keep[period]` buckets of each period."""
+    now = time.time() if now is None else now
+    cursor = conn.cursor()
+    deleted = 0
+    for period, count in keep.items():
+        # Step back count - 1 buckets from the current one; months vary in length
+        cutoff = rollup_bucket(period, now)
+        for _ in range(count - 1):
+            cutoff = rollup_bucket(period, cutoff - 1)
+        deleted += cursor.execute(
+                """DELETE FROM score_rollup
+                WHERE period = :period AND bucket < :cutoff;""",
+                {
+                    "period": period,
+                    "cutoff": cutoff
+                }
+                ).rowcount
+    conn.commit()
+    cursor.close()
+    logger.info("Compacted %d score rollup rows", deleted)
+    return deleted
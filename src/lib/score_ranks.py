@@ -0,0 +1,146 @@
+import bisect
+import heapq
+import logging
+import math
+from dataclasses import dataclass
+from typing import Optional
+
+from .database import Database
+from .lazy_cache import LazyCache
+from .score_aggregator import ScoreAggregator
+
+logger = logging.getLogger(__name__)
+
+# Flushes that change more users than this re-merge the whole list once
+# instead of moving entries one at a time
+MERGE_THRESHOLD = 16
+
+
+@dataclass
+class Standing:
+    score: int
+    # 1-based; users on the same score share a rank
+    rank: int
+    total: int
+    # (user_id, score) of the nearest users with a higher and a lower score
+    above: Optional[tuple[int, int]]
+    below: Optional[tuple[int, int]]
+
+    @property
+    def top_percent(self) -> int:
+        return max(1, math.ceil(100 * self.rank / self.total))
+
+    def __str__(self) -> str:
+        return f"#{self.rank} of {self.total} (top {self.top_percent}%)"
+
+
+class GuildRanks:
+    """One guild's scores as a sorted array.
+
+    Lookups are binary searches, O(log n). Updates are not: moving an entry
+    shifts the array, so `update` costs O(n) per changed user for small
+    batches and a single O(n + k log k) merge for a batch of k changes.
+    """
+
+    def __init__(self):
+        self.scores: dict[int, int] = {}
+        # Sorted (-score, user_id) pairs, highest score first
+        self.sorted: list[tuple[int, int]] = []
+
+    def update(self, deltas: dict[int, int]):
+        """Apply {user_id: score delta} for one flush."""
+        changed = {
+            user_id: self.scores.get(user_id, 0) + delta
+            for user_id, delta in deltas.items()
+            # A gifter's unchanged score only matters if they are new
+            if delta or user_id not in self.scores
+        }
+        if len(changed) <= MERGE_THRESHOLD:
+            for user_id, score in changed.items():
+                old = self.scores.get(user_id)
+                if old is not None:
+                    del self.sorted[bisect.bisect_left(self.sorted, (-old, user_id))]
+                bisect.insort(self.sorted, (-score, user_id))
+        else:
+            kept = [entry for entry in self.sorted if entry[1] not in changed]
+            self.sorted = list(heapq.merge(kept, sorted((-score, user_id) for user_id, score in changed.items())))
+        self.scores.update(changed)
+
+    def _nearest(self, start: int, step: int, user_id: int) -> Optional[tuple[int, int]]:
+        while 0 <= start < len(self.sorted):
+            key, other = self.sorted[start]
+            if other != user_id:
+                return other, -key
+            start += step
+        return None
+
+    def standing(self, user_id: int, score: Optional[int] = None) -> Standing:
+        """Where `user_id` ranks with `score` (their indexed score by default) against everyone else."""
+        stored = self.scores.get(user_id)
+        if score is None:
+            score = stored or 0
+        # Entries before `tied` have a higher score, entries from `lower` a lower one
+        tied = bisect.bisect_left(self.sorted, (-score,))
+        lower = bisect.bisect_left(self.sorted, (-score + 1,))
+        # The user's own indexed entry isn't competition
+        higher = tied - 1 if stored is not None and stored > score else tied
+        return Standing(
+            score=score,
+            rank=higher + 1,
+            total=len(self.scores) + (stored is None),
+            above=self._nearest(tied - 1, -1, user_id),
+            below=self._nearest(lower, 1, user_id)
+        )
+
+    def top(self, number: int) -> list[dict]:
+        return [{"user_id": user_id, "score": -key} for key, user_id in self.sorted[:number]]
+
+
+class ScoreRanks:
+    """All-time scores of each guild kept sorted in memory, for ranks without sorting the user table.
+
+    A guild is loaded from the user table the first time it is asked for and
+    then follows the deltas every score flush applies, one batch per guild
+    per flush. Rank, percentile, neighbours and the top of the leaderboard
+    are binary searches; see GuildRanks for what updates cost.
+    """
+
+    def __init__(self, db: Database, scores: ScoreAggregator):
+        self.db = db
+        self.scores = scores
+        self._guilds: LazyCache[int, GuildRanks] = LazyCache(self._load)
+
+    async def get(self, guild_id: int) -> GuildRanks:
+        return await self._guilds.get(guild_id)
+
+    async def _load(self, guild_id: int) -> GuildRanks:
+        async def load() -> GuildRanks:
+            ranks = GuildRanks()
+            rows = await self.db.get_server_scores(guild_id)
+            ranks.scores = {int(row["user_id"]): row["score"] for row in rows}
+            ranks.sorted = sorted((-score, user_id) for user_id, score in ranks.scores.items())
+            return ranks
+
+        # Read between flushes, and cached before the next one can run, so
+        # every delta is either in the read or applied to the cached ranks
+        ranks = await self.scores.consistent(load)
+        logger.debug("Loaded %d scores for guild %d", len(ranks.scores), guild_id)
+        return ranks
+
+    async def standing(self, guild_id: int, user_id: int, score: Optional[int] = None) -> Standing:
+        return (await self.get(guild_id)).standing(user_id, score)
+
+    async def top(self, guild_id: int, number: int) -> list[dict]:
+        return (await self.get(guild_id)).top(number)
+
+    def apply(self, deltas: dict[tuple[int, int], list[int]]):
+        batches: dict[int, dict[int, int]] = {}
+        for (server_id, user_id), (score, _, _) in deltas.items():
+            if self._guilds.cached(server_id) is not None:
+                batches.setdefault(server_id, {})[user_id] = score
+        for server_id, batch in batches.items():
+            # Not LazyCache.update: a guild still loading already reads these from the database
+            self._guilds.cached(server_id).update(batch)
+
+    def invalidate(self, guild_id: int):
+        self._guilds.invalidate(lambda key: key == guild_id)
@@ -0,0 +1,77 @@
+import bisect
+import logging
+
+from .database import Database
+from .lazy_cache import LazyCache
+
+logger = logging.getLogger(__name__)
+
+
+class GuildTags:
+    def __init__(self):
+        # Sorted (casefolded name, name) pairs for prefix lookups
+        self.sorted: list[tuple[str, str]] = []
+        self.counts: dict[str, int] = {}
+
+    def add(self, name: str, count: int = 0):
+        if name not in self.counts:
+            bisect.insort(self.sorted, (name.casefold(), name))
+            self.counts[name] = 0
+        self.counts[name] += count
+
+    def search(self, query: str, limit: int) -> list[str]:
+        query = query.casefold()
+        # Prefix matches come straight out of the sorted list
+        start = bisect.bisect_left(self.sorted, (query, ""))
+        matches = []
+        for i in range(start, len(self.sorted)):
+            key, name = self.sorted[i]
+            if not key.startswith(query):
+                break
+            matches.append(name)
+        matches.sort(key=lambda name: -self.counts[name])
+        if len(matches) >= limit or not query:
+            return matches[:limit]
+        # Not enough prefix hits: fall back to substring matches
+        prefixed = set(matches)
+        others = [name for key, name in self.sorted if query in key and name not in prefixed]
+        others.sort(key=lambda name: -self.counts[name])
+        return (matches + others)[:limit]
+
+    def ranked(self) -> list[tuple[str, int]]:
+        return sorted(self.counts.items(), key=lambda item: (-item[1], item[0].casefold()))
+
+
+class TagIndex:
+    """Per-guild tag names and usage counts, loaded once and kept current on writes.
+
+    Serves prefix/substring lookups for slash command autocomplete and the
+    ..tags listing without touching the database.
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+        self._guilds: LazyCache[int, GuildTags] = LazyCache(self._load)
+
+    async def get(self, guild_id: int) -> GuildTags:
+        return await self._guilds.get(guild_id)
+
+    async def _load(self, guild_id: int) -> GuildTags:
+        tags = GuildTags()
+        for row in await self.db.get_tag_counts(guild_id):
+            tags.add(row["name"], row["images"])
+        logger.debug("Loaded %d tags for guild %d", len(tags.counts), guild_id)
+        return tags
+
+    async def search(self, guild_id: int, query: str, limit: int = 25) -> list[str]:
+        return (await self.get(guild_id)).search(query, limit)
+
+    def tags_added(self, guild_id: int, tags: list[str]):
+        def add(guild_tags: GuildTags):
+            for tag in tags:
+                guild_tags.add(tag, 1)
+
+        self._guilds.update(guild_id, add)
+
+    def invalidate(self, guild_id: int):
+        self._guilds.invalidate(lambda key: key == guild_id)
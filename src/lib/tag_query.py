@@ -0,0 +1,117 @@
+import logging
+import random
+from dataclasses import dataclass
+from typing import Optional
+
+from .database import Database
+from .lazy_cache import LazyCache
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TagQuery:
+    """Every group in `required` must match (a group is tags OR'd together); no tag in `excluded` may."""
+    required: list[list[str]]
+    excluded: list[str]
+
+
+def parse_query(text: str) -> TagQuery:
+    """`alice bob` is alice AND bob, `alice|bob` is alice OR bob, `-bob` excludes bob."""
+    required = []
+    excluded = []
+    for term in text.split():
+        if term.startswith("-") and len(term) > 1:
+            excluded.extend(tag for tag in term[1:].split("|") if tag)
+        else:
+            group = [tag for tag in term.split("|") if tag]
+            if group:
+                required.append(group)
+    return TagQuery(required, excluded)
+
+
+class GuildBitmaps:
+    """Tag -> bitmap of a guild's images.
+
+    Images get consecutive bit positions in id order and every tag is a
+    Python int with a bit set per image, so a query is a handful of big-int
+    AND/OR/NOT operations however many images match.
+    """
+
+    def __init__(self):
+        self.ids: list[int] = []
+        self.paths: list[str] = []
+        self.positions: dict[int, int] = {}
+        self.bitmaps: dict[str, int] = {}
+
+    def add(self, image_id: int, file_path: str, tags: list[str]):
+        position = self.positions.get(image_id)
+        if position is None:
+            position = self.positions[image_id] = len(self.ids)
+            self.ids.append(image_id)
+            self.paths.append(file_path)
+        bit = 1 << position
+        for tag in tags:
+            self.bitmaps[tag] = self.bitmaps.get(tag, 0) | bit
+
+    def evaluate(self, query: TagQuery) -> int:
+        result = (1 << len(self.ids)) - 1
+        for group in query.required:
+            matches = 0
+            for tag in group:
+                matches |= self.bitmaps.get(tag, 0)
+            result &= matches
+        for tag in query.excluded:
+            result &= ~self.bitmaps.get(tag, 0)
+        return result
+
+    def sample(self, result: int, rng: random.Random = random) -> Optional[str]:
+        """File path of an image picked uniformly from a result bitmap."""
+        count = result.bit_count()
+        if not count:
+            return None
+        return self.paths[_nth_set_bit(result, rng.randrange(count))]
+
+
+def _nth_set_bit(bits: int, n: int) -> int:
+    """Position of the n-th (from 0) lowest set bit, by binary search on popcounts."""
+    low, high = 0, bits.bit_length()
+    total = bits.bit_count()
+    # Find the smallest position p with more than n set bits in bits[0..p]
+    while low < high:
+        middle = (low + high) // 2
+        if total - (bits >> (middle + 1)).bit_count() > n:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+class TagBitmapIndex:
+    """Per-guild GuildBitmaps, loaded on first use and kept current by `image_added`."""
+
+    def __init__(self, db: Database):
+        self.db = db
+        self._guilds: LazyCache[int, GuildBitmaps] = LazyCache(self._load)
+
+    async def get(self, guild_id: int) -> GuildBitmaps:
+        return await self._guilds.get(guild_id)
+
+    async def _load(self, guild_id: int) -> GuildBitmaps:
+        bitmaps = GuildBitmaps()
+        for row in await self.db.get_guild_image_tags(guild_id):
+            bitmaps.add(row["id"], row["file_path"], [row["name"]] if row["name"] is not None else [])
+        logger.debug("Loaded %d images and %d tags for guild %d", len(bitmaps.ids), len(bitmaps.bitmaps), guild_id)
+        return bitmaps
+
+    async def query(self, guild_id: int, text: str) -> tuple[int, Optional[str]]:
+        """Number of images matching `text`, and the file path of one picked at random."""
+        bitmaps = await self.get(guild_id)
+        result = bitmaps.evaluate(parse_query(text))
+        return result.bit_count(), bitmaps.sample(result)
+
+    def image_added(self, guild_id: int, tags: list[str], image_id: int, file_path: str):
+        self._guilds.update(guild_id, lambda bitmaps: bitmaps.add(image_id, file_path, tags))
+
+    def invalidate(self, guild_id: int):
+        self._guilds.invalidate(lambda key: key == guild_id)
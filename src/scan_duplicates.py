@@ -0,0 +1,101 @@
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from lib.blob_store import blob_path, migrate_flat_layout
+from lib.db import configure_connection, migrate
+from lib.image_helper import get_guild_image_hashes, get_unhashed_files, merge_images, save_image_hashes
+from lib.near_duplicates import BKTree, perceptual_hash
+
+logger = logging.getLogger("scan_duplicates")
+
+
+def _hash(path: str) -> int | None:
+    try:
+        return perceptual_hash(path)
+    except Exception as e:
+        # Truncated or unreadable files shouldn't stop the scan
+        logger.warning("Could not hash %s: %s", path, e)
+        return None
+
+
+def hash_store(conn: sqlite3.Connection, images_dir: Path, workers: int, batch_size: int):
+    """Compute the perceptual hash of every stored file that doesn't have one yet."""
+    files = get_unhashed_files(conn)
+    logger.info("%d files to hash", len(files))
+    started = time.perf_counter()
+    batch = []
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        paths = [str(blob_path(images_dir, file_path)) for file_path in files]
+        for file_path, phash in zip(files, pool.map(_hash, paths, chunksize=16)):
+            done += 1
+            if phash is not None:
+                batch.append((file_path, phash))
+            if len(batch) >= batch_size:
+                save_image_hashes(conn, batch)
+                batch.clear()
+            if done % 1000 == 0:
+                logger.info("%d/%d files hashed (%.0f files/s)", done, len(files), done / (time.perf_counter() - started))
+    if batch:
+        save_image_hashes(conn, batch)
+
+
+def find_duplicates(conn: sqlite3.Connection, guild_id: int, max_distance: int) -> list[tuple[int, str, int, str, int]]:
+    """(kept id, kept file, duplicate id, duplicate file, distance) for every near duplicate, keeping the oldest image."""
+    tree: BKTree[tuple[int, str]] = BKTree()
+    duplicates = []
+    for image_id, file_path, phash in get_guild_image_hashes(conn, guild_id):
+        match = next(
+            (match for match in tree.search(phash, max_distance) if match[1][1] != file_path),
+            None
+        )
+        if match is None:
+            tree.add(phash, (image_id, file_path))
+        else:
+            distance, (kept_id, kept_file) = match
+            duplicates.append((kept_id, kept_file, image_id, file_path, distance))
+    return duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        "scan_duplicates",
+        description="Hash every image in Keabot's store and report (or merge) near duplicates. Stop the bot before using --merge."
+    )
+    parser.add_argument("guild_ids", type=int, nargs="*", help="Guilds to check for duplicates. Only hashes when omitted")
+    parser.add_argument("-d", dest="data_folder", type=Path, default=Path("/app/data"))
+    parser.add_argument("--max-distance", type=int, default=5, help="Largest Hamming distance between two hashes that counts as a duplicate")
+    parser.add_argument("--merge", action="store_true", help="Move the tags of every duplicate onto the original and remove the duplicate")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Hashing processes")
+    parser.add_argument("--batch-size", type=int, default=500, help="Hashes per database transaction")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    DATA_DIR: Path = args.data_folder
+    conn = sqlite3.connect(DATA_DIR / "db" / "keabot.sqlite3")
+    configure_connection(conn)
+    migrate(conn)
+    migrate_flat_layout(DATA_DIR / "images", DATA_DIR / "db" / "keabot.sqlite3")
+    try:
+        hash_store(conn, DATA_DIR / "images", args.workers, args.batch_size)
+        for guild_id in args.guild_ids:
+            duplicates = find_duplicates(conn, guild_id, args.max_distance)
+            for kept_id, kept_file, duplicate_id, duplicate_file, distance in duplicates:
+                logger.info("Guild %d: image %d (%s) duplicates %d (%s), distance %d",
+                            guild_id, duplicate_id, duplicate_file, kept_id, kept_file, distance)
+                if args.merge:
+                    merge_images(conn, kept_id, duplicate_id)
+            action = "merged" if args.merge else "found"
+            logger.info("Guild %d: %d near duplicates %s", guild_id, len(duplicates), action)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
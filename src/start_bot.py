@@ -1,23 +1,30 @@
+import time
+# Taken before the heavy imports so the startup report includes them
+PROCESS_START = time.perf_counter()
+
 import asyncio
-import re
+import atexit
+import argparse
 import discord
-import logging
-import logging.handlers
 import json
+import logging
 import os
+import signal
 import sys
-import time
-import atexit
-import random
-import linecache
-import argparse
-import sqlite3
 from pathlib import Path
-from os.path import join, split
-from lib.keabot import Keabot
+from typing import Optional
+from lib.keabot import Keabot, ShardedKeabot
+from lib.database import Database
+from lib.db import initialize_database
+from lib.blob_store import BlobStore, migrate_flat_layout
+from lib.cluster import ClusterDatabase, Supervisor, WorkerSpec, assign_shards, serve_writes
+from lib.logging_setup import LoggingPipeline
+from lib.maintenance import run_maintenance
+from lib.startup import StartupTimer
+
+ROOT_DIR = Path("/app")
 
-async def main():
-    ROOT_DIR = Path("/app")
+def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser("Keabot", "Run to start the discord bot Keabot. Tracks 'reddit gold', allows image upload and random reposting.")
     parser.add_argument(
             "-t",
@@ -41,24 +48,44 @@ async def main():
             type=Path,
             required=False
             )
+    parser.add_argument(
+            "--force-sync",
+            dest="force_sync",
+            action="store_true",
+            help="Sync application commands with Discord even if they have not changed"
+            )
+    parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="Run as a cluster of this many worker processes sharing one database writer process"
+            )
+    parser.add_argument(
+            "--shards",
+            type=int,
+            default=None,
+            help="Total number of shards in cluster mode, split between the workers. Defaults to one per worker"
+            )
+    return parser.parse_args()
+
+def start_logging(args: argparse.Namespace, config: dict, name: str) -> LoggingPipeline:
+    # Formatting and file writes happen on the pipeline's own thread
+    logging_pipeline = LoggingPipeline(args.data_folder / "logs" / f"{name}.log", config, args.config_loc)
+    logging_pipeline.start()
+    atexit.register(logging_pipeline.stop)
+    return logging_pipeline
 
-    args = parser.parse_args()
+async def main(args: argparse.Namespace, worker: Optional[WorkerSpec] = None, heartbeat=None):
+    startup = StartupTimer(PROCESS_START)
+    startup.mark("imports")
     TOKEN_FILE = args.token_file
     DATA_DIR:Path = args.data_folder
     CONFIG_LOC:Path = args.config_loc
     TOKEN = None
 
-    h = logging.handlers.RotatingFileHandler(
-        filename=DATA_DIR / "logs" / "keabot.log",
-        maxBytes=1000*1000*50,
-        backupCount=7
-    )
-    logging.basicConfig(
-            handlers=[h],
-            level=logging.DEBUG
-            )
-    logger = logging.getLogger(__name__)
     config = json.loads(CONFIG_LOC.read_text())
+    start_logging(args, config, "keabot" if worker is None else f"keabot-worker{worker.index}")
+    logger = logging.getLogger(__name__)
     prefix = config["prefix"]
     
     if TOKEN_FILE:
@@ -76,24 +103,108 @@ async def main():
         sys.exit(1)
 
     #database setup
-    db_conn = sqlite3.connect(DATA_DIR / "db" / "keabot.sqlite3")
-    db_conn.row_factory = sqlite3.Row
+    if worker is None:
+        await asyncio.to_thread(prepare_data, DATA_DIR)
+        db = Database(DATA_DIR / "db" / "keabot.sqlite3", readers=config.get("db_readers", 4))
+    else:
+        # Writes go to the cluster's writer process
+        db = ClusterDatabase(
+            DATA_DIR / "db" / "keabot.sqlite3", worker.writer_address, worker.authkey, readers=config.get("db_readers", 4)
+        )
+        if config.get("metrics_port"):
+            config = {**config, "metrics_port": config["metrics_port"] + worker.index}
+    startup.mark("database")
+    # Lean mode: no presences (nothing reads them, and they are most of the gateway
+    # traffic in big guilds), no member chunking and no library member cache.
+    # Members are fetched when needed and kept in Keabot's bounded MemberCache.
+    lean = config.get("lean_mode", False)
     intents = discord.Intents.default()
     intents.message_content = True
     intents.members = True
     intents.guild_reactions = True
-    intents.presences = True
+    intents.presences = not lean
+    member_cache_flags = discord.MemberCacheFlags.none() if lean else discord.MemberCacheFlags.from_intents(intents)
     description = """Keaton's chatbot to handle random image posting and score tracking."""
 
-    keabot = Keabot(
-        db_conn=db_conn,
+    cluster_kwargs = {}
+    if worker is not None:
+        cluster_kwargs = {
+            "shard_ids": worker.shard_ids, "shard_count": worker.shard_count, "primary": worker.primary,
+            # The writer process runs it, so it keeps going whichever workers are down
+            "maintenance": False
+        }
+        logger.info("Worker %d running shards %s of %d", worker.index, worker.shard_ids, worker.shard_count)
+    keabot = (Keabot if worker is None else ShardedKeabot)(
+        db=db,
+        config=config,
+        startup=startup,
+        force_sync=args.force_sync,
         root_dir=ROOT_DIR,
         data_dir=DATA_DIR,
         intents=intents,
+        member_cache_flags=member_cache_flags,
+        chunk_guilds_at_startup=not lean,
+        # Gold tracking uses raw reaction events, so the library's message cache can stay small
+        max_messages=config.get("max_messages", 100),
         description=description,
-        command_prefix=prefix
+        command_prefix=prefix,
+        **cluster_kwargs
+        )
+    if heartbeat is not None:
+        # Proves to the supervisor that this worker's event loop is still turning
+        async def beat():
+            while True:
+                heartbeat.value = time.time()
+                await asyncio.sleep(config.get("cluster_heartbeat_interval", 5))
+        beat_task = asyncio.create_task(beat())
+        # The supervisor stops workers with SIGTERM; close cleanly so buffered scores are written
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(keabot.close()))
+    async with keabot:
+        await keabot.start(TOKEN)
+
+def prepare_data(DATA_DIR: Path):
+    initialize_database(DATA_DIR / "db" / "keabot.sqlite3")
+    moved = migrate_flat_layout(DATA_DIR / "images", DATA_DIR / "db" / "keabot.sqlite3")
+    if moved:
+        logging.getLogger(__name__).info("Moved %d files into the sharded image store", moved)
+
+def run_worker(args: argparse.Namespace, worker: WorkerSpec, heartbeat):
+    asyncio.run(main(args, worker, heartbeat))
+
+def run_writer(args: argparse.Namespace, address: str, authkey: bytes):
+    config = json.loads(args.config_loc.read_text())
+    start_logging(args, config, "keabot-writer")
+
+    async def maintain(db: Database):
+        blobs = BlobStore(
+            args.data_folder / "images",
+            db,
+            grace=config.get("blob_gc_grace", 3600),
+            batch_size=config.get("blob_gc_batch", 100)
         )
-    await keabot.start(TOKEN)
+        await run_maintenance(db, blobs, config)
+
+    serve_writes(args.data_folder / "db" / "keabot.sqlite3", address, authkey, maintain)
+
+def run_cluster(args: argparse.Namespace) -> int:
+    """Supervise one database writer process and `args.processes` ShardedKeabot workers."""
+    config = json.loads(args.config_loc.read_text())
+    start_logging(args, config, "keabot")
+    prepare_data(args.data_folder)
+    address = str(args.data_folder / "db" / "writer.sock")
+    # Only processes started by this supervisor can talk to the writer
+    authkey = os.urandom(32)
+    supervisor = Supervisor(heartbeat_timeout=config.get("cluster_heartbeat_timeout", 60))
+    supervisor.add("writer", run_writer, (args, address, authkey))
+    shard_count = args.shards or args.processes
+    for index, shard_ids in enumerate(assign_shards(shard_count, args.processes)):
+        worker = WorkerSpec(index, shard_ids, shard_count, address, authkey)
+        supervisor.add(f"worker-{index}", run_worker, (args, worker), heartbeat=True)
+    return supervisor.run()
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    args = parse_args()
+    if args.processes > 1 or args.shards:
+        sys.exit(run_cluster(args))
+    asyncio.run(main(args))
     
\ No newline at end of file
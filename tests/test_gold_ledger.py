@@ -0,0 +1,163 @@
+import sqlite3
+import time
+
+import pytest
+
+from lib import score_helper
+from lib.db import migrate
+from lib.score_helper import DISCORD_EPOCH_MS, LEGACY_STATE, rollup_bucket
+
+SERVER = 1
+CHANNEL = 2
+
+
+def snowflake(timestamp: float) -> int:
+    return (int(timestamp * 1000) - DISCORD_EPOCH_MS) << 22
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = sqlite3.Row
+    # The ledger of an empty database starts now
+    migrate(conn)
+    yield conn
+    conn.close()
+
+
+def reaction(message_id: int, gifter_id: int, receiver_id: int, active: bool, updated_at: float = None) -> dict:
+    return {
+        "message_id": message_id,
+        "gifter_id": gifter_id,
+        "emoji": "gold",
+        "server_id": SERVER,
+        "channel_id": CHANNEL,
+        "receiver_id": receiver_id,
+        "active": int(active),
+        "updated_at": int(updated_at or time.time()),
+    }
+
+
+def seed(conn, user_id: int, score: int = 0, given: int = 0):
+    conn.execute(
+        "INSERT INTO user (server_id, user_id, score, given, self) VALUES (?, ?, ?, ?, 0)",
+        (SERVER, user_id, score, given)
+    )
+    conn.commit()
+
+
+def counters(conn, user_id: int) -> tuple[int, int, int]:
+    row = conn.execute(
+        "SELECT score, given, self FROM user WHERE server_id = ? AND user_id = ?", (SERVER, user_id)
+    ).fetchone()
+    return tuple(row) if row else (0, 0, 0)
+
+
+def rollup(conn, period: str, timestamp: float, user_id: int) -> int:
+    row = conn.execute(
+        "SELECT score FROM score_rollup WHERE server_id = ? AND period = ? AND bucket = ? AND user_id = ?",
+        (SERVER, period, rollup_bucket(period, timestamp), user_id)
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def test_repeated_events_count_once(conn):
+    message = snowflake(time.time() + 60)
+    deltas = score_helper.apply_reactions(conn, [reaction(message, 10, 20, True)])
+    assert deltas == {(SERVER, 20): [1, 0, 0], (SERVER, 10): [0, 1, 0]}
+    assert score_helper.apply_reactions(conn, [reaction(message, 10, 20, True)]) == {}
+    assert counters(conn, 20) == (1, 0, 0)
+    assert counters(conn, 10) == (0, 1, 0)
+
+    score_helper.apply_reactions(conn, [reaction(message, 10, 20, False)])
+    assert score_helper.apply_reactions(conn, [reaction(message, 10, 20, False)]) == {}
+    assert counters(conn, 20) == (0, 0, 0)
+    assert counters(conn, 10) == (0, 0, 0)
+
+    # Given again after taking it back
+    score_helper.apply_reactions(conn, [reaction(message, 10, 20, True)])
+    assert counters(conn, 20) == (1, 0, 0)
+
+
+def test_duplicates_within_one_batch_count_once(conn):
+    message = snowflake(time.time() + 60)
+    score_helper.apply_reactions(conn, [reaction(message, 10, 20, True)] * 3)
+    assert counters(conn, 20) == (1, 0, 0)
+
+
+def test_gold_on_own_message_counts_as_self(conn):
+    score_helper.apply_reactions(conn, [reaction(snowflake(time.time() + 60), 10, 10, True)])
+    assert counters(conn, 10) == (1, 0, 1)
+
+
+def test_removal_never_added_on_a_new_message_changes_nothing(conn):
+    message = snowflake(time.time() + 60)
+    assert score_helper.apply_reactions(conn, [reaction(message, 10, 20, False)]) == {}
+    assert counters(conn, 20) == (0, 0, 0)
+
+
+def test_removal_of_gold_from_before_the_ledger_is_taken_back_once(conn):
+    seed(conn, 20, score=5)
+    seed(conn, 10, given=3)
+    old_message = snowflake(time.time() - 3600)
+    key = (old_message, 10, "gold")
+    assert score_helper.get_ledger_states(conn, [key]) == {key: LEGACY_STATE}
+
+    score_helper.apply_reactions(conn, [reaction(old_message, 10, 20, False)])
+    score_helper.apply_reactions(conn, [reaction(old_message, 10, 20, False)])
+    assert counters(conn, 20) == (4, 0, 0)
+    assert counters(conn, 10) == (0, 2, 0)
+    assert score_helper.get_ledger_states(conn, [key]) == {key: 0}
+    # It was never counted in a rollup, so none goes negative
+    assert conn.execute("SELECT COUNT(*) FROM score_rollup").fetchone()[0] == 0
+
+
+def test_removal_undoes_the_buckets_the_gold_was_given_in(conn):
+    message = snowflake(time.time() + 60)
+    given_at = time.time() - 40 * 86400
+    score_helper.apply_reactions(conn, [reaction(message, 10, 20, True, updated_at=given_at)])
+    assert rollup(conn, "month", given_at, 20) == 1
+    assert rollup(conn, "day", given_at, 10) == 0
+
+    # Taken back more than a month later
+    score_helper.apply_reactions(conn, [reaction(message, 10, 20, False)])
+    assert rollup(conn, "month", given_at, 20) == 0
+    assert rollup(conn, "month", time.time(), 20) == 0
+
+
+def test_rebuild_follows_the_ledger_and_keeps_unledgered_counters(conn):
+    # A starting score the ledger knows nothing about
+    seed(conn, 30, score=7)
+    first, second = snowflake(time.time() + 60), snowflake(time.time() + 120)
+    score_helper.apply_reactions(conn, [
+        reaction(first, 10, 20, True),
+        reaction(second, 10, 20, True),
+        reaction(second, 20, 20, True),
+    ])
+    conn.execute("UPDATE user SET score = 100 WHERE user_id = 20")
+    conn.execute("DELETE FROM score_rollup")
+    conn.commit()
+
+    score_helper.rebuild_scores(conn, SERVER)
+    assert counters(conn, 20) == (3, 0, 1)
+    assert counters(conn, 10) == (0, 2, 0)
+    assert counters(conn, 30) == (7, 0, 0)
+    assert rollup(conn, "day", time.time(), 20) == 3
+
+
+def test_backfill_makes_the_ledger_match_history(conn):
+    message = snowflake(time.time() + 60)
+    score_helper.apply_reactions(conn, [reaction(message, 10, 20, True), reaction(message, 11, 20, True)])
+    # While the bot was away 11 took theirs back and 12 gave gold
+    page = [(message, 20, [("gold", 10), ("gold", 12)])]
+    for _ in range(2):
+        score_helper.reconcile_reactions(conn, SERVER, CHANNEL, page, message, True, int(time.time()))
+    active = conn.execute("SELECT gifter_id FROM gold_ledger WHERE active = 1").fetchall()
+    assert sorted(int(row[0]) for row in active) == [10, 12]
+    checkpoints = score_helper.get_backfill_checkpoints(conn, SERVER)
+    assert [(int(channel), row["done"]) for channel, row in checkpoints.items()] == [(CHANNEL, 1)]
+
+    score_helper.rebuild_scores(conn, SERVER)
+    assert counters(conn, 20) == (2, 0, 0)
+    assert counters(conn, 11) == (0, 0, 0)
+    assert counters(conn, 12) == (0, 1, 0)
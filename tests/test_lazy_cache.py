@@ -0,0 +1,96 @@
+import asyncio
+
+from lib.lazy_cache import LazyCache
+
+
+class FakeTable:
+    """Rows a load reads, with a hook to hold the load part way through."""
+
+    def __init__(self):
+        self.rows: list[int] = []
+        self.loads = 0
+        self.reading = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def load(self, key: int) -> list[int]:
+        self.loads += 1
+        rows = list(self.rows)
+        self.reading.set()
+        await self.release.wait()
+        return rows
+
+
+def test_concurrent_gets_share_one_load():
+    async def main():
+        table = FakeTable()
+        table.rows = [1]
+        cache = LazyCache(table.load)
+        gets = [asyncio.create_task(cache.get(7)) for _ in range(3)]
+        await table.reading.wait()
+        table.release.set()
+        results = await asyncio.gather(*gets)
+        assert results == [[1], [1], [1]]
+        assert table.loads == 1
+        assert cache.cached(7) == [1]
+
+    asyncio.run(main())
+
+
+def test_write_during_load_is_not_lost():
+    async def main():
+        table = FakeTable()
+        cache = LazyCache(table.load)
+        get = asyncio.create_task(cache.get(7))
+        await table.reading.wait()
+        # Committed after the load read the table, reported before it finished
+        table.rows.append(2)
+        cache.update(7, lambda rows: rows.append(2))
+        table.release.set()
+        assert await get == [2]
+        assert table.loads == 2
+        # Later writes go straight to the cached value
+        cache.update(7, lambda rows: rows.append(3))
+        assert cache.cached(7) == [2, 3]
+
+    asyncio.run(main())
+
+
+def test_update_for_unloaded_key_is_ignored():
+    async def main():
+        table = FakeTable()
+        table.release.set()
+        cache = LazyCache(table.load)
+        cache.update(7, lambda rows: rows.append(2))
+        assert cache.cached(7) is None
+        assert await cache.get(7) == []
+
+    asyncio.run(main())
+
+
+def test_invalidate_during_load_reloads():
+    async def main():
+        table = FakeTable()
+        cache = LazyCache(table.load)
+        get = asyncio.create_task(cache.get(7))
+        await table.reading.wait()
+        table.rows = [5]
+        cache.invalidate(lambda key: key == 7)
+        table.release.set()
+        assert await get == [5]
+
+    asyncio.run(main())
+
+
+def test_values_failing_keep_are_not_cached():
+    async def main():
+        table = FakeTable()
+        table.release.set()
+        cache = LazyCache(table.load, keep=bool)
+        assert await cache.get(7) == []
+        assert cache.cached(7) is None
+        table.rows = [1]
+        assert await cache.get(7) == [1]
+        assert cache.cached(7) == [1]
+        assert table.loads == 2
+
+    asyncio.run(main())
@@ -0,0 +1,49 @@
+import sqlite3
+
+import pytest
+
+from lib import db
+
+
+def user_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def tables(conn) -> set[str]:
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'index')")}
+
+
+def test_empty_database_gets_every_migration_once():
+    conn = sqlite3.connect(":memory:")
+    assert db.migrate(conn) == len(db.MIGRATIONS)
+    assert user_version(conn) == len(db.MIGRATIONS)
+    schema = tables(conn)
+    assert db.migrate(conn) == len(db.MIGRATIONS)
+    assert tables(conn) == schema
+
+
+def test_older_database_is_upgraded_keeping_its_data(monkeypatch):
+    conn = sqlite3.connect(":memory:")
+    monkeypatch.setattr(db, "MIGRATIONS", db.MIGRATIONS[:4])
+    assert db.migrate(conn) == 4
+    conn.execute("INSERT INTO image (file_path, server_id) VALUES ('a.jpg', '1')")
+    conn.commit()
+
+    monkeypatch.undo()
+    assert db.migrate(conn) == len(db.MIGRATIONS)
+    assert conn.execute("SELECT file_path FROM image").fetchall() == [("a.jpg",)]
+
+
+def test_failed_migration_is_rolled_back(monkeypatch):
+    conn = sqlite3.connect(":memory:")
+    db.migrate(conn)
+
+    def _broken(cursor: sqlite3.Cursor):
+        cursor.execute("CREATE TABLE half_done (id INTEGER)")
+        raise sqlite3.OperationalError("boom")
+
+    monkeypatch.setattr(db, "MIGRATIONS", [*db.MIGRATIONS, _broken])
+    with pytest.raises(sqlite3.OperationalError):
+        db.migrate(conn)
+    assert user_version(conn) == len(db.MIGRATIONS) - 1
+    assert "half_done" not in tables(conn)
@@ -0,0 +1,82 @@
+import asyncio
+import random
+
+import pytest
+
+from lib.near_duplicates import BKTree, DuplicateIndex, hamming, perceptual_hash
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def test_search_matches_brute_force():
+    rng = random.Random(7)
+    # Clustered hashes, so searches have matches at every distance
+    centres = [rng.getrandbits(64) for _ in range(20)]
+    values = [centre ^ rng.getrandbits(64) & rng.getrandbits(64) & rng.getrandbits(64) for centre in centres for _ in range(25)]
+    tree: BKTree[int] = BKTree()
+    for item, value in enumerate(values):
+        tree.add(value, item)
+    assert tree.size == len(values)
+    for _ in range(50):
+        query = rng.choice(centres) ^ rng.getrandbits(64) & rng.getrandbits(64) & rng.getrandbits(64)
+        for max_distance in (0, 4, 12):
+            expected = sorted((hamming(query, value), item) for item, value in enumerate(values) if hamming(query, value) <= max_distance)
+            matches = tree.search(query, max_distance)
+            assert sorted(matches) == expected
+            assert [distance for distance, _ in matches] == sorted(distance for distance, _ in matches)
+
+
+def test_equal_hashes_share_a_node_without_duplicate_items():
+    tree: BKTree[str] = BKTree()
+    assert tree.search(0, 64) == []
+    tree.add(0b1010, "a")
+    tree.add(0b1010, "b")
+    tree.add(0b1010, "a")
+    tree.add(0b1011, "c")
+    assert tree.size == 3
+    assert tree.search(0b1010, 0) == [(0, "a"), (0, "b")]
+    assert tree.search(0b1010, 1) == [(0, "a"), (0, "b"), (1, "c")]
+
+
+class StubDatabase:
+    def __init__(self, rows: list[tuple[int, str, int]]):
+        self.rows = rows
+
+    async def get_guild_image_hashes(self, guild_id: int) -> list[tuple[int, str, int]]:
+        return self.rows
+
+
+def test_find_skips_the_file_itself_and_respects_the_distance():
+    async def main():
+        index = DuplicateIndex(StubDatabase([(1, "a.jpg", 0b0000), (2, "b.jpg", 0b0111)]), max_distance=2)
+        assert await index.find(1, 0b0001) == (1, "a.jpg")
+        assert await index.find(1, 0b0000, exclude="a.jpg") is None
+        index.image_added(1, 0b0011, 3, "c.jpg")
+        assert await index.find(1, 0b0000, exclude="a.jpg") == (3, "c.jpg")
+
+        disabled = DuplicateIndex(StubDatabase([(1, "a.jpg", 0)]), max_distance=-1)
+        assert await disabled.find(1, 0) is None
+
+    asyncio.run(main())
+
+
+@pytest.mark.skipif(Image is None, reason="needs Pillow")
+def test_perceptual_hash_survives_resizing(tmp_path):
+    rng = random.Random(5)
+    image = Image.new("L", (90, 80))
+    image.putdata([rng.randrange(256) for _ in range(90 * 80)])
+    image = image.resize((360, 320), Image.Resampling.BICUBIC)
+    image.save(tmp_path / "original.png")
+    image.resize((180, 160)).save(tmp_path / "smaller.jpg", quality=80)
+    other = Image.new("L", (360, 320))
+    other.putdata([rng.randrange(256) for _ in range(360 * 320)])
+    other.save(tmp_path / "other.png")
+
+    original = perceptual_hash(str(tmp_path / "original.png"))
+    assert hamming(original, perceptual_hash(str(tmp_path / "smaller.jpg"))) <= 5
+    assert hamming(original, perceptual_hash(str(tmp_path / "other.png"))) > 5
+    (tmp_path / "notes.txt").write_text("not an image")
+    assert perceptual_hash(str(tmp_path / "notes.txt")) is None
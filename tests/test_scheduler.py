@@ -0,0 +1,166 @@
+import asyncio
+
+import pytest
+
+from lib.scheduler import Overloaded, Scheduler
+
+
+def scheduler(global_limit: int, guild_limit: int, deadline: float = 5.0) -> Scheduler:
+    return Scheduler({"upload": {"global": global_limit, "guild": guild_limit, "deadline": deadline}})
+
+
+def test_guilds_are_served_in_turn():
+    async def main():
+        sched = scheduler(1, 1)
+        order = []
+        gate = asyncio.Event()
+
+        async def job(guild_id: int, name: str):
+            async with sched.slot("upload", guild_id):
+                order.append(name)
+                await gate.wait()
+
+        # Guild 1 takes the slot and queues two more before guild 2 asks
+        tasks = [asyncio.create_task(job(1, "a1"))]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(job(1, name)) for name in ("a2", "a3")]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(job(2, "b1")))
+        await asyncio.sleep(0)
+        gate.set()
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(main()) == ["a1", "a2", "b1", "a3"]
+
+
+def test_guild_limit_leaves_room_for_other_guilds():
+    async def main():
+        sched = scheduler(3, 1)
+        gate = asyncio.Event()
+        running = []
+
+        async def job(guild_id: int):
+            async with sched.slot("upload", guild_id):
+                running.append(guild_id)
+                await gate.wait()
+
+        tasks = [asyncio.create_task(job(guild_id)) for guild_id in (1, 1, 2, 3)]
+        await asyncio.sleep(0)
+        started = list(running)
+        gate.set()
+        await asyncio.gather(*tasks)
+        return started
+
+    assert asyncio.run(main()) == [1, 2, 3]
+
+
+def test_rejects_when_predicted_wait_exceeds_deadline():
+    async def main():
+        sched = scheduler(1, 1, deadline=1.0)
+        lane = sched._lanes["upload"]
+        lane.service_time = 2.0
+        async with sched.slot("upload", 1):
+            with pytest.raises(Overloaded):
+                async with sched.slot("upload", 2):
+                    pass
+        assert lane.rejected == 1
+        assert lane.running == 0
+
+    asyncio.run(main())
+
+
+def test_rejects_waiter_at_deadline():
+    async def main():
+        sched = scheduler(1, 1, deadline=0.01)
+        lane = sched._lanes["upload"]
+        async with sched.slot("upload", 1):
+            with pytest.raises(Overloaded):
+                async with sched.slot("upload", 2):
+                    pass
+        assert (lane.running, lane.waiting, lane.queues, list(lane.ready)) == (0, 0, {}, [])
+
+    asyncio.run(main())
+
+
+def test_release_while_timed_out_waiter_is_still_queued():
+    async def main():
+        sched = scheduler(1, 1, deadline=0.01)
+        lane = sched._lanes["upload"]
+        holder = sched.slot("upload", 1)
+        await holder.__aenter__()
+        waiting = asyncio.create_task(sched.run("upload", 2, lambda: asyncio.sleep(0)))
+        await asyncio.sleep(0)
+        errors = []
+
+        def release(_):
+            # What the holder's slot() does on exit, run the moment the deadline
+            # cancels the waiter and before _acquire withdraws it
+            try:
+                lane.finish(1, None)
+                lane.dispatch()
+            except Exception as e:
+                errors.append(e)
+
+        lane.queues[2][0].add_done_callback(release)
+        with pytest.raises(Overloaded):
+            await waiting
+        assert errors == []
+        assert (lane.running, lane.waiting, lane.queues, list(lane.ready)) == (0, 0, {}, [])
+        # The slot is free again
+        async with sched.slot("upload", 3):
+            assert lane.running == 1
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_gives_up_its_place():
+    async def main():
+        sched = scheduler(1, 1)
+        lane = sched._lanes["upload"]
+        ran = []
+        async with sched.slot("upload", 1):
+            cancelled = asyncio.create_task(sched.run("upload", 2, lambda: asyncio.sleep(0)))
+            waiting = asyncio.create_task(sched.run("upload", 3, lambda: asyncio.sleep(0, "ran")))
+            await asyncio.sleep(0)
+            cancelled.cancel()
+            await asyncio.sleep(0)
+        ran.append(await waiting)
+        assert cancelled.cancelled()
+        assert ran == ["ran"]
+        assert (lane.running, lane.waiting) == (0, 0)
+
+    asyncio.run(main())
+
+
+def test_cancelled_after_being_handed_a_slot_passes_it_on():
+    async def main():
+        sched = scheduler(1, 1)
+        lane = sched._lanes["upload"]
+        async with sched.slot("upload", 1):
+            handed = asyncio.create_task(sched.run("upload", 2, lambda: asyncio.sleep(0)))
+            after = asyncio.create_task(sched.run("upload", 3, lambda: asyncio.sleep(0, "ran")))
+            await asyncio.sleep(0)
+        # The slot went to `handed`, which is cancelled before it resumes
+        handed.cancel()
+        assert await after == "ran"
+        assert (lane.running, lane.waiting) == (0, 0)
+
+    asyncio.run(main())
+
+
+def test_same_key_shares_one_run():
+    async def main():
+        sched = scheduler(2, 2)
+        calls = 0
+
+        async def build():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return calls
+
+        results = await asyncio.gather(*(sched.run("upload", 1, build, key="board") for _ in range(3)))
+        return calls, results
+
+    assert asyncio.run(main()) == (1, [1, 1, 1])
@@ -0,0 +1,70 @@
+import random
+
+from lib.score_ranks import MERGE_THRESHOLD, GuildRanks, Standing
+
+
+def ranks_of(scores: dict[int, int]) -> GuildRanks:
+    ranks = GuildRanks()
+    ranks.update(scores)
+    return ranks
+
+
+def test_ties_share_a_rank():
+    ranks = ranks_of({1: 10, 2: 5, 3: 5, 4: 1})
+    assert ranks.standing(2).rank == 2
+    assert ranks.standing(3).rank == 2
+    assert ranks.standing(4).rank == 4
+    assert ranks.standing(1) == Standing(score=10, rank=1, total=4, above=None, below=(2, 5))
+
+
+def test_neighbours_skip_the_user_themselves():
+    ranks = ranks_of({1: 10, 2: 5, 3: 1})
+    standing = ranks.standing(2)
+    assert standing.above == (1, 10)
+    assert standing.below == (3, 1)
+    assert ranks.standing(3).below is None
+
+
+def test_unindexed_user_is_counted_in_total():
+    ranks = ranks_of({1: 10, 2: 5})
+    standing = ranks.standing(99)
+    assert (standing.score, standing.rank, standing.total) == (0, 3, 3)
+    assert str(standing) == "#3 of 3 (top 100%)"
+
+
+def test_standing_with_a_newer_score_than_indexed():
+    # e.g. ..score adding reactions still waiting to be flushed
+    ranks = ranks_of({1: 10, 2: 5, 3: 1})
+    assert ranks.standing(3, score=7).rank == 2
+    assert ranks.standing(1, score=4).rank == 2
+    assert ranks.standing(1, score=0).rank == 3
+    assert ranks.standing(2, score=5).rank == 2
+
+
+def test_zero_delta_only_adds_new_users():
+    ranks = ranks_of({1: 3})
+    ranks.update({1: 0, 2: 0})
+    assert ranks.scores == {1: 3, 2: 0}
+    assert ranks.sorted == [(-3, 1), (0, 2)]
+
+
+def test_top():
+    ranks = ranks_of({1: 1, 2: 3, 3: 2})
+    assert ranks.top(2) == [{"user_id": 2, "score": 3}, {"user_id": 3, "score": 2}]
+
+
+def test_small_and_large_batches_match_a_full_sort():
+    rng = random.Random(1)
+    ranks = GuildRanks()
+    expected: dict[int, int] = {}
+    for _ in range(200):
+        # Alternate between the bisect path and the merge path
+        size = rng.choice([1, MERGE_THRESHOLD, MERGE_THRESHOLD + 1, 60])
+        deltas = {rng.randrange(100): rng.randint(-3, 3) for _ in range(size)}
+        ranks.update(deltas)
+        for user_id, delta in deltas.items():
+            expected[user_id] = expected.get(user_id, 0) + delta
+        assert ranks.scores == expected
+        assert ranks.sorted == sorted((-score, user_id) for user_id, score in expected.items())
+    for user_id, score in expected.items():
+        assert ranks.standing(user_id).rank == 1 + sum(other > score for other in expected.values())
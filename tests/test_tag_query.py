@@ -0,0 +1,73 @@
+import random
+
+from lib.tag_query import GuildBitmaps, TagQuery, _nth_set_bit, parse_query
+
+
+def bitmaps_of(images: dict[int, list[str]]) -> GuildBitmaps:
+    bitmaps = GuildBitmaps()
+    for image_id, tags in images.items():
+        bitmaps.add(image_id, f"{image_id}.jpg", tags)
+    return bitmaps
+
+
+def matching(bitmaps: GuildBitmaps, text: str) -> set[int]:
+    result = bitmaps.evaluate(parse_query(text))
+    return {image_id for position, image_id in enumerate(bitmaps.ids) if result >> position & 1}
+
+
+def test_parse_query():
+    assert parse_query("alice") == TagQuery([["alice"]], [])
+    assert parse_query("alice bob|carol -dave") == TagQuery([["alice"], ["bob", "carol"]], ["dave"])
+    assert parse_query("-dave|erin") == TagQuery([], ["dave", "erin"])
+
+
+def test_parse_query_ignores_empty_terms():
+    assert parse_query("  alice  |  -| ") == TagQuery([["alice"]], [])
+    assert parse_query("alice||bob|") == TagQuery([["alice", "bob"]], [])
+
+
+IMAGES = {
+    1: ["alice"],
+    2: ["alice", "bob"],
+    3: ["bob"],
+    4: ["carol"],
+    5: [],
+}
+
+
+def test_evaluate():
+    bitmaps = bitmaps_of(IMAGES)
+    assert matching(bitmaps, "alice") == {1, 2}
+    assert matching(bitmaps, "alice bob") == {2}
+    assert matching(bitmaps, "alice|bob") == {1, 2, 3}
+    assert matching(bitmaps, "alice|bob -bob") == {1}
+    assert matching(bitmaps, "-alice") == {3, 4, 5}
+    assert matching(bitmaps, "unknown") == set()
+    assert matching(bitmaps, "alice|unknown") == {1, 2}
+    assert matching(bitmaps, "") == {1, 2, 3, 4, 5}
+
+
+def test_adding_an_image_again_only_adds_tags():
+    bitmaps = bitmaps_of(IMAGES)
+    bitmaps.add(4, "4.jpg", ["alice"])
+    assert len(bitmaps.ids) == 5
+    assert matching(bitmaps, "alice carol") == {4}
+
+
+def test_nth_set_bit():
+    rng = random.Random(3)
+    for _ in range(200):
+        bits = rng.getrandbits(rng.randrange(1, 300))
+        positions = [position for position in range(bits.bit_length()) if bits >> position & 1]
+        for n, position in enumerate(positions):
+            assert _nth_set_bit(bits, n) == position
+
+
+def test_sample_is_uniform_over_the_matches():
+    bitmaps = bitmaps_of(IMAGES)
+    rng = random.Random(1)
+    result = bitmaps.evaluate(parse_query("alice|bob"))
+    picks = [bitmaps.sample(result, rng) for _ in range(3000)]
+    assert set(picks) == {"1.jpg", "2.jpg", "3.jpg"}
+    assert all(900 < picks.count(path) < 1100 for path in set(picks))
+    assert bitmaps.sample(bitmaps.evaluate(parse_query("unknown")), rng) is None